@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Compare the WebSocket wire formats on typical chat events.
+
+Reports bytes per frame for JSON and MessagePack, with and without
+permessage-deflate (modelled with zlib, one shared context per connection as
+negotiated by config/wsserver.py), plus encode/decode time per frame.
+
+    python bench_codecs.py [--frames 20000]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+import zlib
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+import django
+
+django.setup()
+
+from chat.codecs import JsonCodec, MsgpackCodec
+
+
+def sample_events(count):
+    """A mix resembling a busy room: mostly messages, some typing and receipts"""
+    events = []
+    for i in range(count):
+        user_id = 1000 + i % 25
+        kind = i % 10
+        if kind < 6:
+            events.append({
+                'type': 'message',
+                'message': f'Message number {i} about the release plan for this week',
+                'user_id': user_id,
+                'username': f'user{user_id}',
+                'display_name': f'User {user_id}',
+                'message_id': 500000 + i,
+                'timestamp': f'2024-05-01T12:{i % 60:02d}:{i % 59:02d}.123456+00:00',
+                'client_msg_id': f'c-{user_id}-{i}',
+                'parent_id': None,
+                'thread_root_id': None,
+                'attachments': [],
+            })
+        elif kind < 9:
+            events.append({
+                'type': 'typing',
+                'user_id': user_id,
+                'username': f'user{user_id}',
+                'display_name': f'User {user_id}',
+                'typing': i % 2 == 0,
+            })
+        else:
+            events.append({
+                'type': 'read',
+                'cursors': [{'user_id': user_id, 'delivered_up_to': 500000 + i, 'read_up_to': 500000 + i}],
+            })
+    return events
+
+
+def deflated_size(frames):
+    compressor = zlib.compressobj(wbits=-11, memLevel=4)
+    total = 0
+    for frame in frames:
+        data = frame.encode() if isinstance(frame, str) else frame
+        # permessage-deflate drops the trailing empty block of each sync flush
+        total += len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return total
+
+
+def run(frames):
+    events = sample_events(frames)
+    print(f"📊 {frames} frames")
+    print(f"{'codec':<10}{'bytes/frame':>14}{'deflated':>12}{'encode µs':>12}{'decode µs':>12}")
+    for name, codec in (('json', JsonCodec()), ('msgpack', MsgpackCodec())):
+        encoded = [codec.encode(event) for event in events]
+        raw = sum(len(e.encode() if isinstance(e, str) else e) for e in encoded)
+        deflated = deflated_size(encoded)
+
+        encode = timeit.timeit(lambda: [codec.encode(event) for event in events], number=3) / 3
+        if isinstance(encoded[0], str):
+            decode = timeit.timeit(lambda: [codec.decode(text_data=e) for e in encoded], number=3) / 3
+        else:
+            decode = timeit.timeit(lambda: [codec.decode(bytes_data=e) for e in encoded], number=3) / 3
+
+        print(
+            f"{name:<10}{raw / frames:>14.1f}{deflated / frames:>12.1f}"
+            f"{encode / frames * 1e6:>12.2f}{decode / frames * 1e6:>12.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=20000)
+    run(parser.parse_args().frames)
+
+
+if __name__ == '__main__':
+    main()
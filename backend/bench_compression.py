@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Measure what response compression saves on typical REST payloads.
+
+The payloads mirror the API: a history page from the messages endpoint
+(MessageSerializer, with sender, reactions and thread fields) and a
+conversation list with nested participants. Each one is rendered with DRF's
+JSONRenderer and compressed with every available encoding at a few levels.
+For each encoding the script reports size, compression time, and estimated
+time to deliver the body (compression plus transfer) at several link speeds.
+
+    python bench_compression.py [--messages 50] [--conversations 30] [--participants 8]
+
+br and zstd are only measured when the brotli / zstandard packages are
+installed.
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+import django
+
+django.setup()
+
+from rest_framework.renderers import JSONRenderer
+
+from config import compression_middleware as compression
+
+# Link speeds in megabits per second
+LINKS = (('3g', 1.5), ('4g', 10), ('wifi', 50))
+
+LEVELS = {
+    'gzip': (1, 6, 9),
+    'br': (1, 4, 6),
+    'zstd': (1, 3, 9),
+}
+
+
+def user(user_id):
+    return {'id': user_id, 'username': f'user{user_id}', 'display_name': f'User {user_id}'}
+
+
+def history_page(count):
+    return {
+        'next': 'http://api.example.com/api/conversations/42/messages/?cursor=cD0yMDI0LTA1LTAx',
+        'previous': None,
+        'results': [
+            {
+                'id': 500000 + i,
+                'conversation': 42,
+                'sender': user(1000 + i % 6),
+                'content': f'Message number {i} about the release plan and who is on call this week',
+                'attachments': [],
+                'reactions': {'👍': i % 4} if i % 3 == 0 else {},
+                'client_msg_id': f'c-{1000 + i % 6}-{i}',
+                'parent': None,
+                'thread_root': None,
+                'reply_count': i % 5,
+                'last_reply_at': None,
+                'created_at': f'2024-05-01T12:{i % 60:02d}:{i % 59:02d}.123456Z',
+                'version': 1,
+                'edited_at': None,
+                'deleted_at': None,
+            }
+            for i in range(count)
+        ],
+    }
+
+
+def conversation_list(count, participants):
+    return [
+        {
+            'id': 40 + i,
+            'title': f'Team room {i}' if i % 2 else '',
+            'display_title': f'Team room {i}' if i % 2 else f'User {1000 + i}',
+            'participants': [user(1000 + (i + j) % 40) for j in range(participants if i % 2 else 2)],
+            'slow_mode_seconds': 0,
+            'created_at': f'2024-04-{1 + i % 28:02d}T09:00:00.000000Z',
+        }
+        for i in range(count)
+    ]
+
+
+def compressor(coding, level):
+    if coding == 'gzip':
+        return compression._GzipCompressor(level)
+    if coding == 'br':
+        return compression._BrotliCompressor(level)
+    return compression._ZstdCompressor(level)
+
+
+def measure(name, body):
+    codings = [coding for coding in ('gzip', 'br', 'zstd') if coding in compression.available_encodings()]
+    print(f"\n📊 {name}: {len(body)} bytes")
+    header = ''.join(f'{link + " ms":>10}' for link, _ in LINKS)
+    print(f"{'encoding':<12}{'bytes':>9}{'ratio':>8}{'cpu ms':>9}{header}")
+
+    def row(label, size, cpu_ms):
+        transfer = ''.join(f'{cpu_ms + size * 8 / (mbps * 1000):>10.1f}' for _, mbps in LINKS)
+        print(f"{label:<12}{size:>9}{len(body) / size:>8.1f}{cpu_ms:>9.2f}{transfer}")
+
+    row('identity', len(body), 0.0)
+    for coding in codings:
+        for level in LEVELS[coding]:
+            def run():
+                c = compressor(coding, level)
+                return c.compress(body) + c.finish()
+
+            size = len(run())
+            cpu_ms = timeit.timeit(run, number=20) / 20 * 1000
+            row(f'{coding}-{level}', size, cpu_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--conversations', type=int, default=30)
+    parser.add_argument('--participants', type=int, default=8)
+    args = parser.parse_args()
+
+    renderer = JSONRenderer()
+    measure(f'History page, {args.messages} messages', renderer.render(history_page(args.messages)))
+    measure(
+        f'Conversation list, {args.conversations} conversations',
+        renderer.render(conversation_list(args.conversations, args.participants)),
+    )
+
+
+if __name__ == '__main__':
+    main()
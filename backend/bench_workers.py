@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Measure HTTP throughput of start_server.py with different worker counts.
+
+For each worker count the launcher is started on a free local port and
+hammered with keep-alive GETs from several client processes; requests per
+second are reported per run. Only the health check endpoint is hit, so the
+numbers reflect server and framework overhead, not the database.
+
+    python bench_workers.py [--workers 1 2 4] [--clients 16] [--seconds 10]
+
+Several workers normally need Redis; the benchmark passes
+--skip-layer-check since it never opens a WebSocket.
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not come up")
+
+
+def client(args):
+    port, path, seconds = args
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    done = errors = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                done += 1
+            else:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    return done, errors
+
+
+def measure(workers, clients, seconds, path):
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable, 'start_server.py',
+            '--host', '127.0.0.1',
+            '--port', str(port),
+            '--workers', str(workers),
+            '--skip-layer-check',
+        ],
+        cwd=BASE_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(port)
+        # Every worker has to import the app before it is measured
+        time.sleep(1 + workers)
+        with multiprocessing.Pool(clients) as pool:
+            results = pool.map(client, [(port, path, seconds)] * clients)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(30)
+
+    done = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    return done / seconds, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--path', default='/')
+    args = parser.parse_args()
+
+    print(f"📊 {args.clients} clients, {args.seconds:g}s per run, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8}{'req/s':>12}{'errors':>8}{'scaling':>9}")
+    baseline = None
+    for workers in args.workers:
+        rate, errors = measure(workers, args.clients, args.seconds, args.path)
+        baseline = baseline or rate
+        print(f"{workers:>8}{rate:>12.0f}{errors:>8}{rate / baseline:>8.2f}x")
+
+
+if __name__ == '__main__':
+    main()
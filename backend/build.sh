@@ -1,5 +1,6 @@
 #!/usr/bin/env bash
 # Build script for Render deployment
+set -o errexit
 
 echo "🚀 Starting build process..."
 
@@ -25,6 +26,17 @@ echo "📁 Collecting static files..."
 mkdir -p staticfiles
 python manage.py collectstatic --noinput --clear --verbosity=1 || echo "⚠️  Static files collection completed (no static files to collect)"
 
+# Check that a fresh worker still answers its first request quickly
+echo "⏱️ Checking cold start time..."
+# A crash always fails the build. Going over CHAT_COLD_START_BUDGET_MS (1000 ms,
+# ~774 ms measured) only warns, since build machines vary; set
+# CHAT_COLD_START_STRICT=1 to fail on it too
+if [ "${CHAT_COLD_START_STRICT:-0}" = "1" ]; then
+    python check_cold_start.py --runs 3
+else
+    python check_cold_start.py --runs 3 --warn-only
+fi
+
 # Create superuser if needed (optional)
 # echo "👤 Creating superuser..."
 # python manage.py createsuperuser --noinput
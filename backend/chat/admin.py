@@ -1,17 +1,175 @@
 from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery
 
-from .models import Conversation, Message
+from . import sharding
+from .admin_pagination import EstimatedCountPaginator, KeysetPaginationMixin
+from .models import Conversation, Message, RetentionPolicy
+
+
+def count_subquery(queryset, field):
+    """Correlated COUNT evaluated only for the rows on the page, using the FK index"""
+    return Subquery(
+        queryset.filter(**{field: OuterRef("pk")}).order_by().values(field).annotate(n=Count("*")).values("n"),
+        output_field=IntegerField(),
+    )
+
+
+def message_totals(rows, field):
+    """Messages per row of one page (by ``conversation`` or ``sender``), summed over every shard"""
+    ids = [row.pk for row in rows]
+    totals = {}
+    if not ids:
+        return totals
+    for alias in sharding.databases():
+        counts = (
+            Message.objects.using(alias)
+            .filter(**{f"{field}__in": ids})
+            .order_by()
+            .values_list(field)
+            .annotate(n=Count("*"))
+        )
+        for pk, n in counts:
+            totals[pk] = totals.get(pk, 0) + n
+    return totals
+
+
+class MessageCountMixin:
+    """A ``message_total`` on each listed row: a correlated COUNT on one database,
+    or one grouped query per shard for the page once messages are sharded"""
+
+    message_count_field = None
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if sharding.enabled():
+            return queryset
+        return queryset.annotate(message_total=count_subquery(Message.objects, self.message_count_field))
+
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        if sharding.enabled():
+            # Iterating caches the page, so the totals stay on the rows the template renders
+            rows = list(changelist.result_list)
+            totals = message_totals(rows, self.message_count_field)
+            for row in rows:
+                row.message_total = totals.get(row.pk, 0)
+        return changelist
+
+
+class ShardFilter(admin.SimpleListFilter):
+    """Lists messages from one database at a time, ``default`` unless another is picked"""
+
+    title = "shard"
+    parameter_name = "shard"
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in sharding.databases()] if sharding.enabled() else []
+
+    def alias(self):
+        return self.value() if self.value() in sharding.databases() else DEFAULT_DB_ALIAS
+
+    def choices(self, changelist):
+        for alias, title in self.lookup_choices:
+            yield {
+                "selected": self.alias() == alias,
+                "query_string": changelist.get_query_string({self.parameter_name: alias}),
+                "display": title,
+            }
+
+    def queryset(self, request, queryset):
+        return queryset.using(self.alias())
 
 
 @admin.register(Conversation)
-class ConversationAdmin(admin.ModelAdmin):
-    list_display = ("id", "title", "created_at")
+class ConversationAdmin(MessageCountMixin, admin.ModelAdmin):
+    list_display = ("id", "title", "participant_count", "message_count", "slow_mode_seconds", "created_at")
     search_fields = ("title",)
-    filter_horizontal = ("participants",)
+    autocomplete_fields = ("participants",)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    message_count_field = "conversation"
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            participant_total=count_subquery(Conversation.participants.through.objects, "conversation"),
+        )
+
+    @admin.display(description="participants")
+    def participant_count(self, obj):
+        return obj.participant_total or 0
+
+    @admin.display(description="messages")
+    def message_count(self, obj):
+        return obj.message_total or 0
 
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(KeysetPaginationMixin, admin.ModelAdmin):
     list_display = ("id", "conversation", "sender", "created_at")
-    search_fields = ("content",)
+    # Shows the search box; the lookup itself is get_search_results
+    search_fields = ("sender__username",)
+    search_help_text = "Message id or exact sender username"
     list_select_related = ("conversation", "sender")
+    list_filter = (ShardFilter,)
+    show_facets = admin.ShowFacets.NEVER
+    autocomplete_fields = ("conversation", "sender")
+    raw_id_fields = ("parent", "thread_root")
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if sharding.enabled():
+            # Conversations and senders stay on default, out of reach of a join from a shard
+            queryset = queryset.prefetch_related("conversation", "sender")
+        return queryset
+
+    def get_list_select_related(self, request):
+        return () if sharding.enabled() else self.list_select_related
+
+    def get_object(self, request, object_id, from_field=None):
+        if not sharding.enabled():
+            return super().get_object(request, object_id, from_field)
+        # Change links do not name the shard; ids are unique across all of them
+        field = self.model._meta.pk if from_field is None else self.model._meta.get_field(from_field)
+        try:
+            object_id = field.to_python(object_id)
+        except (ValidationError, ValueError):
+            return None
+        queryset = self.get_queryset(request)
+        for alias in sharding.databases():
+            message = queryset.using(alias).filter(**{field.name: object_id}).first()
+            if message is not None:
+                return message
+        return None
+
+    def delete_model(self, request, obj):
+        using, pk = obj._state.db, obj.pk
+        super().delete_model(request, obj)
+        sharding.delete_attachments(using, [pk])
+
+    def delete_queryset(self, request, queryset):
+        ids = list(queryset.values_list("pk", flat=True))
+        super().delete_queryset(request, queryset)
+        sharding.delete_attachments(queryset.db, ids)
+
+    def get_search_results(self, request, queryset, search_term):
+        # Plain equality on the primary key and the unique username, so both use
+        # their index; the "=" prefix would wrap each side in UPPER() instead.
+        # Senders are looked up first, as they may be on another database
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        senders = get_user_model().objects.filter(username=term).values_list("pk", flat=True)
+        condition = Q(sender_id__in=list(senders))
+        if term.isdigit() and int(term) < 2**63:
+            condition |= Q(pk=int(term))
+        return queryset.filter(condition), False
+
+
+@admin.register(RetentionPolicy)
+class RetentionPolicyAdmin(admin.ModelAdmin):
+    list_display = ("conversation", "keep_days", "action", "updated_at")
+    list_filter = ("action",)
+    raw_id_fields = ("conversation",)
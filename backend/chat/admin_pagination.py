@@ -0,0 +1,89 @@
+"""
+Admin changelists that stay fast on very large tables.
+
+``EstimatedCountPaginator`` replaces ``COUNT(*)`` with PostgreSQL's own
+estimates: ``pg_class.reltuples`` for an unfiltered table, the planner's row
+estimate (``EXPLAIN``) for a filtered one. Small results, and other
+databases, are still counted exactly.
+
+``KeysetPaginationMixin`` pages by primary key (``?before=<id>``) instead of
+OFFSET, so the 1000th page costs the same index seek as the first. It needs
+a fixed ``-pk`` ordering, so column sorting is turned off.
+"""
+
+import json
+
+from django.conf import settings
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+
+CURSOR_VAR = "before"
+
+
+def estimate_count(queryset):
+    """PostgreSQL's estimate of the number of rows ``queryset`` returns"""
+    connection = connections[queryset.db]
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                [connection.ops.quote_name(queryset.model._meta.db_table)],
+            )
+            row = cursor.fetchone()
+            # -1 until the table has been analyzed
+            return max(row[0], 0) if row else 0
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not isinstance(queryset, QuerySet) or connections[queryset.db].vendor != "postgresql":
+            return super().count
+        estimate = estimate_count(queryset)
+        if estimate < getattr(settings, "CHAT_ADMIN_EXACT_COUNT_LIMIT", 10000):
+            return super().count
+        return estimate
+
+
+class KeysetChangeList(ChangeList):
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        super().get_results(request)
+        queryset = self.queryset
+        cursor = request.GET.get(CURSOR_VAR, "")
+        if cursor.isdigit():
+            queryset = queryset.filter(pk__lt=int(cursor))
+
+        rows = list(queryset.order_by("-pk")[: self.list_per_page + 1])
+        self.result_list = rows[: self.list_per_page]
+        self.can_show_all = False
+        self.keyset_next_url = (
+            self.get_query_string({CURSOR_VAR: self.result_list[-1].pk}) if len(rows) > self.list_per_page else None
+        )
+        self.keyset_first_url = self.get_query_string(remove=[CURSOR_VAR]) if cursor else None
+
+
+class KeysetPaginationMixin:
+    """ModelAdmin mixin for keyset pages; pair with an ``admin/<app>/<model>/pagination.html``"""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    sortable_by = ()
+    ordering = ("-pk",)
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
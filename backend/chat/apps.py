@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "chat"
+
+    def ready(self):
+        from config import profiling  # noqa: F401 - times queries in spans
+
+        from . import sharding, versions  # noqa: F401 - register their signals
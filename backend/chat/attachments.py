@@ -0,0 +1,209 @@
+import hashlib
+import os
+import re
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.module_loading import import_string
+
+from .models import Attachment, StoredFile, UploadSession
+
+COPY_BLOCK_SIZE = 64 * 1024
+
+
+class UploadOffsetMismatch(Exception):
+    """The client sent a chunk for a different offset than the server has stored"""
+
+    def __init__(self, expected):
+        super().__init__(f"Expected offset {expected}")
+        self.expected = expected
+
+
+class LocalAttachmentStorage:
+    """Keeps partial uploads and content-addressed blobs under one directory.
+
+    Blobs live at ``blobs/ab/cd/<sha256>``, so identical files share one copy.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or getattr(settings, "CHAT_ATTACHMENT_ROOT")
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def partial_name(self, session_id):
+        return os.path.join("partial", f"{session_id}.part")
+
+    def blob_name(self, sha256):
+        return os.path.join("blobs", sha256[:2], sha256[2:4], sha256)
+
+    def append(self, session_id, offset, stream, limit):
+        """Write at most ``limit`` bytes from ``stream`` at ``offset``; returns the new offset"""
+        path = self.path(self.partial_name(session_id))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "r+b" if os.path.exists(path) else "wb") as handle:
+            handle.seek(offset)
+            handle.truncate()
+            remaining = limit
+            while remaining > 0:
+                chunk = stream.read(min(COPY_BLOCK_SIZE, remaining))
+                if not chunk:
+                    break
+                handle.write(chunk)
+                remaining -= len(chunk)
+            return handle.tell()
+
+    def finalize(self, session_id):
+        """Hash a finished upload and move it into blob storage.
+
+        Returns ``(sha256, size, name)``. When the blob already exists the
+        partial file is dropped instead of stored twice.
+        """
+        partial = self.path(self.partial_name(session_id))
+        digest = hashlib.sha256()
+        size = 0
+        with open(partial, "rb") as handle:
+            for chunk in iter(lambda: handle.read(COPY_BLOCK_SIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+
+        name = self.blob_name(sha256)
+        target = self.path(name)
+        if os.path.exists(target):
+            os.remove(partial)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(partial, target)
+        return sha256, size, name
+
+    def discard_partial(self, session_id):
+        try:
+            os.remove(self.path(self.partial_name(session_id)))
+        except FileNotFoundError:
+            pass
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+
+def get_storage():
+    backend = getattr(settings, "CHAT_ATTACHMENT_STORAGE", "chat.attachments.LocalAttachmentStorage")
+    return import_string(backend)()
+
+
+def append_chunk(session, offset, stream, length):
+    """Store the next chunk of an upload and complete it once all bytes are in.
+
+    Returns the ``Attachment`` when the upload finished with this chunk,
+    otherwise ``None``; chunks for an already finished upload are ignored.
+    """
+    storage = get_storage()
+    with transaction.atomic():
+        # The row lock is held while the chunk is written and the upload is
+        # finalized, so a concurrent or retried chunk waits and is then
+        # refused instead of interleaving its writes or finalizing twice
+        received, attachment_id = (
+            UploadSession.objects.select_for_update()
+            .values_list("received", "attachment_id")
+            .get(pk=session.pk)
+        )
+        session.received, session.attachment_id = received, attachment_id
+        if attachment_id is not None:
+            return None
+        if offset != received:
+            raise UploadOffsetMismatch(received)
+
+        length = min(length, session.size - offset)
+        received = storage.append(session.id, offset, stream, length)
+        UploadSession.objects.filter(pk=session.pk).update(received=received)
+        session.received = received
+
+        if received < session.size:
+            return None
+        return complete_upload(session, storage)
+
+
+def complete_upload(session, storage=None):
+    storage = storage or get_storage()
+    sha256, size, name = storage.finalize(session.id)
+    try:
+        blob, _ = StoredFile.objects.get_or_create(sha256=sha256, defaults={"size": size, "name": name})
+    except IntegrityError:
+        blob = StoredFile.objects.get(sha256=sha256)
+
+    with transaction.atomic():
+        attachment = Attachment.objects.create(
+            conversation_id=session.conversation_id,
+            uploader_id=session.uploader_id,
+            blob=blob,
+            filename=session.filename,
+            content_type=session.content_type,
+        )
+        session.attachment = attachment
+        session.save(update_fields=["attachment"])
+    return attachment
+
+
+def link_attachments(message, attachment_ids):
+    """Attach the sender's finished, unused uploads in the same conversation to a message"""
+    if not attachment_ids:
+        return []
+    Attachment.objects.filter(
+        pk__in=attachment_ids,
+        uploader_id=message.sender_id,
+        conversation_id=message.conversation_id,
+        message__isnull=True,
+    ).update(message=message)
+    return list(message.attachments.select_related("blob"))
+
+
+def attachment_metadata(attachment):
+    """Small description of an attachment for socket events; never the payload"""
+    return {
+        'id': attachment.id,
+        'filename': attachment.filename,
+        'content_type': attachment.content_type,
+        'size': attachment.blob.size,
+    }
+
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, size):
+    """Parse a single-range ``Range`` header into ``(start, end)`` inclusive.
+
+    Returns ``None`` when the header is absent or not a single byte range, and
+    raises ``ValueError`` when the range cannot be satisfied.
+    """
+    match = _RANGE_RE.match(header or "")
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def file_range(path, start, end, block_size=COPY_BLOCK_SIZE):
+    """Yield bytes ``start``..``end`` (inclusive) of a file without reading it whole"""
+    with open(path, "rb") as handle:
+        handle.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = handle.read(min(block_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
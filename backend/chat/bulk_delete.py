@@ -0,0 +1,262 @@
+"""
+Set-based bulk deletion that avoids Django's deletion collector.
+
+``QuerySet.delete()`` loads every related row into memory to run cascades in
+Python. ``BulkDeleter`` walks the same relations from model metadata, but
+deletes children before parents with plain ``DELETE ... WHERE pk IN (...)``
+statements over bounded keyset batches. Whole-table wipes on PostgreSQL use a
+single ``TRUNCATE`` when every table involved is covered by the cascade.
+
+Signals (``pre_delete``/``post_delete``) are not sent, and denormalized
+counters on surviving rows (a thread root's ``reply_count``, ``ReactionCount``)
+are not adjusted. Call ``rebuild_counters`` after deleting rows that feed them.
+"""
+
+import json
+import time
+from dataclasses import dataclass, field
+
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.deletion import get_candidate_relations_to_delete
+
+
+@dataclass
+class DeleteStep:
+    """One table to clear: either delete the matching rows or null out a foreign key"""
+
+    queryset: models.QuerySet
+    whole_table: bool = False
+    set_null: list = field(default_factory=list)
+
+    @property
+    def label(self):
+        return self.queryset.model._meta.label
+
+
+class BulkDeleter:
+    def __init__(self, using=DEFAULT_DB_ALIAS, batch_size=5000, pause=0.0, progress=None):
+        self.using = using
+        self.batch_size = batch_size
+        self.pause = pause
+        self.progress = progress
+
+    # Planning
+
+    def plan(self, queryset, whole_table=False):
+        """Return the steps needed to delete ``queryset``, children first"""
+        steps = []
+        self._collect(queryset.using(self.using), whole_table, steps, path=())
+        return steps
+
+    def _collect(self, queryset, whole_table, steps, path):
+        model = queryset.model._meta.concrete_model
+        if model in path:
+            raise ValueError(f"Cyclic cascade through {model._meta.label} is not supported")
+
+        for relation in get_candidate_relations_to_delete(model._meta):
+            fk = relation.field
+            on_delete = fk.remote_field.on_delete
+            related = relation.related_model._base_manager.using(self.using)
+            if whole_table:
+                children = related.filter(**{f"{fk.name}__isnull": False})
+            else:
+                children = related.filter(**{f"{fk.name}__in": queryset.values(fk.target_field.attname)})
+
+            if on_delete is models.CASCADE:
+                self._collect(children, whole_table, steps, path + (model,))
+            elif on_delete is models.SET_NULL:
+                steps.append(DeleteStep(children, whole_table, set_null=[fk.attname]))
+            elif on_delete in (models.PROTECT, models.RESTRICT):
+                if children.exists():
+                    raise models.ProtectedError(
+                        f"Cannot delete {model._meta.label}: referenced by {relation.related_model._meta.label}",
+                        set(),
+                    )
+            elif on_delete is models.DO_NOTHING:
+                continue
+            else:
+                raise ValueError(f"Unsupported on_delete for {fk} in bulk deletion")
+
+        steps.append(DeleteStep(queryset, whole_table))
+
+    # Estimates
+
+    def estimate(self, step):
+        """Row count estimate, taken from planner statistics on PostgreSQL"""
+        connection = connections[self.using]
+        if connection.vendor != "postgresql":
+            return step.queryset.count()
+
+        with connection.cursor() as cursor:
+            if step.whole_table and not step.set_null:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                    [step.queryset.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+                if row and row[0] >= 0:
+                    return row[0]
+            sql, params = step.queryset.values("pk").query.sql_with_params()
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]["Plan"]["Plan Rows"])
+
+    def plan_all(self, querysets, whole_table=False):
+        """Plan several querysets; whole-table steps reached twice are only kept once"""
+        steps = []
+        seen = set()
+        for queryset in querysets:
+            for step in self.plan(queryset, whole_table):
+                key = (step.label, tuple(step.set_null))
+                if whole_table and key in seen:
+                    continue
+                seen.add(key)
+                steps.append(step)
+        return steps
+
+    def dry_run(self, querysets, whole_table=False):
+        """Return ``[(label, action, estimated_rows)]`` without touching any data"""
+        return [
+            (step.label, "set null" if step.set_null else "delete", self.estimate(step))
+            for step in self.plan_all(querysets, whole_table)
+        ]
+
+    # Execution
+
+    def delete(self, querysets, whole_table=False):
+        """Delete every queryset (and its cascade) in bounded batches.
+
+        Returns ``{model_label: rows_affected}``.
+        """
+        totals = {}
+        for step in self.plan_all(querysets, whole_table):
+            totals[step.label] = totals.get(step.label, 0) + self._run(step)
+        return totals
+
+    def wipe(self, model_classes):
+        """Empty whole tables, using TRUNCATE when the database and cascade allow it.
+
+        Returns ``({model_label: rows}, estimated)``. TRUNCATE reports no row
+        counts, so with ``estimated`` True the numbers are planner estimates.
+        """
+        steps = self.plan_all([model._base_manager.all() for model in model_classes], whole_table=True)
+
+        # Nulling a reference inside a table that is emptied anyway (e.g. a
+        # self-referencing foreign key) does not stand in the way of TRUNCATE
+        emptied = {step.label for step in steps if not step.set_null}
+        connection = connections[self.using]
+        if connection.vendor == "postgresql" and all(step.label in emptied for step in steps if step.set_null):
+            steps = [step for step in steps if not step.set_null]
+            estimates = {step.label: self.estimate(step) for step in steps}
+            tables = [connection.ops.quote_name(step.queryset.model._meta.db_table) for step in steps]
+            with transaction.atomic(using=self.using), connection.cursor() as cursor:
+                cursor.execute(f"TRUNCATE {', '.join(tables)}")
+            for label, estimate in estimates.items():
+                self._report(label, estimate, estimate)
+            return estimates, True
+
+        totals = {}
+        for step in steps:
+            totals[step.label] = totals.get(step.label, 0) + self._run(step)
+        return totals, False
+
+    def _run(self, step):
+        model = step.queryset.model
+        connection = connections[self.using]
+        table = connection.ops.quote_name(model._meta.db_table)
+        pk_column = connection.ops.quote_name(model._meta.pk.column)
+        estimate = self.estimate(step) if self.progress else None
+
+        done = 0
+        last_pk = None
+        rows = step.queryset.order_by("pk")
+        while True:
+            batch = rows if last_pk is None else rows.filter(pk__gt=last_pk)
+            pks = list(batch.values_list("pk", flat=True)[: self.batch_size])
+            if not pks:
+                break
+
+            placeholders = ", ".join(["%s"] * len(pks))
+            if step.set_null:
+                assignments = ", ".join(f"{connection.ops.quote_name(column)} = NULL" for column in step.set_null)
+                sql = f"UPDATE {table} SET {assignments} WHERE {pk_column} IN ({placeholders})"
+            else:
+                sql = f"DELETE FROM {table} WHERE {pk_column} IN ({placeholders})"
+            with transaction.atomic(using=self.using), connection.cursor() as cursor:
+                cursor.execute(sql, pks)
+                done += cursor.rowcount
+
+            last_pk = pks[-1]
+            self._report(step.label, done, estimate)
+            if self.pause:
+                time.sleep(self.pause)
+        return done
+
+    def _report(self, label, done, estimate):
+        if self.progress:
+            self.progress(label, done, estimate)
+
+
+def rebuild_counters(using=DEFAULT_DB_ALIAS, message_ids=None, batch_size=1000):
+    """Recount reply summaries and reaction totals from the rows that are left.
+
+    With ``message_ids`` only those messages are recounted, ``batch_size`` at a
+    time; otherwise every message on ``using`` is.
+    """
+    if message_ids is None:
+        _recount(using, Q(reply_count__gt=0), Q())
+        return
+    message_ids = list(message_ids)
+    for start in range(0, len(message_ids), batch_size):
+        batch = message_ids[start:start + batch_size]
+        _recount(using, Q(pk__in=batch), Q(message_id__in=batch))
+
+
+def _recount(using, roots, reacted):
+    from .models import Message, Reaction, ReactionCount
+
+    replies = Message.objects.using(using).filter(thread_root_id=OuterRef("pk"))
+    Message.objects.using(using).filter(roots).update(
+        reply_count=Coalesce(
+            Subquery(replies.order_by().values("thread_root_id").annotate(total=Count("pk")).values("total")), 0
+        ),
+        last_reply_at=Subquery(replies.order_by("-created_at").values("created_at")[:1]),
+    )
+
+    totals = Reaction.objects.using(using).filter(reacted).values("message_id", "emoji").annotate(total=Count("pk"))
+    with transaction.atomic(using=using):
+        ReactionCount.objects.using(using).filter(reacted).delete()
+        ReactionCount.objects.using(using).bulk_create(
+            (
+                ReactionCount(message_id=row["message_id"], emoji=row["emoji"], count=row["total"])
+                for row in totals.iterator()
+            ),
+            batch_size=1000,
+        )
+
+
+def counted_messages(user_ids, using=DEFAULT_DB_ALIAS):
+    """Ids of the messages whose reply or reaction counters include rows of ``user_ids``"""
+    from .models import Message, Reaction
+
+    roots = Message.objects.using(using).filter(sender_id__in=user_ids, thread_root__isnull=False)
+    reacted = Reaction.objects.using(using).filter(user_id__in=user_ids)
+    return set(roots.values_list("thread_root_id", flat=True).iterator()) | set(
+        reacted.values_list("message_id", flat=True).iterator()
+    )
+
+
+def user_querysets(user_ids):
+    """Everything that has to go when users are removed, including archived copies of their messages"""
+    from django.contrib.auth import get_user_model
+    from .models import ArchivedMessage
+
+    User = get_user_model()
+    return [
+        ArchivedMessage.objects.filter(sender_id__in=user_ids),
+        User._base_manager.filter(pk__in=user_ids),
+    ]
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import threading
+import time
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+class CoalescingBuffer:
+    """Thread-safe keyed buffer that merges repeated updates until drained.
+
+    Subclasses implement ``merge`` to fold a new update into the pending one
+    for the same key, so a burst of updates costs a single write on flush.
+    """
+
+    def __init__(self, flush_interval=1.0, max_pending=500):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._flush_handle = None
+        self._flush_task = None
+
+    def merge(self, current, update):
+        raise NotImplementedError
+
+    def add(self, key, update):
+        with self._lock:
+            current = self._pending.get(key)
+            self._pending[key] = update if current is None else self.merge(current, update)
+
+    def due(self):
+        """True when the buffer is full or its oldest update has waited long enough"""
+        with self._lock:
+            if not self._pending:
+                return False
+            if len(self._pending) >= self.max_pending:
+                return True
+            return time.monotonic() - self._last_flush >= self.flush_interval
+
+    def drain(self):
+        """Take every pending update, leaving the buffer empty"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        return pending
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    async def maybe_flush(self, flush):
+        """Await ``flush()`` now if due, otherwise make sure a timed flush is pending"""
+        if self.due():
+            await flush()
+            return
+
+        if self._flush_handle is not None or not len(self):
+            return
+
+        loop = asyncio.get_running_loop()
+
+        def _fire():
+            self._flush_handle = None
+            # Kept so the task is not collected mid-flush and its failure gets logged
+            self._flush_task = loop.create_task(flush())
+            self._flush_task.add_done_callback(self._flushed)
+
+        self._flush_handle = loop.call_later(self.flush_interval, _fire)
+
+    def _flushed(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Timed flush of {type(self).__name__} failed", exc_info=task.exception())
+
+    def maybe_flush_sync(self, flush):
+        """``maybe_flush`` for synchronous code: call ``flush()`` now if due, otherwise on a timer thread"""
+        if self.due():
+            flush()
+            return
+
+        with self._lock:
+            if self._flush_handle is not None or not self._pending:
+                return
+            timer = threading.Timer(self.flush_interval, self._fire_sync, [flush])
+            timer.daemon = True
+            self._flush_handle = timer
+        timer.start()
+
+    def _fire_sync(self, flush):
+        self._flush_handle = None
+        try:
+            flush()
+        except Exception:
+            logger.exception(f"Timed flush of {type(self).__name__} failed")
+        finally:
+            # The timer thread ends here; do not leave its connections open
+            connections.close_all()
@@ -0,0 +1,126 @@
+"""
+Wire formats for ChatConsumer, negotiated through ``Sec-WebSocket-Protocol``.
+
+JSON text frames stay the default. Clients that offer ``chat.msgpack.v1`` get
+binary MessagePack frames where top-level field names are replaced by their
+index in ``FIELDS``, so repeated keys such as ``display_name`` cost one byte.
+Nested values (attachments, cursors, reaction counts) keep their string keys.
+
+``FIELDS`` is append-only: a field's index is part of the v1 protocol.
+"""
+
+import json
+
+from django.conf import settings
+
+from config.profiling import span
+
+from .protocol import FrameError
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack ships with channels-redis
+    msgpack = None
+
+FIELDS = [
+    'type',
+    'message',
+    'user_id',
+    'username',
+    'display_name',
+    'message_id',
+    'timestamp',
+    'client_msg_id',
+    'parent_id',
+    'thread_root_id',
+    'attachments',
+    'typing',
+    'version',
+    'edited_at',
+    'deleted_at',
+    'cursors',
+    'messages',
+    'code',
+    'detail',
+    'retry_after',
+    'duplicate',
+    'attachment',
+    'attachment_ids',
+    'up_to',
+    'emoji',
+    'add',
+    'reason',
+    'last_message_id',
+    'delay_ms',
+    'resume_token',
+]
+FIELD_IDS = {name: index for index, name in enumerate(FIELDS)}
+
+
+def _check_size(length):
+    max_bytes = getattr(settings, "CHAT_WS_MAX_FRAME_BYTES", 64 * 1024)
+    if length > max_bytes:
+        raise FrameError('frame_too_large', f'Frames are limited to {max_bytes} bytes')
+
+
+class JsonCodec:
+    subprotocol = None
+
+    def encode(self, frame):
+        with span('encode'):
+            return json.dumps(frame)
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            raise FrameError('invalid_frame', 'Expected a JSON text frame')
+        # A str needs at least one byte per character, so check before encoding
+        _check_size(len(text_data))
+        _check_size(len(text_data.encode()))
+        try:
+            frame = json.loads(text_data)
+        except ValueError:
+            raise FrameError('invalid_json', 'Frame is not valid JSON')
+        if not isinstance(frame, dict):
+            raise FrameError('invalid_frame', 'Frame must be a JSON object')
+        return frame
+
+
+class MsgpackCodec:
+    subprotocol = 'chat.msgpack.v1'
+
+    def encode(self, frame):
+        with span('encode'):
+            return msgpack.packb({FIELD_IDS.get(key, key): value for key, value in frame.items()})
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise FrameError('invalid_frame', 'Expected a binary MessagePack frame')
+        _check_size(len(bytes_data))
+        try:
+            packed = msgpack.unpackb(bytes_data, strict_map_key=False)
+        # TypeError: a map key that cannot be a dict key, e.g. an array
+        except (TypeError, ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError):
+            raise FrameError('invalid_frame', 'Frame is not valid MessagePack')
+        if not isinstance(packed, dict):
+            raise FrameError('invalid_frame', 'Frame must be a map')
+        frame = {}
+        for key, value in packed.items():
+            if not isinstance(key, str):
+                if not isinstance(key, int) or not 0 <= key < len(FIELDS):
+                    raise FrameError('invalid_frame', f'Unknown field id {key!r}')
+                key = FIELDS[key]
+            frame[key] = value
+        return frame
+
+
+CODECS = [MsgpackCodec()] if msgpack is not None else []
+DEFAULT_CODEC = JsonCodec()
+
+
+def negotiate(offered):
+    """Pick the first codec the client offered that we support, else JSON"""
+    for subprotocol in offered or ():
+        for codec in CODECS:
+            if codec.subprotocol == subprotocol:
+                return codec
+    return DEFAULT_CODEC
@@ -1,17 +1,33 @@
-import json
+import asyncio
+import logging
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from .models import Conversation, Message
+from urllib.parse import parse_qs
+
+from . import drain, metrics, notifications, outbox, ratelimit, reactions, receipts, sharding
+from .outbound import OutboundQueue
+from .codecs import negotiate
+from .protocol import FrameError, validate_frame
+from .services import MessageConflict, create_message, delete_message, edit_message, recent_send
 from django.core.exceptions import ObjectDoesNotExist
+from config import db_router, profiling
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    presence_refresh_interval = getattr(settings, 'CHAT_PRESENCE_TTL', 300) / 3
+
     async def connect(self):
         self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
         self.room_group_name = f'chat_{self.conversation_id}'
+        # The profiling header on the handshake profiles every event of the socket
+        self.profiled = profiling.authorized(dict(self.scope.get('headers', [])).get(b'x-chat-profile'))
 
         # Get user from scope (set by middleware)
         self.user = self.scope.get('user')
@@ -20,33 +36,73 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
+        # Socket reads stay on the primary; writes pin the user there for REST reads
+        db_router.begin(self.user.id, replica_reads=False)
+        # Message tables of this socket's conversation, wherever its shard is
+        sharding.begin(self.conversation_id)
+
+        # A resume token from a drained worker is spent here; membership is still
+        # checked because it may have been revoked since the token was issued
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        resumed = 'resume' in query and drain.read_resume_token(
+            query['resume'][0], self.user.id, self.conversation_id
+        ) is not None
+
         # Check if user is participant of this conversation
         if not await self.is_participant():
             print(f"WebSocket connection rejected: user {self.user.username} not participant of conversation {self.conversation_id}")
             await self.close()
             return
 
+        # Group events go through a bounded queue drained by a writer task
+        self.outbound = OutboundQueue(self.send, on_evict=self.evict)
+        self.outbound.start()
+        metrics.register(f'ws:{self.channel_name}', lambda: {
+            'user_id': self.user.id,
+            'conversation_id': self.conversation_id,
+            **self.outbound.stats(),
+        })
+
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
 
-        await self.accept()
-        print(f"WebSocket connected: user {self.user.username} to conversation {self.conversation_id}")
+        # JSON unless the client offered a binary subprotocol we support
+        self.codec = negotiate(self.scope.get('subprotocols'))
+        await self.accept(subprotocol=self.codec.subprotocol)
+        drain.connections.add(self)
+        # Participants with a live socket get no offline notifications
+        await database_sync_to_async(notifications.connected)(self.conversation_id, self.user.id)
+        # Refreshed on a timer, so a participant who only reads still counts as online
+        self.presence_task = asyncio.create_task(self.keep_presence())
+        print(f"WebSocket {'resumed' if resumed else 'connected'}: user {self.user.username} to conversation {self.conversation_id}")
 
         # Send user joined message
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_join',
-                'user_id': self.user.id,
-                'username': self.user.username,
-                'display_name': getattr(self.user, 'display_name', self.user.username),
-            }
-        )
+        with profiling.span('group_send'):
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    'type': 'user_join',
+                    'user_id': self.user.id,
+                    'username': self.user.username,
+                    'display_name': getattr(self.user, 'display_name', self.user.username),
+                }
+            )
 
     async def disconnect(self, close_code):
+        drain.connections.discard(self)
+        if hasattr(self, 'outbound'):
+            self.outbound.close()
+            metrics.unregister(f'ws:{self.channel_name}')
+        if hasattr(self, 'presence_task'):
+            self.presence_task.cancel()
+            await database_sync_to_async(notifications.disconnected)(self.conversation_id, self.user.id)
+
+        # Buffered read cursors and reaction counts are left to their timed
+        # flush, which every update schedules; draining flushes them on shutdown
+
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
@@ -55,55 +111,171 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         # Send user left message
         if hasattr(self, 'user') and self.user and not self.user.is_anonymous:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_leave',
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'display_name': getattr(self.user, 'display_name', self.user.username),
-                }
-            )
+            with profiling.span('group_send'):
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    {
+                        'type': 'user_leave',
+                        'user_id': self.user.id,
+                        'username': self.user.username,
+                        'display_name': getattr(self.user, 'display_name', self.user.username),
+                    }
+                )
+
+    async def websocket_receive(self, message):
+        with profiling.maybe_profile(f'ws-{self.conversation_id}', forced=getattr(self, 'profiled', False)):
+            try:
+                await super().websocket_receive(message)
+            except sharding.ShardMoving as e:
+                self.send_error('moving', str(e.detail), retry_after=e.wait)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            text_data_json = validate_frame(self.codec.decode(text_data, bytes_data))
+        except FrameError as e:
+            if e.code != 'frame_too_large':
+                self.send_error(e.code, e.detail)
+                return
+            # Sent past the queue since the connection is closed right away
+            await self.send_frame({'type': 'error', 'code': e.code, 'detail': e.detail})
+            await self.close(code=1009)
+            return
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message_type = text_data_json.get('type', 'message')
-        
+        # Every frame takes a token from the sender's bucket, shared by all workers
+        retry_after = await database_sync_to_async(ratelimit.user_frames.hit)(self.user.id)
+        if retry_after:
+            self.send_error('rate_limited', 'Too many frames', retry_after=round(retry_after, 2))
+            return
+
+        message_type = text_data_json['type']
         if message_type == 'message':
             message = text_data_json['message']
-            
-            # Save message to database
-            saved_message = await self.save_message(message)
-            
-            # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'display_name': getattr(self.user, 'display_name', self.user.username),
-                    'message_id': saved_message.id,
-                    'timestamp': saved_message.created_at.isoformat(),
-                }
-            )
+            attachment_ids = text_data_json.get('attachment_ids') or []
+            client_msg_id = text_data_json.get('client_msg_id')
+            parent_id = text_data_json.get('parent_id')
+
+            # A retried send is acknowledged from the cache without touching the DB
+            if client_msg_id:
+                seen = await database_sync_to_async(recent_send)(self.conversation_id, self.user.id, client_msg_id)
+                if seen is not None:
+                    await self.send_ack(client_msg_id, seen['message_id'], seen['timestamp'], duplicate=True)
+                    return
+
+            try:
+                await database_sync_to_async(ratelimit.check_message)(self.conversation_id, self.user.id)
+            except ratelimit.SendRejected as e:
+                self.send_error(e.code, 'Message not sent', retry_after=round(e.retry_after, 2), client_msg_id=client_msg_id)
+                return
+
+            # Save message and its outbox event, then publish to the room group
+            saved_message, created = await self.save_message(message, attachment_ids, client_msg_id, parent_id)
+            if created:
+                await outbox.kick(self.channel_layer, self.conversation_id)
+            if client_msg_id:
+                await self.send_ack(
+                    client_msg_id,
+                    saved_message.id,
+                    saved_message.created_at.isoformat(),
+                    duplicate=not created,
+                )
         elif message_type == 'typing':
             is_typing = text_data_json.get('typing', False)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_typing',
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'display_name': getattr(self.user, 'display_name', self.user.username),
-                    'typing': is_typing,
-                }
-            )
+            with profiling.span('group_send'):
+                await self.channel_layer.group_send(
+                    self.room_group_name,
+                    {
+                        'type': 'user_typing',
+                        'user_id': self.user.id,
+                        'username': self.user.username,
+                        'display_name': getattr(self.user, 'display_name', self.user.username),
+                        'typing': is_typing,
+                    }
+                )
+        elif message_type in ('edit', 'delete'):
+            message_id = text_data_json['message_id']
+            version = text_data_json.get('version')
+            if message_type == 'edit':
+                changed = await self.change_message(edit_message, message_id, text_data_json['message'], version)
+            else:
+                changed = await self.change_message(delete_message, message_id, version)
+            if changed:
+                await outbox.kick(self.channel_layer, self.conversation_id)
+            else:
+                self.send_error(
+                    'conflict',
+                    'Message not found, not yours, deleted or changed since that version',
+                    message_id=message_id,
+                )
+        elif message_type in ('read', 'delivered'):
+            up_to = text_data_json['up_to']
+            # Ids up to the newest message delivered on this socket are known to
+            # exist; anything beyond is checked as the REST endpoint does, so a
+            # made-up id cannot push the cursor past every future message
+            if up_to > getattr(self, 'last_message_id', 0) and not await self.message_exists(up_to):
+                self.send_error('unknown_message', 'Unknown message', up_to=up_to)
+                return
+            if message_type == 'read':
+                receipts.record(self.conversation_id, self.user.id, read_up_to=up_to)
+            else:
+                receipts.record(self.conversation_id, self.user.id, delivered_up_to=up_to)
+            await receipts.maybe_flush(self.channel_layer)
+        elif message_type == 'react':
+            # The toggle is stored now; counts go out in coalesced batches
+            emoji = text_data_json['emoji'].strip()
+            if await self.react(text_data_json['message_id'], emoji, text_data_json.get('add', True)):
+                await reactions.maybe_flush(self.channel_layer)
+
+    def enqueue(self, frame, ephemeral=False):
+        """Queue a frame for the writer task; ephemeral frames are shed first under load"""
+        message_id = frame.get('message_id') if frame['type'] == 'message' else None
+        if message_id is not None:
+            self.last_message_id = message_id
+        self.outbound.put(self.codec.encode(frame), ephemeral=ephemeral, message_id=message_id)
+
+    async def keep_presence(self):
+        while True:
+            await asyncio.sleep(self.presence_refresh_interval)
+            try:
+                await database_sync_to_async(notifications.refresh)(self.conversation_id, self.user.id)
+            except Exception:
+                # A cache outage must not end the heartbeat for the life of the socket
+                logger.exception('Presence refresh failed')
+
+    async def drain_close(self, delay):
+        # The worker is shutting down: ask the client to come back after a random delay
+        self.enqueue({
+            'type': 'reconnect',
+            'delay_ms': int(delay * 1000),
+            'resume_token': drain.resume_token(
+                self.user.id, self.conversation_id, getattr(self, 'last_message_id', None)
+            ),
+        })
+        await self.outbound.wait_empty(timeout=5)
+        await self.close(code=1012)
+
+    async def send_frame(self, frame):
+        """Send a frame right away, bypassing the outbound queue"""
+        data = self.codec.encode(frame)
+        if isinstance(data, bytes):
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    def send_error(self, code, detail, **extra):
+        self.enqueue({'type': 'error', 'code': code, 'detail': detail, **extra})
+
+    async def evict(self, last_message_id):
+        # The client fell too far behind: tell it to reload history, then drop it
+        await self.send_frame({
+            'type': 'resync',
+            'reason': 'slow_consumer',
+            'last_message_id': last_message_id,
+        })
+        await self.close(code=4008)
 
     async def chat_message(self, event):
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        self.enqueue({
             'type': 'message',
             'message': event['message'],
             'user_id': event['user_id'],
@@ -111,35 +283,90 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'display_name': event['display_name'],
             'message_id': event['message_id'],
             'timestamp': event['timestamp'],
-        }))
+            'client_msg_id': event.get('client_msg_id'),
+            'parent_id': event.get('parent_id'),
+            'thread_root_id': event.get('thread_root_id'),
+            'attachments': event.get('attachments', []),
+        })
+
+    async def send_ack(self, client_msg_id, message_id, timestamp, duplicate=False):
+        # Confirm a send to its author only
+        self.enqueue({
+            'type': 'ack',
+            'client_msg_id': client_msg_id,
+            'message_id': message_id,
+            'timestamp': timestamp,
+            'duplicate': duplicate,
+        })
 
     async def user_join(self, event):
         # Send user joined notification
-        await self.send(text_data=json.dumps({
+        self.enqueue({
             'type': 'user_join',
             'user_id': event['user_id'],
             'username': event['username'],
             'display_name': event['display_name'],
-        }))
+        }, ephemeral=True)
 
     async def user_leave(self, event):
         # Send user left notification
-        await self.send(text_data=json.dumps({
+        self.enqueue({
             'type': 'user_leave',
             'user_id': event['user_id'],
             'username': event['username'],
             'display_name': event['display_name'],
-        }))
+        }, ephemeral=True)
 
     async def user_typing(self, event):
         # Send typing indicator
-        await self.send(text_data=json.dumps({
+        self.enqueue({
             'type': 'typing',
             'user_id': event['user_id'],
             'username': event['username'],
             'display_name': event['display_name'],
             'typing': event['typing'],
-        }))
+        }, ephemeral=True)
+
+    async def message_update(self, event):
+        # Send an edit as a delta; clients apply it if version is newer
+        self.enqueue({
+            'type': 'message_update',
+            'message_id': event['message_id'],
+            'version': event['version'],
+            'message': event['message'],
+            'edited_at': event['edited_at'],
+        })
+
+    async def message_delete(self, event):
+        # Send a delete tombstone
+        self.enqueue({
+            'type': 'message_delete',
+            'message_id': event['message_id'],
+            'version': event['version'],
+            'deleted_at': event['deleted_at'],
+        })
+
+    async def attachment_uploaded(self, event):
+        # Send attachment metadata; the file itself is fetched over HTTP
+        self.enqueue({
+            'type': 'attachment',
+            'user_id': event['user_id'],
+            'attachment': event['attachment'],
+        })
+
+    async def read_receipt(self, event):
+        # Send aggregated "read up to" cursors
+        self.enqueue({
+            'type': 'read',
+            'cursors': event['cursors'],
+        })
+
+    async def reaction_counts(self, event):
+        # Send current reaction totals for messages that changed
+        self.enqueue({
+            'type': 'reactions',
+            'messages': event['messages'],
+        })
 
 
 
@@ -153,11 +380,37 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return False
 
     @database_sync_to_async
-    def save_message(self, content):
-        """Save message to database"""
+    def save_message(self, content, attachment_ids=None, client_msg_id=None, parent_id=None):
+        """Save message to database through the shared write path"""
         conversation = Conversation.objects.get(id=self.conversation_id)
-        return Message.objects.create(
-            conversation=conversation,
-            sender=self.user,
-            content=content
-        ) 
\ No newline at end of file
+        # Replies may only point at messages in the same conversation
+        parent = Message.objects.filter(pk=parent_id, conversation=conversation).first() if parent_id else None
+        return create_message(conversation, self.user, content, attachment_ids, client_msg_id, parent)
+
+    @database_sync_to_async
+    def message_exists(self, message_id):
+        return Message.objects.filter(pk=message_id, conversation_id=self.conversation_id).exists()
+
+    @database_sync_to_async
+    def change_message(self, change, message_id, *args):
+        """Edit or delete one of the user's messages in this conversation"""
+        message = Message.objects.filter(
+            pk=message_id, conversation_id=self.conversation_id, sender=self.user
+        ).first()
+        if message is None:
+            return False
+        try:
+            change(message, self.user, *args)
+        except MessageConflict:
+            return False
+        return True
+
+    @database_sync_to_async
+    def react(self, message_id, emoji, add):
+        """Add or remove the user's reaction on a live message in this conversation"""
+        message = Message.objects.filter(
+            pk=message_id, conversation_id=self.conversation_id, deleted_at__isnull=True
+        ).first()
+        if message is None:
+            return False
+        return reactions.set_reaction(message, self.user, emoji, add)
@@ -0,0 +1,171 @@
+"""
+Graceful connection draining for deploys.
+
+Draining a worker (SIGUSR1, or ``manage.py drain_connections``):
+
+1. new sockets are refused before authentication;
+2. connected clients are closed in waves, each first sent a ``reconnect``
+   frame with a random delay and a signed resume token, so reconnects spread
+   out over ``CHAT_RECONNECT_MAX_DELAY`` seconds instead of arriving at once;
+3. buffered read receipts, reaction counts, outbox events and notification
+   digests are flushed;
+4. the worker then stops itself with SIGTERM, or, when asked to stay up,
+   accepts new sockets again.
+
+A resume token tells the reconnecting client the last message it received, so
+it can fetch only what it missed. Tokens are single-use and do not replace the
+participant check.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import random
+import secrets
+import signal
+import weakref
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CONTROL_GROUP = 'chat_control'
+RESUME_SALT = 'chat.resume'
+
+connections = weakref.WeakSet()
+draining = False
+_installed = False
+_task = None
+
+
+def resume_token(user_id, conversation_id, last_message_id):
+    return signing.dumps(
+        {'u': user_id, 'c': str(conversation_id), 'm': last_message_id, 'n': secrets.token_hex(8)},
+        salt=RESUME_SALT,
+        compress=True,
+    )
+
+
+def read_resume_token(token, user_id, conversation_id):
+    """The last message id from a valid, unused token for this user and conversation, else ``None``
+
+    Reading a token spends it: its nonce is recorded in the cache until the
+    token would have expired anyway.
+    """
+    max_age = getattr(settings, "CHAT_RESUME_TOKEN_MAX_AGE", 300)
+    try:
+        data = signing.loads(token, salt=RESUME_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return None
+    if data.get('u') != user_id or data.get('c') != str(conversation_id):
+        return None
+    if not data.get('n') or not cache.add(f"chat:resume:{data['n']}", 1, max_age):
+        return None
+    return data.get('m') or 0
+
+
+def install(channel_layer):
+    """Listen for SIGUSR1 and drain requests; called once per worker"""
+    global _installed
+    if _installed:
+        return
+    _installed = True
+
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, lambda: start(channel_layer, exit_after=True))
+    except (NotImplementedError, RuntimeError, ValueError):
+        # Not in the main thread, or no signal support (e.g. Windows)
+        logger.warning("Drain signal handler not installed")
+    if channel_layer is not None:
+        loop.create_task(_listen(channel_layer))
+
+
+async def _listen(channel_layer):
+    channel = await channel_layer.new_channel()
+    await channel_layer.group_add(CONTROL_GROUP, channel)
+    while True:
+        message = await channel_layer.receive(channel)
+        if message.get('type') != 'drain':
+            continue
+        if message.get('pid') not in (None, os.getpid()):
+            continue
+        start(channel_layer, exit_after=message.get('exit', False))
+
+
+def start(channel_layer, exit_after=False):
+    """Begin draining this worker; repeated calls while draining are ignored"""
+    global draining, _task
+    if draining:
+        return _task
+    draining = True
+    logger.warning(f"Draining {len(connections)} WebSocket connections")
+    _task = asyncio.get_running_loop().create_task(drain(channel_layer, exit_after))
+    return _task
+
+
+async def drain(channel_layer, exit_after=False):
+    from channels.db import database_sync_to_async
+
+    from . import notifications, outbox, reactions, receipts
+
+    consumers = list(connections)
+    random.shuffle(consumers)
+    waves = max(1, getattr(settings, "CHAT_DRAIN_WAVES", 10))
+    interval = getattr(settings, "CHAT_DRAIN_WAVE_INTERVAL", 1.0)
+    max_delay = getattr(settings, "CHAT_RECONNECT_MAX_DELAY", 30)
+    size = max(1, math.ceil(len(consumers) / waves))
+
+    try:
+        for start_index in range(0, len(consumers), size):
+            wave = consumers[start_index:start_index + size]
+            await asyncio.gather(
+                *(consumer.drain_close(random.uniform(0, max_delay)) for consumer in wave),
+                return_exceptions=True,
+            )
+            if start_index + size < len(consumers):
+                await asyncio.sleep(interval)
+
+        await receipts.flush_and_broadcast(channel_layer)
+        await reactions.flush_and_broadcast(channel_layer)
+        await outbox.kick(channel_layer)
+        await database_sync_to_async(notifications.flush)()
+        logger.warning("Drain complete")
+    finally:
+        if not exit_after:
+            undrain()
+
+    if exit_after:
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def undrain():
+    """Accept new sockets again after a drain that did not stop the worker"""
+    global draining, _task
+    draining = False
+    _task = None
+
+
+class RejectWhileDraining:
+    """ASGI middleware that refuses new sockets before any auth work while draining.
+
+    It wraps the whole application so the drain triggers are installed on the
+    worker's first request of any kind.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not _installed:
+            from channels.layers import get_channel_layer
+
+            install(get_channel_layer())
+        if draining and scope['type'] == 'websocket':
+            await receive()
+            await send({'type': 'websocket.close', 'code': 1013})
+            return
+        return await self.app(scope, receive, send)
@@ -0,0 +1,80 @@
+import csv
+import io
+import json
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from . import sharding
+from .models import Message
+
+EXPORT_FIELDS = [
+    "id",
+    "created_at",
+    "sender_id",
+    "content",
+]
+
+
+def export_rows(conversation_id, chunk_size=None):
+    """Iterate a conversation's messages through a server-side cursor.
+
+    Rows come back as tuples and senders are looked up once per chunk, since
+    messages may be on a shard while users stay on default. Memory use does
+    not grow with the size of the conversation.
+    """
+    chunk_size = chunk_size or getattr(settings, "CHAT_EXPORT_CHUNK_SIZE", 2000)
+    rows = (
+        Message.objects.using(sharding.shard_for(conversation_id))
+        .filter(conversation_id=conversation_id)
+        .order_by("created_at", "id")
+        .values_list(*EXPORT_FIELDS)
+        .iterator(chunk_size=chunk_size)
+    )
+    senders = {}
+    for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+        missing = {row[2] for row in chunk} - senders.keys()
+        if missing:
+            senders.update(
+                (pk, (username, display_name))
+                for pk, username, display_name in get_user_model()
+                .objects.filter(pk__in=missing)
+                .values_list("pk", "username", "display_name")
+            )
+        for message_id, created_at, sender_id, content in chunk:
+            yield (message_id, created_at, sender_id, *senders.get(sender_id, ("", "")), content)
+
+
+def ndjson_lines(rows):
+    for message_id, created_at, sender_id, username, display_name, content in rows:
+        line = json.dumps({
+            "id": message_id,
+            "created_at": created_at.isoformat(),
+            "sender": {"id": sender_id, "username": username, "display_name": display_name},
+            "content": content,
+        }, ensure_ascii=False)
+        yield line.encode("utf-8") + b"\n"
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    writer.writerow(["id", "created_at", "sender_id", "sender_username", "sender_display_name", "content"])
+    yield flush()
+    for message_id, created_at, sender_id, username, display_name, content in rows:
+        writer.writerow([message_id, created_at.isoformat(), sender_id, username, display_name, content])
+        yield flush()
+
+
+EXPORT_FORMATS = {
+    "ndjson": (ndjson_lines, "application/x-ndjson", "ndjson"),
+    "csv": (csv_lines, "text/csv; charset=utf-8", "csv"),
+}
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+
+from chat.retention import effective_policies, expire_conversation
+
+
+class Command(BaseCommand):
+    help = 'Archive or delete messages that are older than their conversation retention policy'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--conversation',
+            type=int,
+            help='Only apply the policy of this conversation',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Rows moved per transaction (defaults to CHAT_RETENTION_BATCH_SIZE)',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help='Seconds to sleep between batches to leave room for live traffic',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many messages would be affected',
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        for conversation_id, keep_days, action in effective_policies(options['conversation']):
+            handled = 0
+            for count in expire_conversation(
+                conversation_id,
+                keep_days,
+                action,
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                dry_run=options['dry_run'],
+            ):
+                handled += count
+            if handled:
+                verb = 'Would ' + action if options['dry_run'] else action.capitalize() + 'd'
+                self.stdout.write(
+                    f'{verb} {handled} messages from conversation {conversation_id} (older than {keep_days} days)'
+                )
+            total += handled
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'Dry run: {total} messages past retention'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'✅ Applied retention to {total} messages'))
@@ -1,7 +1,9 @@
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
-from chat.models import Conversation, Message
-from django.db import connection
+from django.db import DEFAULT_DB_ALIAS
+from chat import sharding
+from chat.bulk_delete import BulkDeleter, rebuild_counters
+from chat.models import ArchivedMessage, Conversation, Message
 
 User = get_user_model()
 
@@ -18,15 +20,47 @@ class Command(BaseCommand):
         parser.add_argument(
             '--users-only',
             action='store_true',
-            help='Clear only users (this will also clear conversations and messages)',
+            help='Clear only users (this will also clear their messages)',
         )
         parser.add_argument(
             '--conversations-only',
             action='store_true',
             help='Clear only conversations and messages',
         )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show estimated row counts per table without deleting anything',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows deleted per statement when TRUNCATE cannot be used',
+        )
 
     def handle(self, *args, **options):
+        if options['users_only']:
+            models = [User]
+        elif options['conversations_only']:
+            models = [Message, ArchivedMessage, Conversation]
+        else:
+            models = [Message, ArchivedMessage, Conversation, User]
+
+        # Message shards hold the sharded rows of the same tables
+        deleters = {
+            alias: BulkDeleter(using=alias, batch_size=options['batch_size'], progress=self.report_progress)
+            for alias in sharding.databases()
+        }
+
+        if options['dry_run']:
+            for alias, deleter in deleters.items():
+                for label, action, estimate in deleter.dry_run(
+                    [model._base_manager.all() for model in models], whole_table=True
+                ):
+                    self.stdout.write(f'  {self.label(label, alias)}: ~{estimate} rows ({action})')
+            return
+
         if not options['confirm']:
             self.stdout.write(
                 self.style.WARNING(
@@ -50,46 +84,18 @@ class Command(BaseCommand):
                 return
 
         try:
-            if options['users_only']:
-                # Clear users (this will cascade to conversations and messages)
-                user_count = User.objects.count()
-                User.objects.all().delete()
-                self.stdout.write(
-                    self.style.SUCCESS(f'✅ Deleted {user_count} users')
-                )
-            elif options['conversations_only']:
-                # Clear conversations and messages only
-                message_count = Message.objects.count()
-                conversation_count = Conversation.objects.count()
-                
-                Message.objects.all().delete()
-                Conversation.objects.all().delete()
-                
-                self.stdout.write(
-                    self.style.SUCCESS(f'✅ Deleted {message_count} messages')
-                )
-                self.stdout.write(
-                    self.style.SUCCESS(f'✅ Deleted {conversation_count} conversations')
-                )
-            else:
-                # Clear everything
-                message_count = Message.objects.count()
-                conversation_count = Conversation.objects.count()
-                user_count = User.objects.count()
-                
-                Message.objects.all().delete()
-                Conversation.objects.all().delete()
-                User.objects.all().delete()
-                
-                self.stdout.write(
-                    self.style.SUCCESS(f'✅ Deleted {message_count} messages')
-                )
-                self.stdout.write(
-                    self.style.SUCCESS(f'✅ Deleted {conversation_count} conversations')
-                )
-                self.stdout.write(
-                    self.style.SUCCESS(f'✅ Deleted {user_count} users')
-                )
+            for alias, deleter in deleters.items():
+                totals, estimated = deleter.wipe(models)
+                for label, count in totals.items():
+                    rows = f'~{count} rows (estimated)' if estimated else f'{count} rows'
+                    self.stdout.write(
+                        self.style.SUCCESS(f'✅ Deleted {rows} from {self.label(label, alias)}')
+                    )
+                if Message not in models:
+                    # Replies and reactions of deleted users went with them
+                    rebuild_counters(using=alias)
+            if Message not in models:
+                self.stdout.write(self.style.SUCCESS('✅ Recounted replies and reactions'))
 
             self.stdout.write(
                 self.style.SUCCESS('\n🎉 Database cleared successfully!')
@@ -99,4 +105,12 @@ class Command(BaseCommand):
             self.stdout.write(
                 self.style.ERROR(f'❌ Error clearing database: {str(e)}')
             )
-            raise 
\ No newline at end of file
+            raise
+
+    @staticmethod
+    def label(label, alias):
+        return label if alias == DEFAULT_DB_ALIAS else f'{label} ({alias})'
+
+    def report_progress(self, label, done, estimate):
+        total = f'/~{estimate}' if estimate is not None else ''
+        self.stdout.write(f'  {label}: {done}{total}')
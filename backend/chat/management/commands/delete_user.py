@@ -0,0 +1,99 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS
+
+from chat import sharding
+from chat.bulk_delete import BulkDeleter, counted_messages, rebuild_counters, user_querysets
+from chat.models import Message, Reaction
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Delete user accounts and all of their data in bounded batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('usernames', nargs='+', help='Usernames to delete')
+        parser.add_argument(
+            '--confirm',
+            action='store_true',
+            help='Skip confirmation prompt',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show estimated row counts per table without deleting anything',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows deleted per statement',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help='Seconds to sleep between batches',
+        )
+
+    def handle(self, *args, **options):
+        users = dict(User.objects.filter(username__in=options['usernames']).values_list('username', 'id'))
+        missing = set(options['usernames']) - set(users)
+        if missing:
+            raise CommandError(f'Unknown users: {", ".join(sorted(missing))}')
+
+        user_ids = list(users.values())
+        # Sharded rows of the users on every database; cascades from the users only reach default
+        plans = {
+            alias: [
+                Message.objects.filter(sender_id__in=user_ids),
+                Reaction.objects.filter(user_id__in=user_ids),
+            ]
+            for alias in sharding.databases()
+        }
+        plans[DEFAULT_DB_ALIAS] = user_querysets(user_ids)
+        deleters = {
+            alias: BulkDeleter(
+                using=alias,
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                progress=self.report_progress,
+            )
+            for alias in plans
+        }
+
+        if options['dry_run']:
+            for alias, querysets in plans.items():
+                for label, action, estimate in deleters[alias].dry_run(querysets):
+                    self.stdout.write(f'  {self.label(label, alias)}: ~{estimate} rows ({action})')
+            return
+
+        if not options['confirm']:
+            self.stdout.write(
+                self.style.WARNING(f'⚠️  This will permanently delete {", ".join(sorted(users))} and all their data.')
+            )
+            confirm = input('\nType "YES" to confirm: ')
+            if confirm != 'YES':
+                self.stdout.write(self.style.ERROR('Operation cancelled.'))
+                return
+
+        # Bulk deletes skip signals: recount the threads and reactions the users fed
+        counted = {alias: counted_messages(user_ids, using=alias) for alias in plans}
+        totals = {}
+        for alias in sorted(plans, key=lambda alias: alias == DEFAULT_DB_ALIAS):
+            for label, count in deleters[alias].delete(plans[alias]).items():
+                totals[self.label(label, alias)] = count
+        for label, count in totals.items():
+            self.stdout.write(self.style.SUCCESS(f'✅ {label}: {count} rows'))
+        for alias, message_ids in counted.items():
+            rebuild_counters(using=alias, message_ids=message_ids)
+        if any(counted.values()):
+            self.stdout.write(self.style.SUCCESS(f'✅ Recounted replies and reactions of {sum(map(len, counted.values()))} messages'))
+
+    @staticmethod
+    def label(label, alias):
+        return label if alias == DEFAULT_DB_ALIAS else f'{label} ({alias})'
+
+    def report_progress(self, label, done, estimate):
+        self.stdout.write(f'  {label}: {done}/~{estimate}')
@@ -0,0 +1,40 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from chat.outbox import OutboxDispatcher
+
+
+class Command(BaseCommand):
+    help = 'Publish committed outbox events to WebSocket groups'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the outbox once and exit instead of polling',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait when the outbox is empty',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Events claimed per batch (defaults to CHAT_OUTBOX_BATCH_SIZE)',
+        )
+
+    def handle(self, *args, **options):
+        dispatcher = OutboxDispatcher(batch_size=options['batch_size'])
+        if options['once']:
+            delivered = asyncio.run(dispatcher.drain())
+            self.stdout.write(self.style.SUCCESS(f'✅ Published {delivered} events'))
+            return
+
+        self.stdout.write('📤 Dispatching outbox events (Ctrl+C to stop)')
+        try:
+            asyncio.run(dispatcher.run_forever(options['poll_interval']))
+        except KeyboardInterrupt:
+            self.stdout.write('\n🛑 Dispatcher stopped')
@@ -0,0 +1,42 @@
+import os
+import signal
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.drain import CONTROL_GROUP
+
+
+class Command(BaseCommand):
+    help = 'Drain WebSocket connections before a deploy: clients are told to reconnect with jitter'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pid',
+            type=int,
+            help='Only drain the worker with this process id (default: every worker)',
+        )
+        parser.add_argument(
+            '--exit',
+            action='store_true',
+            help='Stop the drained workers once their connections are closed (otherwise they accept new sockets again)',
+        )
+
+    def handle(self, *args, **options):
+        pid = options['pid']
+        channel_layer = get_channel_layer()
+        if isinstance(channel_layer, InMemoryChannelLayer):
+            # The in-memory layer does not reach other processes; fall back to the signal
+            if not pid:
+                raise CommandError('The in-memory channel layer needs --pid (workers are signalled with SIGUSR1)')
+            os.kill(pid, signal.SIGUSR1)
+            self.stdout.write(self.style.SUCCESS(f'✅ Sent SIGUSR1 to worker {pid}'))
+            return
+
+        async_to_sync(channel_layer.group_send)(
+            CONTROL_GROUP,
+            {'type': 'drain', 'pid': pid, 'exit': options['exit']},
+        )
+        target = f'worker {pid}' if pid else 'all workers'
+        self.stdout.write(self.style.SUCCESS(f'✅ Drain requested for {target}'))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from chat.retention import export_archive
+
+
+class Command(BaseCommand):
+    help = 'Export archived messages to gzip-compressed JSONL files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output-dir',
+            help='Target directory (defaults to CHAT_ARCHIVE_EXPORT_DIR)',
+        )
+        parser.add_argument(
+            '--conversation',
+            type=int,
+            help='Only export this conversation',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            help='Rows read and written per chunk',
+        )
+        parser.add_argument(
+            '--purge',
+            action='store_true',
+            help='Delete archived rows once they have been written to disk',
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        paths = set()
+        for count, paths in export_archive(
+            directory=options['output_dir'],
+            conversation_id=options['conversation'],
+            chunk_size=options['chunk_size'],
+            purge=options['purge'],
+        ):
+            total += count
+            self.stdout.write(f'Exported {total} messages...')
+
+        self.stdout.write(
+            self.style.SUCCESS(f'✅ Exported {total} archived messages to {len(paths)} files')
+        )
@@ -0,0 +1,41 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.attachments import get_storage
+from chat.models import StoredFile, UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Remove abandoned uploads and stored files no attachment refers to'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-hours',
+            type=int,
+            default=24,
+            help='Unfinished uploads idle for longer than this are removed',
+        )
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        cutoff = timezone.now() - timedelta(hours=options['older_than_hours'])
+
+        stale = UploadSession.objects.filter(attachment__isnull=True, created_at__lt=cutoff)
+        sessions = 0
+        for session_id in stale.values_list('id', flat=True).iterator():
+            storage.discard_partial(session_id)
+            sessions += 1
+        stale.delete()
+
+        orphans = StoredFile.objects.filter(attachments__isnull=True)
+        blobs = 0
+        for blob in orphans.iterator():
+            storage.delete(blob.name)
+            blob.delete()
+            blobs += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(f'✅ Removed {sessions} abandoned uploads and {blobs} unused files')
+        )
@@ -0,0 +1,117 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count
+
+from chat import sharding
+from chat.models import Conversation, ConversationShard, Message
+from chat.rebalance import move_conversation
+
+
+class Command(BaseCommand):
+    help = 'Show how conversations are spread over message shards, or move them between shards online'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--to',
+            help='Shard to move conversations to',
+        )
+        parser.add_argument(
+            '--conversation',
+            type=int,
+            action='append',
+            default=[],
+            help='Conversation to move (repeatable)',
+        )
+        parser.add_argument(
+            '--from',
+            dest='source',
+            help='Move conversations away from this shard, oldest first',
+        )
+        parser.add_argument(
+            '--count',
+            type=int,
+            default=1,
+            help='How many conversations to move with --from',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Messages copied per transaction',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help='Seconds to sleep between batches of the initial copy',
+        )
+        parser.add_argument(
+            '--grace',
+            type=float,
+            help='Seconds to wait for in-flight writes after freezing (defaults to CHAT_SHARD_MOVE_GRACE)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only list the conversations that would be moved',
+        )
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError('Sharding is off: set CHAT_MESSAGE_SHARDS first')
+
+        if not options['to']:
+            self.show_status()
+            return
+        if options['to'] not in sharding.databases():
+            raise CommandError(f'Unknown shard {options["to"]}, choose one of: {", ".join(sharding.databases())}')
+
+        conversation_ids = options['conversation'] or self.pick(options['source'], options['count'])
+        if not conversation_ids:
+            raise CommandError('Nothing to move: pass --conversation or --from')
+
+        for conversation_id in conversation_ids:
+            if options['dry_run']:
+                self.stdout.write(
+                    f'Would move conversation {conversation_id} from '
+                    f'{sharding.placement(conversation_id, fresh=True)[0]} to {options["to"]}'
+                )
+                continue
+            self.stdout.write(f'📦 Moving conversation {conversation_id} to {options["to"]}')
+            moved = move_conversation(
+                conversation_id,
+                options['to'],
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                grace=options['grace'],
+                progress=self.report_progress,
+            )
+            self.stdout.write(self.style.SUCCESS(f'✅ Conversation {conversation_id}: {moved} messages on {options["to"]}'))
+
+    def pick(self, source, count):
+        if not source:
+            return []
+        if source == DEFAULT_DB_ALIAS:
+            # Conversations from before sharding have no directory entry
+            conversations = Conversation.objects.exclude(shard__alias__in=[
+                alias for alias in sharding.databases() if alias != DEFAULT_DB_ALIAS
+            ])
+        else:
+            conversations = Conversation.objects.filter(shard__alias=source)
+        return list(conversations.order_by('id').values_list('id', flat=True)[:count])
+
+    def show_status(self):
+        placed = dict(
+            ConversationShard.objects.values('alias').annotate(total=Count('pk')).values_list('alias', 'total')
+        )
+        placed[DEFAULT_DB_ALIAS] = Conversation.objects.count() - sum(
+            total for alias, total in placed.items() if alias != DEFAULT_DB_ALIAS
+        )
+        for alias in sharding.databases():
+            self.stdout.write(
+                f'  {alias}: {placed.get(alias, 0)} conversations, '
+                f'{Message.objects.using(alias).count()} messages'
+            )
+
+    def report_progress(self, phase, count):
+        self.stdout.write(f'  {phase}: {count}')
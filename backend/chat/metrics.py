@@ -0,0 +1,39 @@
+"""
+In-process metrics for this worker.
+
+Counters are plain named integers. Sources are callables registered under a
+name (e.g. one per WebSocket connection) and sampled when a snapshot is taken.
+Each worker process keeps its own registry.
+"""
+
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_sources = {}
+
+
+def incr(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def register(name, source):
+    """Sample ``source()`` under ``name`` in every snapshot until unregistered"""
+    with _lock:
+        _sources[name] = source
+
+
+def unregister(name):
+    with _lock:
+        _sources.pop(name, None)
+
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        sources = dict(_sources)
+    return {
+        "counters": counters,
+        "sources": {name: source() for name, source in sorted(sources.items())},
+    }
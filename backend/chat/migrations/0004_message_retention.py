@@ -0,0 +1,50 @@
+# Generated by Django 5.0.2 on 2026-10-19 15:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_read_cursor'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('conversation_id', models.BigIntegerField()),
+                ('sender_id', models.BigIntegerField()),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('exported_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RetentionPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('keep_days', models.PositiveIntegerField()),
+                ('action', models.CharField(choices=[('archive', 'Archive'), ('delete', 'Delete')], default='archive', max_length=16)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'created_at'], name='chat_msg_conv_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedmessage',
+            index=models.Index(fields=['conversation_id', 'created_at'], name='chat_archive_conv_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='retentionpolicy',
+            name='conversation',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='retention_policy', to='chat.conversation'),
+        ),
+    ]
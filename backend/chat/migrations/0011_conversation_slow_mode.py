@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-19 15:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_message_threads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='slow_mode_seconds',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.0.2 on 2026-10-19 16:23
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0013_message_created_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConversationShard',
+            fields=[
+                ('conversation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='shard', serialize=False, to='chat.conversation')),
+                ('alias', models.CharField(max_length=64)),
+                ('frozen', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='attachment',
+            name='message',
+            field=models.ForeignKey(blank=True, db_constraint=not getattr(settings, 'CHAT_MESSAGE_SHARDS', []), null=True, on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='chat.message'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(db_constraint=not getattr(settings, 'CHAT_MESSAGE_SHARDS', []), on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.conversation'),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='sender',
+            field=models.ForeignKey(db_constraint=not getattr(settings, 'CHAT_MESSAGE_SHARDS', []), on_delete=django.db.models.deletion.CASCADE, related_name='sent_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='outboxevent',
+            name='conversation',
+            field=models.ForeignKey(db_constraint=not getattr(settings, 'CHAT_MESSAGE_SHARDS', []), on_delete=django.db.models.deletion.CASCADE, related_name='outbox_events', to='chat.conversation'),
+        ),
+        migrations.AlterField(
+            model_name='reaction',
+            name='user',
+            field=models.ForeignKey(db_constraint=not getattr(settings, 'CHAT_MESSAGE_SHARDS', []), on_delete=django.db.models.deletion.CASCADE, related_name='reactions', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
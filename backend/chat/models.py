@@ -1,24 +1,286 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
+# Foreign keys between the sharded tables and those that stay on the default
+# database are only enforced while sharding is off: with it on, either end may
+# be on another database (see chat.sharding.drop_cross_database_constraints)
+CROSS_DATABASE_CONSTRAINTS = not getattr(settings, "CHAT_MESSAGE_SHARDS", [])
+
 
 class Conversation(models.Model):
     title = models.CharField(max_length=255, blank=True)
     participants = models.ManyToManyField(get_user_model(), related_name="conversations")
     created_at = models.DateTimeField(auto_now_add=True)
+    # Minimum seconds between two messages from the same participant; 0 is off
+    slow_mode_seconds = models.PositiveIntegerField(default=0)
+    # Bumped with every change to the message history; validators for conditional GETs
+    version = models.PositiveBigIntegerField(default=1)
+    last_activity_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self) -> str:
         return self.title or f"Conversation {self.pk}"
 
 
+class ConversationShard(models.Model):
+    """Directory entry: the database holding a conversation's messages (see chat/sharding.py)"""
+
+    conversation = models.OneToOneField(
+        Conversation, on_delete=models.CASCADE, primary_key=True, related_name="shard"
+    )
+    alias = models.CharField(max_length=64)
+    # Set while a rebalance copies the last changes; writes are refused meanwhile
+    frozen = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.conversation_id} on {self.alias}"
+
+
 class Message(models.Model):
-    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="messages")
-    sender = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="sent_messages")
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name="messages",
+        db_constraint=CROSS_DATABASE_CONSTRAINTS,
+    )
+    sender = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name="sent_messages",
+        db_constraint=CROSS_DATABASE_CONSTRAINTS,
+    )
     content = models.TextField()
+    # Optional id chosen by the client so retried sends can be recognised
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Bumped on every edit or delete so clients can apply deltas in order
+    version = models.PositiveIntegerField(default=1)
+    edited_at = models.DateTimeField(null=True, blank=True)
+    # Deleted messages stay as tombstones with their content cleared
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    # Replies point at the message they answer and at the top of their thread
+    parent = models.ForeignKey("self", on_delete=models.SET_NULL, null=True, blank=True, related_name="replies")
+    thread_root = models.ForeignKey(
+        "self", on_delete=models.SET_NULL, null=True, blank=True, related_name="thread_messages"
+    )
+    # Thread summary, kept on the root so room history needs no extra queries
+    reply_count = models.PositiveIntegerField(default=0)
+    last_reply_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["conversation", "created_at"], name="chat_msg_conv_created_idx"),
+            models.Index(fields=["thread_root", "created_at"], name="chat_msg_thread_created_idx"),
+            # Admin date hierarchy filters on created_at alone
+            models.Index(fields=["created_at"], name="chat_msg_created_idx"),
+        ]
+        constraints = [
+            # A client id is only unique within one conversation
+            models.UniqueConstraint(
+                fields=["conversation", "sender", "client_msg_id"],
+                condition=models.Q(client_msg_id__isnull=False),
+                name="unique_conversation_sender_client_msg_id",
+            ),
+        ]
 
     def __str__(self) -> str:
         return f"{self.sender}: {self.content[:20]}"
+
+    @property
+    def is_deleted(self):
+        return self.deleted_at is not None
+
+
+class Reaction(models.Model):
+    """One user's emoji reaction on a message"""
+
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="reactions")
+    user = models.ForeignKey(
+        get_user_model(),
+        on_delete=models.CASCADE,
+        related_name="reactions",
+        db_constraint=CROSS_DATABASE_CONSTRAINTS,
+    )
+    emoji = models.CharField(max_length=32)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["message", "user", "emoji"], name="unique_message_user_emoji"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.user} {self.emoji} on {self.message_id}"
+
+
+class ReactionCount(models.Model):
+    """Denormalized reaction totals, one row per (message, emoji).
+
+    Kept in step with ``Reaction`` inside the same transaction so history
+    pages read counts directly instead of aggregating reactions.
+    """
+
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="reaction_counts")
+    emoji = models.CharField(max_length=32)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["message", "emoji"], name="unique_message_emoji_count"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.emoji} x{self.count} on {self.message_id}"
+
+
+class ReadCursor(models.Model):
+    """Per-participant delivery and read high-water marks for a conversation"""
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="read_cursors")
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="read_cursors")
+    last_delivered_message_id = models.BigIntegerField(default=0)
+    last_read_message_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["conversation", "user"], name="unique_read_cursor"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.user} read {self.conversation} up to {self.last_read_message_id}"
+
+
+class RetentionPolicy(models.Model):
+    """How long a conversation keeps messages before they are archived or deleted"""
+
+    ACTION_ARCHIVE = "archive"
+    ACTION_DELETE = "delete"
+    ACTION_CHOICES = [
+        (ACTION_ARCHIVE, "Archive"),
+        (ACTION_DELETE, "Delete"),
+    ]
+
+    conversation = models.OneToOneField(Conversation, on_delete=models.CASCADE, related_name="retention_policy")
+    keep_days = models.PositiveIntegerField()
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES, default=ACTION_ARCHIVE)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f"{self.conversation}: {self.action} after {self.keep_days} days"
+
+
+class ArchivedMessage(models.Model):
+    """Cold copy of an expired message.
+
+    Keeps the original primary key and stores plain ids instead of foreign keys,
+    so archived rows never take part in cascades on the live tables.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    conversation_id = models.BigIntegerField()
+    sender_id = models.BigIntegerField()
+    content = models.TextField()
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    exported_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["conversation_id", "created_at"], name="chat_archive_conv_created_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"Archived message {self.pk}"
+
+
+class StoredFile(models.Model):
+    """Content-addressed file on disk, shared by every attachment with the same bytes"""
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    name = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return self.sha256
+
+
+class Attachment(models.Model):
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="attachments")
+    uploader = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="attachments")
+    message = models.ForeignKey(
+        Message,
+        on_delete=models.CASCADE,
+        related_name="attachments",
+        null=True,
+        blank=True,
+        db_constraint=CROSS_DATABASE_CONSTRAINTS,
+    )
+    blob = models.ForeignKey(StoredFile, on_delete=models.PROTECT, related_name="attachments")
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return self.filename
+
+
+class UploadSession(models.Model):
+    """A resumable upload; ``received`` is the byte offset the next chunk must start at"""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="upload_sessions")
+    uploader = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name="upload_sessions")
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    attachment = models.OneToOneField(
+        Attachment, on_delete=models.CASCADE, related_name="upload_session", null=True, blank=True
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def is_complete(self):
+        return self.attachment_id is not None
+
+    def __str__(self) -> str:
+        return f"Upload {self.pk} ({self.received}/{self.size})"
+
+
+class OutboxEvent(models.Model):
+    """A channel-layer event written in the same transaction as the change it announces.
+
+    Rows are deleted once published. ``claim_token``/``claimed_until`` form a
+    lease so several dispatchers can share the table without long transactions.
+    """
+
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name="outbox_events",
+        db_constraint=CROSS_DATABASE_CONSTRAINTS,
+    )
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    claim_token = models.UUIDField(null=True, blank=True)
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [
+            models.Index(fields=["available_at", "id"], name="chat_outbox_available_idx"),
+            models.Index(fields=["conversation", "id"], name="chat_outbox_conv_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"Outbox {self.pk} for {self.conversation_id}"
@@ -0,0 +1,223 @@
+"""
+Digest notifications for participants who are not connected.
+
+After the outbox dispatcher publishes a batch of new messages, the offline
+recipients of the whole batch are found in bulk: one query for the
+participants of every conversation in it, and one cache ``get_many`` for
+their presence. Each offline recipient's messages are merged into a single
+pending digest per (user, conversation). Digests are sent to the configured
+sink every CHAT_NOTIFY_WINDOW seconds, or sooner if CHAT_NOTIFY_MAX_PENDING
+digests are waiting. Users who reconnected in the meantime are skipped.
+
+Memory stays bounded under bursty group traffic. There is at most one entry
+per (user, conversation), each keeps only the last CHAT_NOTIFY_PREVIEWS
+previews, and a full buffer is flushed immediately.
+
+Presence is a per-(conversation, user) connection count in the shared
+cache. Each socket refreshes it from a timer every third of CHAT_PRESENCE_TTL,
+so participants who only read stay online; the TTL only expires the count of a
+worker that died without disconnecting its sockets.
+"""
+
+import json
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .coalesce import CoalescingBuffer
+from .models import Conversation
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_LENGTH = 140
+
+
+def _presence_key(conversation_id, user_id):
+    return f"chat:presence:{conversation_id}:{user_id}"
+
+
+def _presence_ttl():
+    return getattr(settings, "CHAT_PRESENCE_TTL", 300)
+
+
+def connected(conversation_id, user_id):
+    key = _presence_key(conversation_id, user_id)
+    cache.add(key, 0, _presence_ttl())
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Expired between add and incr
+        cache.set(key, 1, _presence_ttl())
+    cache.touch(key, _presence_ttl())
+
+
+def disconnected(conversation_id, user_id):
+    key = _presence_key(conversation_id, user_id)
+    try:
+        if cache.decr(key) <= 0:
+            cache.delete(key)
+    except ValueError:
+        pass
+
+
+def refresh(conversation_id, user_id):
+    cache.touch(_presence_key(conversation_id, user_id), _presence_ttl())
+
+
+def online(pairs):
+    """The ``(conversation_id, user_id)`` pairs with at least one live socket, in one cache call"""
+    keys = {_presence_key(*pair): pair for pair in pairs}
+    found = cache.get_many(list(keys))
+    return {keys[key] for key, count in found.items() if count and count > 0}
+
+
+class DigestBuffer(CoalescingBuffer):
+    """Pending digests keyed by (user_id, conversation_id)"""
+
+    def __init__(self, previews=3, **kwargs):
+        super().__init__(**kwargs)
+        self.previews = previews
+
+    def merge(self, current, update):
+        return {
+            "count": current["count"] + update["count"],
+            "first_at": current["first_at"],
+            "last_at": update["last_at"],
+            "messages": (current["messages"] + update["messages"])[-self.previews:],
+        }
+
+
+digests = DigestBuffer(
+    previews=getattr(settings, "CHAT_NOTIFY_PREVIEWS", 3),
+    flush_interval=getattr(settings, "CHAT_NOTIFY_WINDOW", 60),
+    max_pending=getattr(settings, "CHAT_NOTIFY_MAX_PENDING", 10000),
+)
+metrics.register("notify.buffer", lambda: {"pending": len(digests), "max": digests.max_pending})
+
+_timer = None
+_timer_lock = threading.Lock()
+_sink = None
+
+
+def get_sink():
+    global _sink
+    if _sink is None:
+        _sink = import_string(getattr(settings, "CHAT_NOTIFICATION_SINK", "chat.notifications.MemorySink"))()
+    return _sink
+
+
+def enqueue_events(events):
+    """Queue digests for the offline recipients of published ``chat_message`` events"""
+    messages = [e for e in events if e.payload.get("type") == "chat_message"]
+    if not messages:
+        return 0
+
+    participants = {}
+    rows = Conversation.participants.through.objects.filter(
+        conversation_id__in={e.conversation_id for e in messages}
+    ).values_list("conversation_id", "user_id")
+    for conversation_id, user_id in rows:
+        participants.setdefault(conversation_id, []).append(user_id)
+    present = online(
+        (conversation_id, user_id) for conversation_id, users in participants.items() for user_id in users
+    )
+
+    queued = 0
+    for event in messages:
+        payload = event.payload
+        for user_id in participants.get(event.conversation_id, ()):
+            if user_id == payload["user_id"] or (event.conversation_id, user_id) in present:
+                continue
+            digests.add((user_id, event.conversation_id), {
+                "count": 1,
+                "first_at": payload["timestamp"],
+                "last_at": payload["timestamp"],
+                "messages": [{
+                    "message_id": payload["message_id"],
+                    "user_id": payload["user_id"],
+                    "display_name": payload["display_name"],
+                    "preview": payload["message"][:PREVIEW_LENGTH],
+                    "timestamp": payload["timestamp"],
+                }],
+            })
+            queued += 1
+        if len(digests) >= digests.max_pending:
+            flush()
+
+    metrics.incr("notify.messages", len(messages))
+    metrics.incr("notify.recipients", queued)
+    if digests.due():
+        flush()
+    else:
+        _schedule()
+    return queued
+
+
+def _schedule():
+    """Flush after the window even if no further message arrives"""
+    global _timer
+    with _timer_lock:
+        if _timer is not None or not len(digests):
+            return
+        _timer = threading.Timer(digests.flush_interval, _timed_flush)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _timed_flush():
+    global _timer
+    with _timer_lock:
+        _timer = None
+    try:
+        flush()
+    except Exception:
+        logger.exception("Notification flush failed")
+
+
+def flush():
+    """Send every pending digest whose recipient is still offline; returns the number sent"""
+    pending = digests.drain()
+    if not pending:
+        return 0
+
+    present = online((conversation_id, user_id) for user_id, conversation_id in pending)
+    batch = [
+        {"user_id": user_id, "conversation_id": conversation_id, **digest}
+        for (user_id, conversation_id), digest in pending.items()
+        if (conversation_id, user_id) not in present
+    ]
+    if batch:
+        get_sink().deliver(batch)
+    metrics.incr("notify.flushes")
+    metrics.incr("notify.digests_sent", len(batch))
+    metrics.incr("notify.digests_skipped_online", len(pending) - len(batch))
+    metrics.incr("notify.digest_messages", sum(d["count"] for d in batch))
+    return len(batch)
+
+
+class MemorySink:
+    """Keeps the latest digests in memory; for tests and local development"""
+
+    def __init__(self, maxlen=1000):
+        self.delivered = deque(maxlen=maxlen)
+
+    def deliver(self, digests):
+        self.delivered.extend(digests)
+
+
+class FileSink:
+    """Appends digests as JSON lines to CHAT_NOTIFICATION_FILE"""
+
+    def __init__(self, path=None):
+        self.path = path or settings.CHAT_NOTIFICATION_FILE
+        self._lock = threading.Lock()
+
+    def deliver(self, digests):
+        lines = "".join(json.dumps(digest, ensure_ascii=False) + "\n" for digest in digests)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
@@ -0,0 +1,126 @@
+import asyncio
+import collections
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+
+class OutboundQueue:
+    """Bounded send queue for one WebSocket, drained by a single writer task.
+
+    Group events are queued instead of sent inline, so a slow client never
+    stalls the consumer's channel-layer reads (where ``channels_redis`` would
+    otherwise start dropping events silently once the channel is full).
+
+    - Above ``high_watermark`` the connection is congested: queued and new
+      ephemeral frames (typing, join/leave) are dropped.
+    - Congestion clears once the writer is back down to ``low_watermark``.
+    - A connection that reaches ``max_size`` or stays congested for
+      ``evict_after`` seconds is handed to ``on_evict``.
+    """
+
+    def __init__(self, send, on_evict, high_watermark=None, low_watermark=None, max_size=None, evict_after=None):
+        self._send = send
+        self._on_evict = on_evict
+        self.high_watermark = high_watermark or getattr(settings, "CHAT_WS_QUEUE_HIGH_WATERMARK", 200)
+        self.low_watermark = low_watermark or getattr(settings, "CHAT_WS_QUEUE_LOW_WATERMARK", 50)
+        self.max_size = max_size or getattr(settings, "CHAT_WS_QUEUE_MAX_SIZE", 1000)
+        self.evict_after = evict_after or getattr(settings, "CHAT_WS_SLOW_EVICT_SECONDS", 10)
+
+        self._frames = collections.deque()
+        self._ready = asyncio.Event()
+        self._task = None
+        self.closed = False
+        self.congested_since = None
+        self.peak = 0
+        self.sent = 0
+        self.dropped = 0
+        self.last_message_id = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def put(self, data, ephemeral=False, message_id=None):
+        """Queue an encoded frame: ``str`` goes out as a text frame, ``bytes`` as binary"""
+        if self.closed:
+            return
+
+        depth = len(self._frames)
+        if depth >= self.high_watermark and self.congested_since is None:
+            self.congested_since = time.monotonic()
+            self._shed_ephemeral()
+
+        if self.congested_since is not None:
+            if ephemeral:
+                self._drop()
+                return
+            if len(self._frames) >= self.max_size or time.monotonic() - self.congested_since >= self.evict_after:
+                self.evict()
+                return
+
+        self._frames.append((data, ephemeral, message_id))
+        self.peak = max(self.peak, len(self._frames))
+        self._ready.set()
+
+    def _shed_ephemeral(self):
+        kept = collections.deque(frame for frame in self._frames if not frame[1])
+        self._drop(len(self._frames) - len(kept))
+        self._frames = kept
+
+    def _drop(self, count=1):
+        if count:
+            self.dropped += count
+            metrics.incr("ws.frames_dropped", count)
+
+    def evict(self):
+        """Stop sending queued frames and let ``on_evict`` close the connection"""
+        if self.closed:
+            return
+        metrics.incr("ws.slow_consumers_evicted")
+        self._drop(len(self._frames))
+        self.close()
+        asyncio.get_running_loop().create_task(self._on_evict(self.last_message_id))
+
+    def close(self):
+        self.closed = True
+        self._frames.clear()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def wait_empty(self, timeout):
+        """Give the writer up to ``timeout`` seconds to send everything queued"""
+        deadline = time.monotonic() + timeout
+        while self._frames and not self.closed and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def _run(self):
+        while not self.closed:
+            if not self._frames:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            data, _, message_id = self._frames.popleft()
+            if isinstance(data, bytes):
+                await self._send(bytes_data=data)
+            else:
+                await self._send(text_data=data)
+            self.sent += 1
+            if message_id is not None:
+                self.last_message_id = message_id
+            if self.congested_since is not None and len(self._frames) <= self.low_watermark:
+                self.congested_since = None
+
+    def stats(self):
+        return {
+            "depth": len(self._frames),
+            "peak": self.peak,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "congested_for": round(time.monotonic() - self.congested_since, 3) if self.congested_since else 0,
+        }
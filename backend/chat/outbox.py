@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from config.profiling import span
+
+from . import notifications, sharding
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxDispatcher:
+    """Publishes committed outbox rows to their ``chat_<id>`` groups in batches.
+
+    Guarantees:
+    - at-least-once: a row is deleted only after ``group_send`` succeeded, and
+      a crashed dispatcher's lease simply expires;
+    - per-conversation order: an event is only published when no earlier event
+      of the same conversation is still pending, so a failing event holds back
+      the ones behind it until its retry succeeds.
+    """
+
+    def __init__(self, channel_layer=None, batch_size=None, lease_seconds=None):
+        self.channel_layer = channel_layer or get_channel_layer()
+        self.batch_size = batch_size or getattr(settings, "CHAT_OUTBOX_BATCH_SIZE", 100)
+        self.lease = timedelta(seconds=lease_seconds or getattr(settings, "CHAT_OUTBOX_LEASE_SECONDS", 30))
+        self.max_backoff = getattr(settings, "CHAT_OUTBOX_MAX_BACKOFF", 60)
+
+    def claim(self, using=DEFAULT_DB_ALIAS, conversation_id=None):
+        """Lease the next batch of publishable events on one database; returns them in id order"""
+        table = OutboxEvent.objects.using(using)
+        now = timezone.now()
+        available = table.filter(available_at__lte=now).filter(
+            Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+        )
+        if conversation_id is not None:
+            available = available.filter(conversation_id=conversation_id)
+        candidates = list(available.order_by("id").values_list("id", flat=True)[: self.batch_size])
+        if not candidates:
+            return []
+
+        token = uuid.uuid4()
+        available.filter(pk__in=candidates).update(claim_token=token, claimed_until=now + self.lease)
+        events = list(table.filter(claim_token=token).order_by("id"))
+        if not events:
+            return []
+
+        # Hold back events that have an earlier sibling we do not own, e.g. one
+        # waiting for a retry or leased by another dispatcher
+        heads = dict(
+            table.filter(conversation_id__in={e.conversation_id for e in events})
+            .exclude(claim_token=token)
+            .values("conversation_id")
+            .annotate(first=Min("id"))
+            .values_list("conversation_id", "first")
+        )
+        ready = [e for e in events if heads.get(e.conversation_id) is None or e.id < heads[e.conversation_id]]
+        held = [e.id for e in events if e not in ready]
+        if held:
+            table.filter(pk__in=held).update(claim_token=None, claimed_until=None)
+        return ready
+
+    def settle(self, delivered, failed, released, using=DEFAULT_DB_ALIAS):
+        table = OutboxEvent.objects.using(using)
+        if delivered:
+            table.filter(pk__in=delivered).delete()
+        if released:
+            table.filter(pk__in=released).update(claim_token=None, claimed_until=None)
+        now = timezone.now()
+        for event, error in failed:
+            attempts = event.attempts + 1
+            delay = min(2 ** attempts, self.max_backoff)
+            table.filter(pk=event.pk).update(
+                attempts=attempts,
+                last_error=error,
+                available_at=now + timedelta(seconds=delay),
+                claim_token=None,
+                claimed_until=None,
+            )
+            logger.warning(f"Outbox event {event.pk} failed (attempt {attempts}), retrying in {delay}s: {error}")
+
+    async def dispatch_once(self):
+        """Publish one batch from every database holding outbox rows; returns the number delivered"""
+        delivered = 0
+        for using in sharding.databases():
+            delivered += await self.dispatch_from(using)
+        return delivered
+
+    async def dispatch_from(self, using, conversation_id=None):
+        events = await database_sync_to_async(self.claim)(using, conversation_id)
+        delivered, failed, released = [], [], []
+        blocked = set()
+        for event in events:
+            if event.conversation_id in blocked:
+                released.append(event.id)
+                continue
+            try:
+                with span('group_send'):
+                    await self.channel_layer.group_send(f'chat_{event.conversation_id}', event.payload)
+            except Exception as e:
+                failed.append((event, repr(e)))
+                blocked.add(event.conversation_id)
+            else:
+                delivered.append(event.id)
+        if events:
+            await database_sync_to_async(self.settle)(delivered, failed, released, using)
+        if delivered:
+            published = [e for e in events if e.id in set(delivered)]
+            try:
+                await database_sync_to_async(notifications.enqueue_events)(published)
+            except Exception:
+                # Notifications are best effort and must never hold up the outbox
+                logger.exception("Queueing notifications failed")
+        return len(delivered)
+
+    async def drain(self):
+        """Dispatch until nothing publishable is left; returns the number delivered"""
+        total = 0
+        while True:
+            delivered = await self.dispatch_once()
+            if not delivered:
+                return total
+            total += delivered
+
+    async def drain_conversation(self, conversation_id):
+        """Dispatch one conversation's pending events; returns the number delivered"""
+        using = await database_sync_to_async(sharding.shard_for)(conversation_id)
+        total = 0
+        while True:
+            delivered = await self.dispatch_from(using, conversation_id)
+            if not delivered:
+                return total
+            total += delivered
+
+    async def run_forever(self, poll_interval=1.0):
+        while True:
+            try:
+                delivered = await self.drain()
+            except Exception:
+                logger.exception("Outbox dispatch failed")
+                delivered = 0
+            if not delivered:
+                await asyncio.sleep(poll_interval)
+
+
+async def kick(channel_layer=None, conversation_id=None):
+    """Publish right after a write, unless a separate dispatch_outbox worker does it.
+
+    With ``conversation_id`` only that conversation's events go out, so a
+    sender never waits for other conversations' backlog. The write has
+    already committed, so a failure here is logged, not raised; the events
+    stay queued for the next kick or ``dispatch_outbox``.
+    """
+    if not getattr(settings, "CHAT_OUTBOX_INLINE_DISPATCH", True):
+        return
+    dispatcher = OutboxDispatcher(channel_layer)
+    try:
+        if conversation_id is None:
+            await dispatcher.drain()
+        else:
+            await dispatcher.drain_conversation(conversation_id)
+    except Exception:
+        logger.exception(f"Inline outbox dispatch failed for conversation {conversation_id}")
+
+
+def kick_sync(conversation_id=None):
+    async_to_sync(kick)(conversation_id=conversation_id)
@@ -0,0 +1,76 @@
+"""
+Validation for inbound WebSocket frames.
+
+Codecs (see ``chat.codecs``) enforce the size cap and decode; each decoded
+frame is then checked against its schema. Failures raise ``FrameError`` with
+a code the consumer sends back as ``{"type": "error", "code": ..., "detail": ...}``.
+"""
+
+from django.conf import settings
+
+
+class FrameError(Exception):
+    def __init__(self, code, detail):
+        super().__init__(detail)
+        self.code = code
+        self.detail = detail
+
+
+# Ids are 64-bit signed columns; larger values would fail in the database
+MAX_ID = 2 ** 63 - 1
+
+
+def _int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and 0 < value <= MAX_ID
+
+
+def _text(max_length):
+    return lambda value: isinstance(value, str) and 0 < len(value.strip()) and len(value) <= max_length
+
+
+def _bool(value):
+    return isinstance(value, bool)
+
+
+def _ids(value):
+    return isinstance(value, list) and len(value) <= 10 and all(_int(i) for i in value)
+
+
+def _schemas():
+    message = _text(getattr(settings, "CHAT_MAX_MESSAGE_LENGTH", 4000))
+    return {
+        'message': {
+            'message': (message, True),
+            'client_msg_id': (_text(64), False),
+            'attachment_ids': (_ids, False),
+            'parent_id': (_int, False),
+        },
+        'typing': {'typing': (_bool, False)},
+        'edit': {'message_id': (_int, True), 'message': (message, True), 'version': (_int, False)},
+        'delete': {'message_id': (_int, True), 'version': (_int, False)},
+        'read': {'up_to': (_int, True)},
+        'delivered': {'up_to': (_int, True)},
+        'react': {'message_id': (_int, True), 'emoji': (_text(32), True), 'add': (_bool, False)},
+    }
+
+
+SCHEMAS = _schemas()
+
+
+def validate_frame(frame):
+    frame_type = frame.setdefault('type', 'message')
+    if not isinstance(frame_type, str):
+        raise FrameError('invalid_frame', 'type must be a string')
+    schema = SCHEMAS.get(frame_type)
+    if schema is None:
+        raise FrameError('unknown_type', f'Unknown frame type {frame_type!r}')
+
+    for field, (valid, required) in schema.items():
+        value = frame.get(field)
+        if value is None:
+            if required:
+                raise FrameError('invalid_frame', f'{field} is required for {frame_type} frames')
+            continue
+        if not valid(value):
+            raise FrameError('invalid_frame', f'Invalid {field} for {frame_type} frames')
+    return frame
@@ -0,0 +1,96 @@
+"""
+Send-rate limits shared by every worker through the cache.
+
+``TokenBucket`` implements GCRA (a token bucket that stores a single
+timestamp per key). With the Redis cache backend each check is one atomic Lua
+call timed by the Redis clock; other backends fall back to a read-modify-write
+that is only approximate under concurrency.
+"""
+
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.redis import RedisCache
+
+_GCRA_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local interval = tonumber(ARGV[1])
+local tolerance = tonumber(ARGV[2])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1]) or '0'), now)
+local new_tat = tat + interval
+if new_tat - tolerance > now then
+    return tostring(new_tat - tolerance - now)
+end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+return '0'
+"""
+
+
+class TokenBucket:
+    """Allow ``rate`` events per second on average with bursts of up to ``burst``"""
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (burst - 1)
+
+    def hit(self, key):
+        """Take one token; returns 0 if allowed, otherwise seconds until it would be"""
+        cache_key = f"chat:bucket:{self.name}:{key}"
+        if isinstance(cache, RedisCache):
+            full_key = cache.make_and_validate_key(cache_key)
+            client = cache._cache.get_client(full_key, write=True)
+            return float(client.eval(_GCRA_SCRIPT, 1, full_key, self.interval, self.tolerance))
+
+        now = time.time()
+        tat = max(cache.get(cache_key) or 0.0, now)
+        new_tat = tat + self.interval
+        if new_tat - self.tolerance > now:
+            return new_tat - self.tolerance - now
+        cache.set(cache_key, new_tat, math.ceil(new_tat - now))
+        return 0.0
+
+
+user_frames = TokenBucket(
+    "user",
+    getattr(settings, "CHAT_USER_FRAME_RATE", 10),
+    getattr(settings, "CHAT_USER_FRAME_BURST", 20),
+)
+room_messages = TokenBucket(
+    "room",
+    getattr(settings, "CHAT_ROOM_MESSAGE_RATE", 20),
+    getattr(settings, "CHAT_ROOM_MESSAGE_BURST", 50),
+)
+
+
+class SendRejected(Exception):
+    def __init__(self, code, retry_after):
+        super().__init__(f"{code}, retry after {retry_after:.1f}s")
+        self.code = code
+        self.retry_after = retry_after
+
+
+def slow_mode_seconds(conversation_id):
+    """A conversation's slow mode interval, cached briefly to keep it off the DB"""
+    from .models import Conversation
+
+    return cache.get_or_set(
+        f"chat:slow_mode:{conversation_id}",
+        lambda: Conversation.objects.filter(pk=conversation_id).values_list("slow_mode_seconds", flat=True).first()
+        or 0,
+        getattr(settings, "CHAT_SLOW_MODE_CACHE_SECONDS", 10),
+    )
+
+
+def check_message(conversation_id, user_id):
+    """Raise ``SendRejected`` if a new message would break slow mode or the room's rate"""
+    interval = slow_mode_seconds(conversation_id)
+    if interval and not cache.add(f"chat:slow:{conversation_id}:{user_id}", 1, interval):
+        raise SendRejected("slow_mode", interval)
+
+    retry_after = room_messages.hit(conversation_id)
+    if retry_after:
+        raise SendRejected("room_rate_limited", retry_after)
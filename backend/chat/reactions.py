@@ -0,0 +1,134 @@
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from config.profiling import span
+
+from . import sharding
+from .coalesce import CoalescingBuffer
+from .models import Reaction, ReactionCount
+from .versions import touch_conversation
+
+
+class ChangedCountsBuffer(CoalescingBuffer):
+    """Messages whose reaction counts changed since the last fan-out.
+
+    Keyed by message id with the conversation id as value, so any number of
+    toggles on one message collapse into a single count update.
+    """
+
+    def merge(self, current, update):
+        return current
+
+
+changed_counts = ChangedCountsBuffer(
+    flush_interval=getattr(settings, "CHAT_REACTION_FLUSH_INTERVAL", 0.5),
+    max_pending=getattr(settings, "CHAT_REACTION_BATCH_SIZE", 500),
+)
+
+
+def set_reaction(message, user, emoji, add=True):
+    """Add or remove one user's reaction; returns True if anything changed.
+
+    The reaction row and its counter move in the same transaction, and the
+    counter is adjusted with ``F()`` so concurrent toggles never lose updates.
+    """
+    with sharding.atomic(message.conversation_id) as using:
+        counts = ReactionCount.objects.filter(message=message, emoji=emoji)
+        if add:
+            try:
+                with transaction.atomic(using=using):
+                    Reaction.objects.create(message=message, user=user, emoji=emoji)
+            except IntegrityError:
+                return False
+            if not counts.update(count=F("count") + 1):
+                _, created = ReactionCount.objects.get_or_create(message=message, emoji=emoji, defaults={"count": 1})
+                if not created:
+                    counts.update(count=F("count") + 1)
+        else:
+            deleted, _ = Reaction.objects.filter(message=message, user=user, emoji=emoji).delete()
+            if not deleted:
+                return False
+            counts.filter(count__gt=0).update(count=F("count") - 1)
+            counts.filter(count=0).delete()
+
+        sharding.alongside(using, lambda: touch_conversation(message.conversation_id))
+        transaction.on_commit(lambda: changed_counts.add(message.id, message.conversation_id), using=using)
+    return True
+
+
+def counts_for(message_ids, using=None):
+    """``{message_id: {emoji: count}}`` for a whole page of messages in one query"""
+    counts = {}
+    rows = (
+        ReactionCount.objects.using(using).filter(message_id__in=message_ids, count__gt=0)
+        .order_by("message_id", "emoji")
+        .values_list("message_id", "emoji", "count")
+    )
+    for message_id, emoji, count in rows:
+        counts.setdefault(message_id, {})[emoji] = count
+    return counts
+
+
+def flush_reaction_counts():
+    """Read current totals for every changed message.
+
+    Returns ``{conversation_id: [{"message_id", "counts"}, ...]}``, one
+    aggregated update per conversation.
+    """
+    pending = changed_counts.drain()
+    if not pending:
+        return {}
+
+    # One query per shard holding any of the messages
+    by_shard = {}
+    for message_id, conversation_id in pending.items():
+        by_shard.setdefault(sharding.shard_for(conversation_id), []).append(message_id)
+    counts = {}
+    for using, message_ids in by_shard.items():
+        counts.update(counts_for(message_ids, using))
+    updates = {}
+    for message_id, conversation_id in pending.items():
+        updates.setdefault(conversation_id, []).append({
+            'message_id': message_id,
+            'counts': counts.get(message_id, {}),
+        })
+    return updates
+
+
+async def broadcast_reaction_counts(channel_layer, updates):
+    for conversation_id, messages in updates.items():
+        with span('group_send'):
+            await channel_layer.group_send(
+                f'chat_{conversation_id}',
+                {
+                    'type': 'reaction_counts',
+                    'messages': messages,
+                }
+            )
+
+
+async def flush_and_broadcast(channel_layer):
+    updates = await database_sync_to_async(flush_reaction_counts)()
+    await broadcast_reaction_counts(channel_layer, updates)
+
+
+def flush_and_broadcast_sync():
+    """Flush from synchronous code (REST views)"""
+    updates = flush_reaction_counts()
+    if updates:
+        async_to_sync(broadcast_reaction_counts)(get_channel_layer(), updates)
+    return updates
+
+
+def maybe_flush_sync():
+    """Flush from synchronous code if the buffer is due, otherwise on a timer"""
+    changed_counts.maybe_flush_sync(flush_and_broadcast_sync)
+
+
+async def maybe_flush(channel_layer):
+    """Flush now if the buffer is due, otherwise make sure a timed flush is pending"""
+    await changed_counts.maybe_flush(lambda: flush_and_broadcast(channel_layer))
@@ -0,0 +1,161 @@
+"""
+Moving a conversation's message history between shards while it stays in use.
+
+1. Copy every message to the target in primary-key batches. Reads and
+   writes continue on the source.
+2. Freeze the conversation in the directory. Writes are refused with
+   ``ShardMoving`` (503, or a ``moving`` socket error) for a few seconds.
+   Wait until every process's cached placement has expired and in-flight
+   transactions have finished (CHAT_SHARD_DIRECTORY_TTL +
+   CHAT_SHARD_MOVE_GRACE).
+3. Re-sync. Copy messages that are new, or whose version, reply summary or
+   deletion changed. Drop copies of rows removed since the first pass.
+   Replace reactions and counts, and move unpublished outbox events.
+4. Point the directory at the target and unfreeze.
+5. After another TTL, when no reader can still be on the source, delete the
+   source rows.
+
+Message ids are global (see chat/sharding.py), so rows keep their ids.
+Reactions, counts and outbox events get new ids on the target.
+"""
+
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from . import sharding
+from .bulk_delete import BulkDeleter
+from .models import ConversationShard, Message, OutboxEvent, Reaction, ReactionCount
+
+# Fields that change after a message is written; a difference means it must be copied again
+SIGNATURE_FIELDS = ("version", "reply_count", "last_reply_at", "deleted_at")
+
+
+@contextmanager
+def _original_timestamps(model):
+    """Keep copied ``auto_now_add`` values, which ``bulk_create`` would stamp with the current time.
+
+    This changes the field definitions while active, so it is only meant for
+    the process running the rebalance, not for a serving worker.
+    """
+    fields = [f for f in model._meta.concrete_fields if getattr(f, "auto_now_add", False)]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def _message_fields():
+    return [f.attname for f in Message._meta.concrete_fields]
+
+
+def _copy_messages(ids, source, target):
+    rows = Message.objects.using(source).filter(pk__in=ids).values(*_message_fields())
+    with _original_timestamps(Message):
+        Message.objects.using(target).bulk_create(
+            [Message(**row) for row in rows],
+            update_conflicts=True,
+            unique_fields=["id"],
+            update_fields=[name for name in _message_fields() if name != "id"],
+        )
+
+
+def sync_messages(conversation_id, source, target, batch_size=1000, pause=0.0):
+    """Make the target's copy of the conversation's messages match the source; returns rows copied"""
+    copied = 0
+    last_id = 0
+    source_messages = Message.objects.using(source).filter(conversation_id=conversation_id).order_by("id")
+    target_messages = Message.objects.using(target).filter(conversation_id=conversation_id)
+    while True:
+        batch = list(source_messages.filter(id__gt=last_id).values_list("id", *SIGNATURE_FIELDS)[:batch_size])
+        upper = batch[-1][0] if batch else None
+        in_range = target_messages.filter(id__gt=last_id)
+        if upper is not None:
+            in_range = in_range.filter(id__lte=upper)
+        existing = {row[0]: row for row in in_range.values_list("id", *SIGNATURE_FIELDS)}
+
+        changed = [row[0] for row in batch if existing.get(row[0]) != row]
+        if changed:
+            with transaction.atomic(using=target):
+                _copy_messages(changed, source, target)
+            copied += len(changed)
+        gone = existing.keys() - {row[0] for row in batch}
+        if gone:
+            BulkDeleter(using=target).delete([Message.objects.filter(pk__in=gone)])
+
+        if upper is None:
+            return copied
+        last_id = upper
+        if pause:
+            time.sleep(pause)
+
+
+def replace_reactions(conversation_id, source, target):
+    """Copy reactions and counts of the conversation's messages, replacing what the target has"""
+    for model in (Reaction, ReactionCount):
+        fields = [f.attname for f in model._meta.concrete_fields if not f.primary_key]
+        rows = model.objects.using(source).filter(message__conversation_id=conversation_id).values(*fields)
+        with transaction.atomic(using=target), _original_timestamps(model):
+            model.objects.using(target).filter(message__conversation_id=conversation_id).delete()
+            model.objects.using(target).bulk_create([model(**row) for row in rows], batch_size=1000)
+
+
+def move_outbox(conversation_id, source, target):
+    """Move unpublished events in order; one a dispatcher is publishing right now may go out twice"""
+    pending = OutboxEvent.objects.using(source).filter(conversation_id=conversation_id).order_by("id")
+    fields = [f.attname for f in OutboxEvent._meta.concrete_fields if not f.primary_key]
+    events = [OutboxEvent(**dict(row, claim_token=None, claimed_until=None)) for row in pending.values(*fields)]
+    if not events:
+        return 0
+    with transaction.atomic(using=target), _original_timestamps(OutboxEvent):
+        OutboxEvent.objects.using(target).bulk_create(events)
+    pending.delete()
+    return len(events)
+
+
+def _set_placement(conversation_id, alias, frozen):
+    ConversationShard.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        conversation_id=conversation_id, defaults={"alias": alias, "frozen": frozen}
+    )
+    sharding.forget(conversation_id)
+
+
+def move_conversation(conversation_id, target, batch_size=1000, pause=0.0, grace=None, progress=None):
+    """Move one conversation's history to the ``target`` shard; returns the number of messages moved"""
+    if target not in sharding.databases():
+        raise ValueError(f"{target} is not a message shard")
+    source, frozen = sharding.placement(conversation_id, fresh=True)
+    if frozen:
+        raise sharding.ShardMoving(f"Conversation {conversation_id} is already being moved")
+    if source == target:
+        return 0
+
+    report = progress or (lambda phase, count: None)
+    settle = getattr(settings, "CHAT_SHARD_DIRECTORY_TTL", 5) + (
+        grace if grace is not None else getattr(settings, "CHAT_SHARD_MOVE_GRACE", 2)
+    )
+
+    report("copy", sync_messages(conversation_id, source, target, batch_size, pause))
+
+    _set_placement(conversation_id, source, frozen=True)
+    try:
+        time.sleep(settle)
+        report("catch-up", sync_messages(conversation_id, source, target, batch_size))
+        replace_reactions(conversation_id, source, target)
+        report("outbox", move_outbox(conversation_id, source, target))
+    except BaseException:
+        _set_placement(conversation_id, source, frozen=False)
+        raise
+    _set_placement(conversation_id, target, frozen=False)
+
+    # Readers that resolved the old placement just before the switch finish on the source
+    time.sleep(settle)
+    stale = Message.objects.filter(conversation_id=conversation_id)
+    report("cleanup", stale.using(source).count())
+    BulkDeleter(using=source, batch_size=batch_size, pause=pause).delete([stale])
+    return Message.objects.using(target).filter(conversation_id=conversation_id).count()
@@ -0,0 +1,129 @@
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from config.profiling import span
+
+from .coalesce import CoalescingBuffer
+from .models import ReadCursor
+
+
+class ReadCursorBuffer(CoalescingBuffer):
+    """Pending (delivered, read) high-water marks keyed by (conversation_id, user_id)"""
+
+    def merge(self, current, update):
+        delivered = max(current[0], update[0])
+        read = max(current[1], update[1])
+        return (max(delivered, read), read)
+
+
+read_cursors = ReadCursorBuffer(
+    flush_interval=getattr(settings, "CHAT_READ_CURSOR_FLUSH_INTERVAL", 1.0),
+    max_pending=getattr(settings, "CHAT_READ_CURSOR_BATCH_SIZE", 500),
+)
+
+
+def record(conversation_id, user_id, read_up_to=0, delivered_up_to=0):
+    """Queue a cursor update; reading a message implies it was delivered"""
+    read_cursors.add(
+        (int(conversation_id), int(user_id)),
+        (max(delivered_up_to, read_up_to), read_up_to),
+    )
+
+
+def flush_read_cursors():
+    """Upsert every pending cursor that moves forward.
+
+    Returns ``{conversation_id: [cursor, ...]}`` for the cursors that changed,
+    ready to be fanned out as one aggregated event per conversation.
+    """
+    pending = read_cursors.drain()
+    if not pending:
+        return {}
+
+    updates = {}
+    items = list(pending.items())
+    size = read_cursors.max_pending
+    for start in range(0, len(items), size):
+        for conversation_id, user_id, delivered, read in write_cursors(items[start:start + size]):
+            updates.setdefault(conversation_id, []).append({
+                'user_id': user_id,
+                'delivered_up_to': delivered,
+                'read_up_to': read,
+            })
+    return updates
+
+
+def write_cursors(items):
+    """Upsert ``[((conversation_id, user_id), (delivered, read)), ...]`` in one statement.
+
+    The database keeps the larger of the stored and the new value, so
+    concurrent flushes (other workers, the timer thread) never move a cursor
+    back, whichever commits last. Returns the rows that moved as
+    ``(conversation_id, user_id, delivered, read)``.
+    """
+    connection = connections[router.db_for_write(ReadCursor)]
+    quote = connection.ops.quote_name
+    table = quote(ReadCursor._meta.db_table)
+    delivered_column = quote("last_delivered_message_id")
+    read_column = quote("last_read_message_id")
+    greatest = "MAX" if connection.vendor == "sqlite" else "GREATEST"
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+
+    values = ", ".join(["(%s, %s, %s, %s, %s)"] * len(items))
+    params = []
+    for (conversation_id, user_id), (delivered, read) in items:
+        params += [conversation_id, user_id, delivered, read, now]
+    sql = (
+        f"INSERT INTO {table} (conversation_id, user_id, {delivered_column}, {read_column}, updated_at) "
+        f"VALUES {values} "
+        f"ON CONFLICT (conversation_id, user_id) DO UPDATE SET "
+        f"{delivered_column} = {greatest}({table}.{delivered_column}, EXCLUDED.{delivered_column}), "
+        f"{read_column} = {greatest}({table}.{read_column}, EXCLUDED.{read_column}), "
+        f"updated_at = EXCLUDED.updated_at "
+        f"WHERE {table}.{delivered_column} < EXCLUDED.{delivered_column} "
+        f"OR {table}.{read_column} < EXCLUDED.{read_column} "
+        f"RETURNING conversation_id, user_id, {delivered_column}, {read_column}"
+    )
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+async def broadcast_receipts(channel_layer, updates):
+    """Send one "read up to" event per conversation, however many readers moved"""
+    for conversation_id, cursors in updates.items():
+        with span('group_send'):
+            await channel_layer.group_send(
+                f'chat_{conversation_id}',
+                {
+                    'type': 'read_receipt',
+                    'cursors': cursors,
+                }
+            )
+
+
+async def flush_and_broadcast(channel_layer):
+    updates = await database_sync_to_async(flush_read_cursors)()
+    await broadcast_receipts(channel_layer, updates)
+
+
+def flush_and_broadcast_sync():
+    """Flush from synchronous code (REST views, management commands)"""
+    updates = flush_read_cursors()
+    if updates:
+        async_to_sync(broadcast_receipts)(get_channel_layer(), updates)
+    return updates
+
+
+def maybe_flush_sync():
+    """Flush from synchronous code if the buffer is due, otherwise on a timer"""
+    read_cursors.maybe_flush_sync(flush_and_broadcast_sync)
+
+
+async def maybe_flush(channel_layer):
+    """Flush now if the buffer is due, otherwise make sure a timed flush is pending"""
+    await read_cursors.maybe_flush(lambda: flush_and_broadcast(channel_layer))
@@ -0,0 +1,162 @@
+import gzip
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import sharding
+from .bulk_delete import BulkDeleter
+from .models import ArchivedMessage, Conversation, Message, RetentionPolicy
+from .versions import touch_conversation
+
+
+def effective_policies(conversation_id=None):
+    """Yield ``(conversation_id, keep_days, action)`` for every conversation with a retention rule"""
+    default_days = getattr(settings, "CHAT_DEFAULT_RETENTION_DAYS", None)
+    default_action = getattr(settings, "CHAT_DEFAULT_RETENTION_ACTION", RetentionPolicy.ACTION_ARCHIVE)
+
+    if default_days is None:
+        policies = RetentionPolicy.objects.order_by("conversation_id")
+        if conversation_id is not None:
+            policies = policies.filter(conversation_id=conversation_id)
+        for policy in policies.iterator():
+            yield policy.conversation_id, policy.keep_days, policy.action
+        return
+
+    conversations = Conversation.objects.order_by("id").values_list(
+        "id", "retention_policy__keep_days", "retention_policy__action"
+    )
+    if conversation_id is not None:
+        conversations = conversations.filter(id=conversation_id)
+    for cid, keep_days, action in conversations.iterator():
+        if keep_days is None:
+            yield cid, default_days, default_action
+        else:
+            yield cid, keep_days, action
+
+
+def expire_conversation(conversation_id, keep_days, action, batch_size=None, pause=0.0, dry_run=False):
+    """Archive or delete messages older than ``keep_days`` in one conversation.
+
+    Walks the expired rows by primary key in bounded batches, each in its own
+    short transaction, so no lock is held for longer than a single batch.
+    Yields the number of rows handled per batch.
+    """
+    batch_size = batch_size or getattr(settings, "CHAT_RETENTION_BATCH_SIZE", 1000)
+    cutoff = timezone.now() - timedelta(days=keep_days)
+    using = sharding.shard_for(conversation_id)
+    expired = (
+        Message.objects.using(using).filter(conversation_id=conversation_id, created_at__lt=cutoff).order_by("id")
+    )
+
+    if dry_run:
+        yield expired.count()
+        return
+
+    deleter = BulkDeleter(using=using, batch_size=batch_size)
+    last_id = 0
+    while True:
+        with sharding.atomic(conversation_id):
+            rows = list(
+                expired.filter(id__gt=last_id).values(
+                    "id", "conversation_id", "sender_id", "content", "created_at"
+                )[:batch_size]
+            )
+            if not rows:
+                return
+            ids = [row["id"] for row in rows]
+            if action == RetentionPolicy.ACTION_ARCHIVE:
+                # Archived copies stay on default; ignore_conflicts makes a
+                # batch that fails after archiving safe to archive again
+                ArchivedMessage.objects.bulk_create(
+                    [ArchivedMessage(**row) for row in rows],
+                    ignore_conflicts=True,
+                )
+            deleter.delete([Message.objects.filter(pk__in=ids)])
+            sharding.alongside(using, lambda ids=ids: sharding.delete_attachments(using, ids))
+            sharding.alongside(using, lambda: touch_conversation(conversation_id))
+
+        last_id = ids[-1]
+        yield len(ids)
+        if pause:
+            time.sleep(pause)
+
+
+class _ArchiveWriter:
+    """Appends JSONL rows to gzip files, one per conversation and month.
+
+    Only a bounded number of files stay open; appending to gzip creates a new
+    member, which readers decompress as one continuous stream.
+    """
+
+    def __init__(self, directory, max_open=32):
+        self.directory = directory
+        self.max_open = max_open
+        self._files = OrderedDict()
+        self.paths = set()
+
+    def write(self, row):
+        key = (row["conversation_id"], row["created_at"].strftime("%Y-%m"))
+        handle = self._files.pop(key, None)
+        if handle is None:
+            folder = os.path.join(self.directory, f"conversation_{key[0]}")
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, f"{key[1]}.jsonl.gz")
+            handle = gzip.open(path, "at", encoding="utf-8")
+            self.paths.add(path)
+            if len(self._files) >= self.max_open:
+                self._files.popitem(last=False)[1].close()
+        self._files[key] = handle
+
+        row = dict(row, created_at=row["created_at"].isoformat())
+        handle.write(json.dumps(row, ensure_ascii=False))
+        handle.write("\n")
+
+    def close(self):
+        while self._files:
+            self._files.popitem()[1].close()
+
+
+def export_archive(directory=None, conversation_id=None, chunk_size=None, purge=False):
+    """Stream archived messages that have not been exported yet to compressed JSONL files.
+
+    Rows are read in keyset chunks and marked exported (or purged) once the
+    chunk has been written, so an interrupted run resumes where it stopped.
+    Yields ``(rows_in_chunk, paths_written_so_far)``.
+    """
+    directory = directory or getattr(settings, "CHAT_ARCHIVE_EXPORT_DIR")
+    chunk_size = chunk_size or getattr(settings, "CHAT_RETENTION_BATCH_SIZE", 1000)
+
+    pending = ArchivedMessage.objects.filter(exported_at__isnull=True).order_by("id")
+    if conversation_id is not None:
+        pending = pending.filter(conversation_id=conversation_id)
+
+    writer = _ArchiveWriter(directory)
+    last_id = 0
+    try:
+        while True:
+            rows = list(
+                pending.filter(id__gt=last_id).values(
+                    "id", "conversation_id", "sender_id", "content", "created_at"
+                )[:chunk_size]
+            )
+            if not rows:
+                return
+            for row in rows:
+                writer.write(row)
+            writer.close()
+
+            ids = [row["id"] for row in rows]
+            exported = ArchivedMessage.objects.filter(pk__in=ids)
+            if purge:
+                exported.delete()
+            else:
+                exported.update(exported_at=timezone.now())
+            last_id = ids[-1]
+            yield len(ids), writer.paths
+    finally:
+        writer.close()
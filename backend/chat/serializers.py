@@ -1,7 +1,12 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 
-from .models import Conversation, Message
+from django.conf import settings
+from django.urls import reverse
+
+from .reactions import counts_for
+from .services import create_message
+from .models import Attachment, Conversation, Message, ReadCursor, UploadSession
 
 
 User = get_user_model()
@@ -13,13 +18,125 @@ class UserSlimSerializer(serializers.ModelSerializer):
         fields = ["id", "username", "display_name"]
 
 
+class AttachmentSerializer(serializers.ModelSerializer):
+    size = serializers.IntegerField(source="blob.size", read_only=True)
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Attachment
+        fields = ["id", "filename", "content_type", "size", "url", "created_at"]
+
+    def get_url(self, obj):
+        return reverse("attachment_download", kwargs={"pk": obj.pk})
+
+
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserSlimSerializer(read_only=True)
+    attachments = AttachmentSerializer(many=True, read_only=True)
+    attachment_ids = serializers.ListField(
+        child=serializers.IntegerField(), write_only=True, required=False
+    )
+    client_msg_id = serializers.CharField(max_length=64, required=False, allow_null=True)
+    reactions = serializers.SerializerMethodField()
+    parent = serializers.PrimaryKeyRelatedField(queryset=Message.objects.all(), required=False, allow_null=True)
 
     class Meta:
         model = Message
-        fields = ["id", "conversation", "sender", "content", "created_at"]
-        read_only_fields = ["id", "sender", "conversation", "created_at"]
+        fields = [
+            "id",
+            "conversation",
+            "sender",
+            "content",
+            "attachments",
+            "attachment_ids",
+            "reactions",
+            "client_msg_id",
+            "parent",
+            "thread_root",
+            "reply_count",
+            "last_reply_at",
+            "created_at",
+            "version",
+            "edited_at",
+            "deleted_at",
+        ]
+        read_only_fields = [
+            "id",
+            "sender",
+            "conversation",
+            "thread_root",
+            "reply_count",
+            "last_reply_at",
+            "created_at",
+            "version",
+            "edited_at",
+            "deleted_at",
+        ]
+        # Duplicate client_msg_ids are answered with the original message, not rejected
+        validators = []
+        extra_kwargs = {"content": {"max_length": getattr(settings, "CHAT_MAX_MESSAGE_LENGTH", 4000)}}
+
+    def create(self, validated_data):
+        message, self.created = create_message(
+            conversation=validated_data["conversation"],
+            sender=validated_data["sender"],
+            content=validated_data["content"],
+            attachment_ids=validated_data.get("attachment_ids"),
+            client_msg_id=validated_data.get("client_msg_id"),
+            parent=validated_data.get("parent"),
+        )
+        return message
+
+    def validate_parent(self, parent):
+        view = self.context.get("view")
+        if parent is not None and view is not None and parent.conversation_id != int(view.kwargs["conversation_id"]):
+            raise serializers.ValidationError("Replies must be in the same conversation")
+        return parent
+
+    def get_reactions(self, obj):
+        # List views load counts for the whole page up front
+        counts = self.context.get("reaction_counts")
+        if counts is None:
+            counts = counts_for([obj.id])
+        return counts.get(obj.id, {})
+
+
+class ReactionSerializer(serializers.Serializer):
+    emoji = serializers.CharField(max_length=32)
+
+
+class MessageEditSerializer(serializers.Serializer):
+    content = serializers.CharField(max_length=getattr(settings, "CHAT_MAX_MESSAGE_LENGTH", 4000))
+    # Version the client last saw; the edit is rejected if the message moved on
+    version = serializers.IntegerField(required=False, min_value=1)
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    offset = serializers.IntegerField(source="received", read_only=True)
+    attachment = AttachmentSerializer(read_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = ["id", "filename", "content_type", "size", "offset", "attachment", "created_at"]
+        read_only_fields = ["id", "created_at"]
+
+    def validate_size(self, value):
+        max_size = getattr(settings, "CHAT_ATTACHMENT_MAX_SIZE", 100 * 1024 * 1024)
+        if value <= 0 or value > max_size:
+            raise serializers.ValidationError(f"Size must be between 1 and {max_size} bytes")
+        return value
+
+
+class ReadCursorSerializer(serializers.ModelSerializer):
+    user = UserSlimSerializer(read_only=True)
+
+    class Meta:
+        model = ReadCursor
+        fields = ["user", "last_delivered_message_id", "last_read_message_id", "updated_at"]
+
+
+class ReadCursorUpdateSerializer(serializers.Serializer):
+    up_to = serializers.IntegerField(min_value=1)
 
 
 class ConversationSerializer(serializers.ModelSerializer):
@@ -37,9 +154,10 @@ class ConversationSerializer(serializers.ModelSerializer):
             "display_title",
             "participants",
             "participant_ids",
+            "slow_mode_seconds",
             "created_at",
         ]
-        read_only_fields = ["id", "created_at"]
+        read_only_fields = ["id", "slow_mode_seconds", "created_at"]
 
     def get_display_title(self, obj):
         """Get the appropriate title for the current user"""
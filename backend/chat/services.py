@@ -0,0 +1,156 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from . import sharding
+from .attachments import attachment_metadata, link_attachments
+from .models import Attachment, Message, OutboxEvent
+from .versions import touch_conversation
+
+
+def message_event(message, attachments=()):
+    """Channel-layer event announcing a new message to ``chat_<conversation_id>``"""
+    sender = message.sender
+    return {
+        'type': 'chat_message',
+        'message': message.content,
+        'user_id': sender.id,
+        'username': sender.username,
+        'display_name': getattr(sender, 'display_name', sender.username),
+        'message_id': message.id,
+        'timestamp': message.created_at.isoformat(),
+        'client_msg_id': message.client_msg_id,
+        'parent_id': message.parent_id,
+        'thread_root_id': message.thread_root_id,
+        'attachments': [attachment_metadata(a) for a in attachments],
+    }
+
+
+class MessageConflict(Exception):
+    """The message was deleted, or changed since the version the client saw"""
+
+
+def _client_msg_key(conversation_id, sender_id, client_msg_id):
+    return f"chat:client_msg:{conversation_id}:{sender_id}:{client_msg_id}"
+
+
+def recent_send(conversation_id, sender_id, client_msg_id):
+    """``{"message_id", "timestamp"}`` of a send to this conversation seen recently, from the cache only"""
+    return cache.get(_client_msg_key(conversation_id, sender_id, client_msg_id))
+
+
+def remember_send(message):
+    cache.set(
+        _client_msg_key(message.conversation_id, message.sender_id, message.client_msg_id),
+        {'message_id': message.id, 'timestamp': message.created_at.isoformat()},
+        getattr(settings, "CHAT_CLIENT_MSG_ID_TTL", 600),
+    )
+
+
+def create_message(conversation, sender, content, attachment_ids=None, client_msg_id=None, parent=None):
+    """The single write path for new messages, used by REST and WebSocket alike.
+
+    The message and its outbox event commit together on the conversation's
+    shard, so an event is published if and only if the message exists.
+    Publishing is left to the outbox dispatcher.
+
+    Returns ``(message, created)``. A repeated ``client_msg_id`` from the same
+    sender in the same conversation returns the original message without
+    inserting or publishing again; recent ids are answered from the cache,
+    older ones by the unique constraint.
+
+    A ``parent`` makes the message a reply; it joins the parent's thread and
+    bumps the reply count and last-reply time on the thread root.
+    """
+    with sharding.for_conversation(conversation.id):
+        if client_msg_id:
+            seen = recent_send(conversation.id, sender.id, client_msg_id)
+            if seen is not None:
+                return Message.objects.prefetch_related("sender").get(pk=seen['message_id']), False
+
+        try:
+            with sharding.atomic(conversation.id) as using:
+                message = Message.objects.create(
+                    conversation=conversation,
+                    sender=sender,
+                    content=content,
+                    client_msg_id=client_msg_id or None,
+                    parent=parent,
+                    thread_root_id=(parent.thread_root_id or parent.id) if parent else None,
+                )
+                if parent:
+                    Message.objects.filter(pk=message.thread_root_id).update(
+                        reply_count=F("reply_count") + 1,
+                        last_reply_at=message.created_at,
+                    )
+                attachments = link_attachments(message, attachment_ids)
+                OutboxEvent.objects.create(conversation=conversation, payload=message_event(message, attachments))
+                sharding.alongside(using, lambda: touch_conversation(conversation.id))
+        except IntegrityError:
+            if not client_msg_id:
+                raise
+            message = Message.objects.prefetch_related("sender").filter(
+                conversation=conversation, sender=sender, client_msg_id=client_msg_id
+            ).first()
+            if message is None:
+                # The error was not a repeated send, e.g. a missing parent
+                raise
+            remember_send(message)
+            return message, False
+
+    if client_msg_id:
+        remember_send(message)
+    return message, True
+
+
+def _change_message(message, user, expected_version, changes, event):
+    """Apply a versioned change to a live message and queue its delta event"""
+    with sharding.atomic(message.conversation_id) as using:
+        live = Message.objects.filter(pk=message.pk, sender=user, deleted_at__isnull=True)
+        if expected_version is not None:
+            live = live.filter(version=expected_version)
+        if not live.update(version=F("version") + 1, **changes):
+            raise MessageConflict(f"Message {message.pk} was deleted or has changed")
+        message.refresh_from_db(fields=["content", "version", "edited_at", "deleted_at"])
+        OutboxEvent.objects.create(conversation_id=message.conversation_id, payload=event(message))
+        sharding.alongside(using, lambda: touch_conversation(message.conversation_id))
+    return message
+
+
+def edit_message(message, user, content, expected_version=None):
+    """Replace a message's content; only its sender may edit it"""
+    return _change_message(
+        message,
+        user,
+        expected_version,
+        {"content": content, "edited_at": timezone.now()},
+        lambda m: {
+            'type': 'message_update',
+            'message_id': m.id,
+            'version': m.version,
+            'message': m.content,
+            'edited_at': m.edited_at.isoformat(),
+        },
+    )
+
+
+def delete_message(message, user, expected_version=None):
+    """Turn a message into a tombstone and drop its attachments"""
+    message = _change_message(
+        message,
+        user,
+        expected_version,
+        {"content": "", "deleted_at": timezone.now()},
+        lambda m: {
+            'type': 'message_delete',
+            'message_id': m.id,
+            'version': m.version,
+            'deleted_at': m.deleted_at.isoformat(),
+        },
+    )
+    if Attachment.objects.filter(message=message).delete()[0]:
+        # Pages cached since the tombstone committed still list the attachments
+        touch_conversation(message.conversation_id)
+    return message
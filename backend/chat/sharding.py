@@ -0,0 +1,390 @@
+"""
+Opt-in sharding of message history by conversation.
+
+With CHAT_MESSAGE_SHARDS set (database aliases, usually ``default`` plus one
+or more ``shard_N``), a conversation's messages, reactions, reaction counts
+and outbox events live on one shard. Users, conversations, attachments and
+everything else stay on ``default``.
+
+Placement is a directory table, ``ConversationShard``. A new conversation is
+assigned a shard by a stable hash of its id, and keeps it until
+``manage.py rebalance_shards`` moves it. Conversations without an entry
+(created before sharding was enabled) are on ``default``. Lookups are cached
+in each process for CHAT_SHARD_DIRECTORY_TTL seconds.
+
+Foreign keys that may cross databases (``CROSS_DATABASE_FOREIGN_KEYS``) are
+enforced only while sharding is off; a database migrated before sharding was
+enabled has them dropped by its next ``migrate``.
+
+Routing uses the conversation bound with ``for_conversation`` (or ``begin``
+for a WebSocket consumer), or the conversation or message a query starts
+from. Message writes go through ``atomic`` so they commit on the right
+database. Joins from sharded tables to users or conversations are not
+possible, so senders are loaded with ``prefetch_related``.
+
+New messages get snowflake ids (time, worker, sequence) so ids stay unique
+across shards and still sort by time. Each process needs its own worker id:
+CHAT_SNOWFLAKE_WORKER_ID, or a lease on a free one in the shared cache that
+expires CHAT_SNOWFLAKE_LEASE_SECONDS after the process stops using it. They stay below 2**53, so JavaScript
+clients read them exactly. Do not turn sharding off again once new ids have
+been issued: the old sequence would hand out smaller ids than existing
+messages.
+"""
+
+import atexit
+import contextvars
+import os
+import random
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core import checks
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.exceptions import APIException
+
+from .bulk_delete import BulkDeleter, counted_messages, rebuild_counters
+from .models import Attachment, Conversation, ConversationShard, Message, OutboxEvent, Reaction
+
+SHARDED_MODELS = {"chat.Message", "chat.Reaction", "chat.ReactionCount", "chat.OutboxEvent"}
+# Foreign keys whose two ends may be on different databases once sharding is on
+CROSS_DATABASE_FOREIGN_KEYS = [
+    (Message, "conversation"),
+    (Message, "sender"),
+    (Reaction, "user"),
+    (Attachment, "message"),
+    (OutboxEvent, "conversation"),
+]
+
+_conversation = contextvars.ContextVar("shard_conversation", default=None)
+
+
+class ShardMoving(APIException):
+    """The conversation is frozen for the last step of a rebalance; writes can be retried shortly"""
+
+    status_code = 503
+    default_detail = "This conversation is being moved, try again in a moment."
+    default_code = "moving"
+    wait = 1
+
+
+def shards():
+    return list(getattr(settings, "CHAT_MESSAGE_SHARDS", []))
+
+
+def enabled():
+    return bool(shards())
+
+
+def databases():
+    """Every database that may hold sharded rows, ``default`` first"""
+    return list(dict.fromkeys([DEFAULT_DB_ALIAS, *shards()]))
+
+
+def choose_shard(conversation_id):
+    """Stable shard for a new conversation"""
+    aliases = shards()
+    return aliases[zlib.crc32(str(conversation_id).encode()) % len(aliases)]
+
+
+# Directory
+
+_placements = {}
+_placements_lock = threading.Lock()
+MAX_CACHED_PLACEMENTS = 10000
+
+
+def placement(conversation_id, fresh=False):
+    """``(alias, frozen)`` for a conversation, cached for CHAT_SHARD_DIRECTORY_TTL seconds"""
+    conversation_id = int(conversation_id)
+    now = time.monotonic()
+    if not fresh:
+        cached = _placements.get(conversation_id)
+        if cached is not None and cached[2] > now:
+            return cached[0], cached[1]
+
+    # Always the primary: a lagging replica would not know a new placement yet
+    row = (
+        ConversationShard.objects.using(DEFAULT_DB_ALIAS)
+        .filter(conversation_id=conversation_id)
+        .values_list("alias", "frozen")
+        .first()
+    )
+    alias, frozen = row or (DEFAULT_DB_ALIAS, False)
+    with _placements_lock:
+        if len(_placements) >= MAX_CACHED_PLACEMENTS:
+            _placements.clear()
+        _placements[conversation_id] = (alias, frozen, now + getattr(settings, "CHAT_SHARD_DIRECTORY_TTL", 5))
+    return alias, frozen
+
+
+def shard_for(conversation_id, writing=False):
+    """Database alias holding a conversation's messages; raises ShardMoving for writes while frozen"""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    alias, frozen = placement(conversation_id)
+    if writing and frozen:
+        raise ShardMoving()
+    return alias
+
+
+def forget(conversation_id):
+    with _placements_lock:
+        _placements.pop(int(conversation_id), None)
+
+
+# Routing context
+
+def begin(conversation_id):
+    """Route sharded queries to ``conversation_id``'s shard; returns a token for ``end``"""
+    return _conversation.set(int(conversation_id))
+
+
+def end(token):
+    _conversation.reset(token)
+
+
+@contextmanager
+def for_conversation(conversation_id):
+    token = begin(conversation_id)
+    try:
+        yield
+    finally:
+        end(token)
+
+
+@contextmanager
+def atomic(conversation_id):
+    """A transaction on the conversation's shard, with queries routed there; yields the alias"""
+    with for_conversation(conversation_id):
+        using = shard_for(conversation_id, writing=True)
+        with transaction.atomic(using=using):
+            yield using
+
+
+def alongside(using, func):
+    """Run a write to ``default`` that belongs with the current shard transaction.
+
+    On ``default`` it joins that transaction. On another shard it runs once
+    the shard commits, so the default database never announces a change
+    (e.g. a new conversation version) before it is visible.
+    """
+    if using == DEFAULT_DB_ALIAS:
+        func()
+    else:
+        transaction.on_commit(func, using=using)
+
+
+class ShardRouter:
+    """Database router for sharded message tables; a no-op unless CHAT_MESSAGE_SHARDS is set.
+
+    Goes before ``config.db_router.ReplicaRouter``, which still handles
+    everything that is not sharded.
+    """
+
+    def _route(self, model, hints, writing):
+        if not enabled():
+            return None
+        instance = hints.get("instance")
+        if model._meta.label not in SHARDED_MODELS:
+            # Related users and attachments of a sharded row live on default
+            if instance is not None and instance._state.db not in (None, DEFAULT_DB_ALIAS) and (
+                instance._meta.label in SHARDED_MODELS
+            ):
+                return DEFAULT_DB_ALIAS
+            return None
+        if instance is not None:
+            if instance._meta.label in SHARDED_MODELS and instance._state.db:
+                return instance._state.db
+            if isinstance(instance, Conversation):
+                return shard_for(instance.pk, writing)
+        conversation_id = _conversation.get()
+        if conversation_id is None:
+            return None
+        return shard_for(conversation_id, writing)
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints, writing=False)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints, writing=True)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if enabled() and SHARDED_MODELS & {obj1._meta.label, obj2._meta.label}:
+            return True
+        return None
+
+
+# Snowflake ids: 41 bits of milliseconds since EPOCH_MS, 6 bits of worker and
+# 6 bits of sequence, 53 bits in total
+
+EPOCH_MS = 1704067200000  # 2024-01-01
+WORKER_BITS = 6
+SEQUENCE_BITS = 6
+
+_id_lock = threading.Lock()
+_worker = None
+_lease_owner = None
+_leased_at = 0.0
+_last_ms = 0
+_sequence = 0
+
+
+def _lease_key(worker):
+    return f"chat:snowflake:worker:{worker}"
+
+
+def _shared_cache():
+    backend = settings.CACHES["default"]["BACKEND"].lower()
+    return "locmem" not in backend and "dummy" not in backend
+
+
+def _lease_worker(ttl):
+    """Claim a free worker id in the shared cache for ``ttl`` seconds"""
+    global _lease_owner
+    if not _shared_cache():
+        raise ImproperlyConfigured(
+            "Sharded message ids need CHAT_SNOWFLAKE_WORKER_ID or a cache shared by all workers"
+        )
+    _lease_owner = f"{os.getpid()}:{random.getrandbits(64):x}"
+    start = random.randrange(1 << WORKER_BITS)
+    for offset in range(1 << WORKER_BITS):
+        worker = (start + offset) % (1 << WORKER_BITS)
+        if cache.add(_lease_key(worker), _lease_owner, ttl):
+            return worker
+    raise ImproperlyConfigured(f"All {1 << WORKER_BITS} snowflake worker ids are leased")
+
+
+def _worker_id():
+    """CHAT_SNOWFLAKE_WORKER_ID, else a worker id leased from the cache and renewed while in use"""
+    global _worker, _leased_at
+    configured = getattr(settings, "CHAT_SNOWFLAKE_WORKER_ID", None)
+    if configured is not None:
+        if not 0 <= configured < 1 << WORKER_BITS:
+            raise ImproperlyConfigured(f"CHAT_SNOWFLAKE_WORKER_ID must be between 0 and {(1 << WORKER_BITS) - 1}")
+        return configured
+
+    ttl = getattr(settings, "CHAT_SNOWFLAKE_LEASE_SECONDS", 60)
+    age = time.monotonic() - _leased_at
+    if _worker is not None and age < ttl / 3:
+        return _worker
+    # Within two thirds of the TTL nobody else can have taken the id, so
+    # extending it is safe; after that it may have expired and been reused
+    if _worker is None or age >= ttl * 2 / 3 or not cache.touch(_lease_key(_worker), ttl):
+        _worker = _lease_worker(ttl)
+    _leased_at = time.monotonic()
+    return _worker
+
+
+@atexit.register
+def _release_worker():
+    if _worker is not None and _lease_owner is not None and cache.get(_lease_key(_worker)) == _lease_owner:
+        cache.delete(_lease_key(_worker))
+
+
+@checks.register()
+def check_worker_id(app_configs, **kwargs):
+    if not enabled() or getattr(settings, "CHAT_SNOWFLAKE_WORKER_ID", None) is not None or _shared_cache():
+        return []
+    return [checks.Error(
+        "Sharding is on, but workers cannot get distinct snowflake worker ids from a per-process cache.",
+        hint="Set CHAT_SNOWFLAKE_WORKER_ID (0-63) per process, or configure a shared cache.",
+        id="chat.E001",
+    )]
+
+
+def next_id():
+    global _last_ms, _sequence
+    with _id_lock:
+        worker = _worker_id()
+        # Never step back, even if the clock does
+        now = max(int(time.time() * 1000) - EPOCH_MS, _last_ms)
+        if now == _last_ms:
+            _sequence = (_sequence + 1) % (1 << SEQUENCE_BITS)
+            if _sequence == 0:
+                # Sequence exhausted: borrow the next millisecond
+                now += 1
+        else:
+            _sequence = 0
+        _last_ms = now
+        return (now << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | _sequence
+
+
+@receiver(pre_save, sender=Message)
+def assign_message_id(sender, instance, **kwargs):
+    if instance.pk is None and enabled():
+        instance.pk = next_id()
+
+
+@receiver(post_save, sender=Conversation)
+def place_conversation(sender, instance, created, **kwargs):
+    if created and enabled():
+        ConversationShard.objects.using(DEFAULT_DB_ALIAS).create(
+            conversation_id=instance.pk, alias=choose_shard(instance.pk)
+        )
+
+
+@receiver(pre_delete, sender=Conversation)
+def purge_conversation(sender, instance, **kwargs):
+    """Cascades only reach rows on default; clear the conversation's shard as well"""
+    alias = shard_for(instance.pk)
+    if alias != DEFAULT_DB_ALIAS:
+        Message.objects.using(alias).filter(conversation_id=instance.pk).delete()
+        OutboxEvent.objects.using(alias).filter(conversation_id=instance.pk).delete()
+    forget(instance.pk)
+
+
+@receiver(pre_delete, sender=get_user_model())
+def purge_user_messages(sender, instance, **kwargs):
+    """Cascades only reach rows on default; clear the user's messages and reactions on the shards.
+
+    Their attachments go with the user on default. The reply and reaction
+    counters they fed are recounted once the user is gone.
+    """
+    instance._counted_messages = {alias: counted_messages([instance.pk], using=alias) for alias in databases()}
+    for alias in databases():
+        if alias != DEFAULT_DB_ALIAS:
+            BulkDeleter(using=alias).delete([
+                Message.objects.filter(sender_id=instance.pk),
+                Reaction.objects.filter(user_id=instance.pk),
+            ])
+
+
+@receiver(post_delete, sender=get_user_model())
+def recount_after_user(sender, instance, **kwargs):
+    for alias, message_ids in instance.__dict__.pop("_counted_messages", {}).items():
+        rebuild_counters(using=alias, message_ids=message_ids)
+
+
+def delete_attachments(using, message_ids):
+    """Delete the attachments of messages just deleted on ``using``.
+
+    Attachments stay on default, so a cascade run on another shard misses them.
+    """
+    if using != DEFAULT_DB_ALIAS and message_ids:
+        BulkDeleter().delete([Attachment.objects.filter(message_id__in=message_ids)])
+
+
+@receiver(post_migrate)
+def drop_cross_database_constraints(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """Drop foreign keys created before sharding was enabled; they would reject rows on other shards"""
+    if sender.label != "chat" or not enabled():
+        return
+    connection = connections[using]
+    if connection.vendor == "sqlite":
+        # No ALTER TABLE ... DROP CONSTRAINT; SQLite databases are recreated instead
+        return
+    with connection.cursor() as cursor, connection.schema_editor() as editor:
+        for model, name in CROSS_DATABASE_FOREIGN_KEYS:
+            column = model._meta.get_field(name).column
+            constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+            for constraint, details in constraints.items():
+                if details["foreign_key"] and details["columns"] == [column]:
+                    editor.execute(editor._delete_fk_sql(model, constraint))
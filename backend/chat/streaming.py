@@ -0,0 +1,74 @@
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+
+STREAM_BUFFER_SIZE = 64 * 1024
+
+
+def is_asgi(request):
+    """True when the request is served by the ASGI handler"""
+    return isinstance(getattr(request, "_request", request), ASGIRequest)
+
+
+def buffered(chunks, size=STREAM_BUFFER_SIZE):
+    """Join small byte chunks into writes of roughly ``size`` bytes"""
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= size:
+            yield b"".join(pending)
+            pending = []
+            pending_size = 0
+    if pending:
+        yield b"".join(pending)
+
+
+def gzipped(chunks, level=6):
+    """Compress a byte stream incrementally into a single gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _take(iterator, count):
+    items = []
+    for item in iterator:
+        items.append(item)
+        if len(items) >= count:
+            break
+    return items
+
+
+async def aiter_sync(iterable, batch=16):
+    """Consume a blocking iterator from async code without materialising it.
+
+    StreamingHttpResponse under ASGI reads synchronous iterators into memory in
+    one go; this pulls a few items at a time on the request's sync thread, so
+    database cursors opened by the iterator stay on a single connection.
+    """
+    iterator = iter(iterable)
+    take = sync_to_async(_take, thread_sensitive=True)
+    try:
+        while True:
+            items = await take(iterator, batch)
+            if not items:
+                return
+            for item in items:
+                yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await sync_to_async(close, thread_sensitive=True)()
+
+
+def streaming_body(request, chunks):
+    """Return ``chunks`` in the form the current handler streams without buffering"""
+    if is_asgi(request):
+        return aiter_sync(chunks)
+    return chunks
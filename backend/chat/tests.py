@@ -1,3 +1,732 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import tempfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.http import HttpResponse, StreamingHttpResponse
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connections
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from config import db_router, profiling
+from config.compression_middleware import CompressionMiddleware
+
+from . import attachments, drain, notifications, receipts, sharding
+from .codecs import JsonCodec, MsgpackCodec, msgpack
+from .consumers import ChatConsumer
+from .models import (
+    Attachment,
+    Conversation,
+    Message,
+    OutboxEvent,
+    Reaction,
+    ReactionCount,
+    ReadCursor,
+    RetentionPolicy,
+    StoredFile,
+    UploadSession,
+)
+from .outbox import OutboxDispatcher
+from .rebalance import move_conversation
+from .reactions import set_reaction
+from .retention import expire_conversation
+from .services import create_message
+from .protocol import FrameError, validate_frame
+
+
+class ValidateFrameTests(SimpleTestCase):
+    def test_missing_type_defaults_to_message(self):
+        self.assertEqual(validate_frame({'message': 'hi'})['type'], 'message')
+
+    def test_malformed_frames_raise_frame_error(self):
+        frames = [
+            {'type': []},
+            {'type': {'a': 1}},
+            {'type': 1},
+            {'type': 'nope'},
+            {'type': 'message'},
+            {'type': 'message', 'message': ['hi']},
+            {'type': 'message', 'message': 'hi', 'attachment_ids': 'abc'},
+            {'type': 'edit', 'message_id': True, 'message': 'hi'},
+            {'type': 'react', 'message_id': 1, 'emoji': {'x': 1}},
+            {'type': 'read', 'up_to': 2 ** 63},
+        ]
+        for frame in frames:
+            with self.subTest(frame=frame), self.assertRaises(FrameError):
+                validate_frame(frame)
+
+
+@skipIf(msgpack is None, 'msgpack is not installed')
+class MsgpackCodecTests(SimpleTestCase):
+    def test_round_trip(self):
+        codec = MsgpackCodec()
+        frame = {'type': 'message', 'message': 'hi', 'extra': 1}
+        self.assertEqual(codec.decode(bytes_data=codec.encode(frame)), frame)
+
+    def test_malformed_frames_raise_frame_error(self):
+        frames = [
+            b'\x81\x91\x01\x02',  # map keyed by an array
+            b'\x81\x81\x01\x02\x03',  # map keyed by a map
+            b'\x81\xcc\xff\x01',  # unknown field id
+            b'\x91\x01',  # not a map
+            b'\xc1',  # reserved byte
+            b'\x81\x00',  # truncated
+        ]
+        for data in frames:
+            with self.subTest(data=data), self.assertRaises(FrameError):
+                MsgpackCodec().decode(bytes_data=data)
+
+
+class DrainTests(SimpleTestCase):
+    def test_resume_token_is_single_use(self):
+        token = drain.resume_token(1, 7, 42)
+        self.assertIsNone(drain.read_resume_token(token, 2, 7))
+        self.assertIsNone(drain.read_resume_token(token, 1, 8))
+        self.assertEqual(drain.read_resume_token(token, 1, 7), 42)
+        self.assertIsNone(drain.read_resume_token(token, 1, 7))
+
+    def test_drain_without_exit_accepts_sockets_again(self):
+        async def run():
+            await drain.start(None)
+            return drain.draining
+
+        with mock.patch('chat.receipts.flush_and_broadcast'), \
+                mock.patch('chat.reactions.flush_and_broadcast'), \
+                mock.patch('chat.outbox.kick'), \
+                mock.patch('chat.notifications.flush'), \
+                mock.patch('os.kill') as kill:
+            self.assertFalse(async_to_sync(run)())
+        kill.assert_not_called()
+
+
+class CompressionTests(SimpleTestCase):
+    body = b'{"messages": [%s]}' % b",".join([b'"hello"'] * 500)
+
+    def respond(self, path, response):
+        middleware = CompressionMiddleware(lambda request: response)
+        middleware.preference = ['gzip']
+        return middleware(RequestFactory().get(path, HTTP_ACCEPT_ENCODING='gzip'))
+
+    def test_gzip_round_trips_with_random_padding(self):
+        sizes = set()
+        for _ in range(20):
+            response = self.respond('/api/conversations/', HttpResponse(self.body, content_type='application/json'))
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(response.content), self.body)
+            sizes.add(len(response.content))
+        self.assertGreater(len(sizes), 1)
+
+    def test_streaming_gzip_round_trips(self):
+        response = self.respond(
+            '/api/export/',
+            StreamingHttpResponse(iter([self.body, self.body]), content_type='application/x-ndjson'),
+        )
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.body * 2)
+
+    def test_auth_endpoints_are_not_compressed(self):
+        response = self.respond('/api/auth/token/', HttpResponse(self.body, content_type='application/json'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, self.body)
+
+
+@override_settings(CHAT_PRESENCE_TTL=0.2)
+class PresenceTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.sink = notifications.MemorySink()
+        patcher = mock.patch.object(notifications, '_sink', self.sink)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(notifications.digests.drain)
+
+    def queue_digest(self, user_id):
+        notifications.digests.add((user_id, 1), {
+            'count': 1, 'first_at': 't', 'last_at': 't', 'messages': [],
+        })
+
+    def connect_silently(self, user_id, seconds):
+        """Hold a socket open without sending frames, with the consumer's heartbeat running"""
+        consumer = ChatConsumer()
+        consumer.conversation_id = 1
+        consumer.user = SimpleNamespace(id=user_id)
+        consumer.presence_refresh_interval = 0.05
+
+        async def run():
+            notifications.connected(1, user_id)
+            task = asyncio.create_task(consumer.keep_presence())
+            await asyncio.sleep(seconds)
+            task.cancel()
+
+        async_to_sync(run)()
+
+    def test_silent_socket_stays_online_past_the_ttl(self):
+        self.connect_silently(user_id=2, seconds=0.5)
+        self.queue_digest(2)
+        self.queue_digest(3)
+        self.assertEqual(notifications.flush(), 1)
+        self.assertEqual([d['user_id'] for d in self.sink.delivered], [3])
+
+    def test_disconnected_user_gets_a_digest(self):
+        notifications.connected(1, 2)
+        notifications.disconnected(1, 2)
+        self.queue_digest(2)
+        self.assertEqual(notifications.flush(), 1)
+        self.assertEqual(self.sink.delivered[0]['user_id'], 2)
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    """Run with config.settings_test, whose SQLite replicas mirror default"""
+
+    databases = {'default', 'replica_1', 'replica_2'}
+
+    def setUp(self):
+        cache.clear()
+        self.alice = get_user_model().objects.create_user('alice')
+        self.bob = get_user_model().objects.create_user('bob')
+
+    def route_read(self, lags, user_id=None):
+        """The alias a fresh request context reads from, with replicas reporting ``lags``"""
+        def probe(alias):
+            if isinstance(lags[alias], Exception):
+                raise lags[alias]
+            return lags[alias]
+
+        router = db_router.ReplicaRouter()
+        token = db_router.begin(user_id)
+        try:
+            with mock.patch.object(db_router.ReplicaSet, 'probe', side_effect=probe):
+                return router.db_for_read(Conversation)
+        finally:
+            db_router.end(token)
+
+    def test_current_replica_is_chosen(self):
+        self.assertEqual(self.route_read({'replica_1': 10.0, 'replica_2': 0.1}), 'replica_2')
+
+    def test_lagging_replicas_fall_back_to_primary(self):
+        self.assertEqual(self.route_read({'replica_1': 10.0, 'replica_2': 10.0}), 'default')
+
+    def test_unreachable_replicas_fall_back_to_primary(self):
+        down = DatabaseError('connection refused')
+        self.assertEqual(self.route_read({'replica_1': down, 'replica_2': down}), 'default')
+
+    def test_writer_is_pinned_to_primary(self):
+        token = db_router.begin(self.alice.id)
+        try:
+            db_router.ReplicaRouter().db_for_write(Conversation)
+        finally:
+            db_router.end(token)
+        current = {'replica_1': 0.0, 'replica_2': 0.0}
+        self.assertEqual(self.route_read(current, self.alice.id), 'default')
+        self.assertIn(self.route_read(current, self.bob.id), current)
+
+    def get_as(self, user, path):
+        """Queries per alias while ``user`` GETs ``path``"""
+        captured = {alias: CaptureQueriesContext(connections[alias]) for alias in self.databases}
+        for context in captured.values():
+            context.__enter__()
+        try:
+            access = RefreshToken.for_user(user).access_token
+            response = self.client.get(path, HTTP_AUTHORIZATION=f'Bearer {access}')
+        finally:
+            for context in captured.values():
+                context.__exit__(None, None, None)
+        self.assertEqual(response.status_code, 200)
+        return {alias: len(context.captured_queries) for alias, context in captured.items()}
+
+    def test_read_your_writes_over_http(self):
+        access = RefreshToken.for_user(self.alice).access_token
+        response = self.client.post(
+            '/api/conversations/',
+            {'title': 'Plans', 'participant_ids': [self.bob.id]},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Bearer {access}',
+        )
+        self.assertEqual(response.status_code, 201)
+
+        writer = self.get_as(self.alice, '/api/conversations/')
+        self.assertGreater(writer['default'], 0)
+        self.assertEqual(writer['replica_1'] + writer['replica_2'], 0)
+
+        reader = self.get_as(self.bob, '/api/conversations/')
+        self.assertGreater(reader['replica_1'] + reader['replica_2'], 0)
+
+
+class SnowflakeWorkerTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # A file cache is shared by every process on the host, like Redis
+        shared = override_settings(
+            CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': directory.name,
+            }},
+            CHAT_SNOWFLAKE_WORKER_ID=None,
+        )
+        shared.enable()
+        self.addCleanup(shared.disable)
+        self.new_process()
+
+    def new_process(self):
+        """Forget this process's lease, as a freshly started worker would"""
+        patcher = mock.patch.multiple(sharding, _worker=None, _lease_owner=None, _leased_at=0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_processes_lease_distinct_ids(self):
+        leased = set()
+        for _ in range(1 << sharding.WORKER_BITS):
+            self.new_process()
+            leased.add(sharding._worker_id())
+        self.assertEqual(len(leased), 1 << sharding.WORKER_BITS)
+        self.new_process()
+        with self.assertRaises(ImproperlyConfigured):
+            sharding._worker_id()
+
+    def test_released_id_can_be_leased_again(self):
+        worker = sharding._worker_id()
+        sharding._release_worker()
+        self.assertIsNone(cache.get(sharding._lease_key(worker)))
+
+    def test_expired_lease_is_not_renewed(self):
+        worker = sharding._worker_id()
+        cache.set(sharding._lease_key(worker), 'another process', 60)
+        with mock.patch('chat.sharding.time.monotonic', return_value=sharding._leased_at + 60):
+            self.assertNotEqual(sharding._worker_id(), worker)
+
+    def test_per_process_cache_needs_a_configured_id(self):
+        with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }}), self.assertRaises(ImproperlyConfigured):
+            sharding._worker_id()
+        with override_settings(CHAT_SNOWFLAKE_WORKER_ID=64), self.assertRaises(ImproperlyConfigured):
+            sharding._worker_id()
+        with override_settings(CHAT_SNOWFLAKE_WORKER_ID=5):
+            self.assertEqual(sharding.next_id() >> sharding.SEQUENCE_BITS & 63, 5)
+
+
+class ShardingTests(TransactionTestCase):
+    """Run with config.settings_test: default and two SQLite message shards"""
+
+    databases = {'default', 'replica_1', 'replica_2', 'shard_1', 'shard_2'}
+
+    def setUp(self):
+        self.alice = get_user_model().objects.create_user('alice')
+        self.bob = get_user_model().objects.create_user('bob')
+        # One conversation on each database; placement is a hash of the id
+        self.conversations = {}
+        while len(self.conversations) < len(sharding.databases()):
+            conversation = Conversation.objects.create(title='Room')
+            conversation.participants.set([self.alice, self.bob])
+            self.conversations.setdefault(sharding.shard_for(conversation.id), conversation)
+        self.addCleanup(sharding._placements.clear)
+
+    def messages_on(self, alias, conversation):
+        return list(
+            Message.objects.using(alias).filter(conversation_id=conversation.id).values_list('content', flat=True)
+        )
+
+    def get(self, user, path):
+        access = RefreshToken.for_user(user).access_token
+        response = self.client.get(path, HTTP_AUTHORIZATION=f'Bearer {access}')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_messages_are_stored_on_the_conversation_shard(self):
+        for alias, conversation in self.conversations.items():
+            create_message(conversation, self.alice, f'hello {alias}')
+        for alias, conversation in self.conversations.items():
+            for other in sharding.databases():
+                expected = [f'hello {alias}'] if other == alias else []
+                self.assertEqual(self.messages_on(other, conversation), expected)
+
+    def test_history_is_read_from_each_shard(self):
+        for alias, conversation in self.conversations.items():
+            root, _ = create_message(conversation, self.alice, f'root {alias}')
+            create_message(conversation, self.bob, f'reply {alias}', parent=root)
+            set_reaction(root, self.bob, '👍')
+
+        for alias, conversation in self.conversations.items():
+            data = self.get(self.bob, f'/api/conversations/{conversation.id}/messages/')
+            [root] = data['results'] if isinstance(data, dict) else data
+            self.assertEqual(root['content'], f'root {alias}')
+            self.assertEqual(root['sender']['username'], 'alice')
+            self.assertEqual(root['reply_count'], 1)
+            self.assertEqual(root['reactions'], {'👍': 1})
+
+    def test_rebalance_moves_history_and_placement(self):
+        source = 'shard_1'
+        conversation = self.conversations[source]
+        root, _ = create_message(conversation, self.alice, 'before the move')
+        set_reaction(root, self.bob, '🎉')
+
+        self.assertEqual(move_conversation(conversation.id, 'shard_2'), 1)
+        self.assertEqual(sharding.placement(conversation.id, fresh=True), ('shard_2', False))
+        self.assertEqual(self.messages_on(source, conversation), [])
+        self.assertEqual(self.messages_on('shard_2', conversation), ['before the move'])
+        self.assertEqual(Reaction.objects.using('shard_2').filter(message_id=root.id).count(), 1)
+
+        sharding.forget(conversation.id)
+        create_message(conversation, self.bob, 'after the move')
+        self.assertEqual(sorted(self.messages_on('shard_2', conversation)), ['after the move', 'before the move'])
+
+    def test_delete_user_clears_every_shard_and_recounts(self):
+        roots = {}
+        for alias, conversation in self.conversations.items():
+            roots[alias], _ = create_message(conversation, self.alice, 'root')
+            create_message(conversation, self.bob, 'reply', parent=roots[alias])
+            set_reaction(roots[alias], self.alice, '👍')
+            set_reaction(roots[alias], self.bob, '👍')
+
+        call_command('delete_user', 'bob', '--confirm', stdout=StringIO())
+
+        for alias, root in roots.items():
+            self.assertFalse(Message.objects.using(alias).filter(sender_id=self.bob.id).exists())
+            self.assertFalse(Reaction.objects.using(alias).filter(user_id=self.bob.id).exists())
+            root = Message.objects.using(alias).get(pk=root.pk)
+            self.assertEqual(root.reply_count, 0)
+            self.assertEqual(ReactionCount.objects.using(alias).get(message_id=root.id).count, 1)
+
+    def test_deleting_a_user_clears_every_shard_and_recounts(self):
+        roots = {}
+        for alias, conversation in self.conversations.items():
+            roots[alias], _ = create_message(conversation, self.alice, 'root')
+            create_message(conversation, self.bob, 'reply', parent=roots[alias])
+            set_reaction(roots[alias], self.alice, '👍')
+            set_reaction(roots[alias], self.bob, '👍')
+
+        self.bob.delete()
+
+        for alias, root in roots.items():
+            self.assertFalse(Message.objects.using(alias).filter(sender_id=self.bob.id).exists())
+            self.assertFalse(Reaction.objects.using(alias).filter(user_id=self.bob.id).exists())
+            root = Message.objects.using(alias).get(pk=root.pk)
+            self.assertEqual(root.reply_count, 0)
+            self.assertEqual(ReactionCount.objects.using(alias).get(message_id=root.id).count, 1)
+
+    def test_retention_deletes_attachments_of_shard_messages(self):
+        blob = StoredFile.objects.create(sha256='0' * 64, size=1, name='blob')
+        attachments = {}
+        for alias, conversation in self.conversations.items():
+            message, _ = create_message(conversation, self.alice, 'old')
+            attachments[alias] = Attachment.objects.create(
+                conversation=conversation, uploader=self.alice, message_id=message.id, blob=blob, filename='a.txt'
+            )
+            list(expire_conversation(conversation.id, 0, RetentionPolicy.ACTION_DELETE))
+
+        for alias, conversation in self.conversations.items():
+            with self.subTest(alias=alias):
+                self.assertEqual(self.messages_on(alias, conversation), [])
+                self.assertFalse(Attachment.objects.filter(pk=attachments[alias].pk).exists())
+
+    def test_clear_data_empties_every_shard(self):
+        for conversation in self.conversations.values():
+            create_message(conversation, self.alice, 'hello')
+
+        call_command('clear_data', '--confirm', stdout=StringIO())
+
+        for alias in sharding.databases():
+            self.assertFalse(Message.objects.using(alias).exists())
+        self.assertFalse(Conversation.objects.exists())
+
+
+class ReadCursorFlushTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('alice')
+        self.conversation = Conversation.objects.create(title='Room')
+        self.key = (self.conversation.id, self.user.id)
+        self.addCleanup(receipts.read_cursors.drain)
+
+    def cursor(self):
+        cursor = ReadCursor.objects.get(conversation=self.conversation, user=self.user)
+        return cursor.last_delivered_message_id, cursor.last_read_message_id
+
+    def test_flush_creates_and_advances_cursors(self):
+        receipts.record(*self.key, read_up_to=5)
+        receipts.record(*self.key, delivered_up_to=8)
+        self.assertEqual(receipts.flush_read_cursors(), {
+            self.conversation.id: [{'user_id': self.user.id, 'delivered_up_to': 8, 'read_up_to': 5}],
+        })
+        self.assertEqual(self.cursor(), (8, 5))
+
+        receipts.record(*self.key, read_up_to=3)
+        self.assertEqual(receipts.flush_read_cursors(), {})
+        self.assertEqual(self.cursor(), (8, 5))
+
+    def test_socket_cursor_must_name_a_message(self):
+        consumer = ChatConsumer()
+        consumer.conversation_id = self.conversation.id
+        consumer.user = self.user
+        consumer.codec = JsonCodec()
+        consumer.enqueue = mock.Mock()
+        consumer.message_exists = mock.AsyncMock(return_value=False)
+
+        async_to_sync(consumer.receive)(text_data='{"type": "read", "up_to": 9000}')
+        consumer.message_exists.assert_awaited_once_with(9000)
+        self.assertEqual(consumer.enqueue.call_args.args[0]['code'], 'unknown_message')
+        self.assertEqual(receipts.read_cursors.drain(), {})
+
+    def test_interleaved_flushes_never_move_cursors_back(self):
+        # Flush A drains an older snapshot, flush B drains a newer one and
+        # commits first; A writing last must not undo B
+        receipts.record(*self.key, read_up_to=5)
+        older = list(receipts.read_cursors.drain().items())
+        receipts.record(*self.key, read_up_to=10)
+        newer = list(receipts.read_cursors.drain().items())
+
+        self.assertEqual(receipts.write_cursors(newer), [(*self.key, 10, 10)])
+        self.assertEqual(receipts.write_cursors(older), [])
+        self.assertEqual(self.cursor(), (10, 10))
+
+        # Each column keeps its own maximum
+        self.assertEqual(receipts.write_cursors([(self.key, (12, 4))]), [(*self.key, 12, 10)])
+
+
+class UploadTests(TestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.enterContext(override_settings(CHAT_ATTACHMENT_ROOT=root.name))
+        user = get_user_model().objects.create_user('alice')
+        conversation = Conversation.objects.create(title='Room')
+        self.session = UploadSession.objects.create(
+            conversation=conversation, uploader=user, filename='a.txt', content_type='text/plain', size=5
+        )
+
+    def test_retried_final_chunk_does_not_finalize_again(self):
+        attachment = attachments.append_chunk(self.session, 0, BytesIO(b'hello'), 5)
+        self.assertIsNotNone(attachment)
+
+        retry = UploadSession.objects.get(pk=self.session.pk)
+        retry.attachment_id = None
+        self.assertIsNone(attachments.append_chunk(retry, 5, BytesIO(b''), 0))
+        self.assertEqual(retry.attachment_id, attachment.id)
+        self.assertEqual(Attachment.objects.count(), 1)
+        with open(attachments.get_storage().path(attachment.blob.name), 'rb') as handle:
+            self.assertEqual(handle.read(), b'hello')
+
+    def test_chunk_at_wrong_offset_is_refused(self):
+        attachments.append_chunk(self.session, 0, BytesIO(b'he'), 2)
+        with self.assertRaises(attachments.UploadOffsetMismatch) as caught:
+            attachments.append_chunk(self.session, 1, BytesIO(b'llo'), 3)
+        self.assertEqual(caught.exception.expected, 2)
+
+
+class FlakyLayer:
+    """Channel layer stand-in whose first ``failures`` sends raise"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+
+    async def group_send(self, group, message):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('layer down')
+        self.sent.append((group, message['message']))
+
+
+class OutboxTests(TransactionTestCase):
+    databases = {'default', 'replica_1', 'replica_2', 'shard_1', 'shard_2'}
+
+    def setUp(self):
+        self.alice = get_user_model().objects.create_user('alice')
+        self.conversation = Conversation.objects.create(title='Room')
+        self.alias = sharding.shard_for(self.conversation.id)
+        self.addCleanup(sharding._placements.clear)
+
+    def test_message_and_event_commit_on_the_same_shard(self):
+        message, _ = create_message(self.conversation, self.alice, 'hi')
+        event = OutboxEvent.objects.using(self.alias).get()
+        self.assertEqual(event.payload['message_id'], message.id)
+
+    def test_claimed_events_are_not_claimed_again_until_the_lease_expires(self):
+        create_message(self.conversation, self.alice, 'hi')
+        dispatcher = OutboxDispatcher(FlakyLayer())
+        self.assertEqual(len(dispatcher.claim(self.alias)), 1)
+        self.assertEqual(dispatcher.claim(self.alias), [])
+
+        OutboxEvent.objects.using(self.alias).update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(len(dispatcher.claim(self.alias)), 1)
+
+    def test_failed_event_is_retried_in_order(self):
+        create_message(self.conversation, self.alice, 'first')
+        create_message(self.conversation, self.alice, 'second')
+        layer = FlakyLayer(failures=1)
+        dispatcher = OutboxDispatcher(layer)
+
+        self.assertEqual(async_to_sync(dispatcher.dispatch_from)(self.alias), 0)
+        failed, held = OutboxEvent.objects.using(self.alias).order_by('id')
+        self.assertEqual((failed.attempts, held.attempts), (1, 0))
+        self.assertIn('layer down', failed.last_error)
+        self.assertGreater(failed.available_at, timezone.now())
+        # The second event waits behind the first while it backs off
+        self.assertEqual(dispatcher.claim(self.alias), [])
+
+        OutboxEvent.objects.using(self.alias).update(available_at=timezone.now())
+        self.assertEqual(async_to_sync(dispatcher.drain)(), 2)
+        self.assertEqual([text for _, text in layer.sent], ['first', 'second'])
+        self.assertFalse(OutboxEvent.objects.using(self.alias).exists())
+
+
+class ClientMessageIdTests(TransactionTestCase):
+    databases = {'default', 'replica_1', 'replica_2', 'shard_1', 'shard_2'}
+
+    def setUp(self):
+        self.alice = get_user_model().objects.create_user('alice')
+        self.conversation = Conversation.objects.create(title='Room')
+        self.alias = sharding.shard_for(self.conversation.id)
+        self.addCleanup(sharding._placements.clear)
+        self.addCleanup(cache.clear)
+
+    def assertSentOnce(self):
+        self.assertEqual(Message.objects.using(self.alias).count(), 1)
+        self.assertEqual(OutboxEvent.objects.using(self.alias).count(), 1)
+
+    def test_repeated_send_is_answered_from_the_cache(self):
+        first, created = create_message(self.conversation, self.alice, 'hi', client_msg_id='abc')
+        self.assertTrue(created)
+        again, created = create_message(self.conversation, self.alice, 'hi', client_msg_id='abc')
+        self.assertEqual((again.pk, created), (first.pk, False))
+        self.assertSentOnce()
+
+    def test_repeated_send_after_the_cache_expired_hits_the_constraint(self):
+        first, _ = create_message(self.conversation, self.alice, 'hi', client_msg_id='abc')
+        cache.clear()
+        again, created = create_message(self.conversation, self.alice, 'hi', client_msg_id='abc')
+        self.assertEqual((again.pk, created), (first.pk, False))
+        self.assertSentOnce()
+
+    def test_other_integrity_errors_are_not_mistaken_for_repeats(self):
+        with mock.patch.object(Message.objects, 'create', side_effect=IntegrityError('boom')):
+            with self.assertRaisesMessage(IntegrityError, 'boom'):
+                create_message(self.conversation, self.alice, 'hi', client_msg_id='abc')
+
+
+class ConditionalGetTests(TransactionTestCase):
+    databases = {'default', 'replica_1', 'replica_2', 'shard_1', 'shard_2'}
+
+    def setUp(self):
+        self.alice = get_user_model().objects.create_user('alice')
+        self.bob = get_user_model().objects.create_user('bob')
+        self.conversation = Conversation.objects.create(title='Room')
+        self.conversation.participants.set([self.alice, self.bob])
+        self.addCleanup(sharding._placements.clear)
+
+    def get(self, user, path, etag=None):
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}'}
+        if etag:
+            headers['HTTP_IF_NONE_MATCH'] = etag
+        return self.client.get(path, **headers)
+
+    def assertRevalidates(self, user, path, change):
+        """The validator is stable while nothing changes and moves with ``change``"""
+        etag = self.get(user, path)['ETag']
+        self.assertEqual(self.get(user, path, etag).status_code, 304)
+        change()
+        response = self.get(user, path, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response
+
+    def test_new_message_changes_the_message_list(self):
+        path = f'/api/conversations/{self.conversation.id}/messages/'
+        self.assertRevalidates(self.alice, path, lambda: create_message(self.conversation, self.bob, 'hi'))
+
+    def test_joining_changes_the_conversation_list(self):
+        carol = get_user_model().objects.create_user('carol')
+        self.assertRevalidates(self.alice, '/api/conversations/', lambda: self.conversation.participants.add(carol))
+
+    def test_rename_changes_lists_that_show_the_user(self):
+        create_message(self.conversation, self.bob, 'hi')
+        paths = ['/api/conversations/', f'/api/conversations/{self.conversation.id}/messages/']
+        etags = [self.get(self.alice, path)['ETag'] for path in paths]
+
+        self.bob.display_name = 'Robert'
+        self.bob.save()
+        for path, etag in zip(paths, etags):
+            with self.subTest(path=path):
+                self.assertEqual(self.get(self.alice, path, etag).status_code, 200)
+
+    def test_login_does_not_change_the_conversation_list(self):
+        etag = self.get(self.alice, '/api/conversations/')['ETag']
+        self.bob.last_login = timezone.now()
+        self.bob.save(update_fields=['last_login'])
+        self.assertEqual(self.get(self.alice, '/api/conversations/', etag).status_code, 304)
+
+
+class ShardedAdminTests(TransactionTestCase):
+    databases = {'default', 'replica_1', 'replica_2', 'shard_1', 'shard_2'}
+
+    def setUp(self):
+        self.admin = get_user_model().objects.create_superuser('admin', password='x')
+        self.alice = get_user_model().objects.create_user('alice')
+        self.client.force_login(self.admin)
+        self.conversations = {}
+        while len(self.conversations) < len(sharding.databases()):
+            conversation = Conversation.objects.create(title=f'Room {len(self.conversations)}')
+            self.conversations.setdefault(sharding.shard_for(conversation.id), conversation)
+        self.messages = {
+            alias: create_message(conversation, self.alice, f'hello {alias}')[0]
+            for alias, conversation in self.conversations.items()
+        }
+        self.addCleanup(sharding._placements.clear)
+
+    def test_message_list_reads_the_chosen_shard(self):
+        for alias, message in self.messages.items():
+            with self.subTest(alias=alias):
+                response = self.client.get(f'/admin/chat/message/?shard={alias}')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual([m.pk for m in response.context['cl'].result_list], [message.pk])
+
+    def test_message_search_finds_senders_from_a_shard(self):
+        response = self.client.get('/admin/chat/message/?shard=shard_1&q=alice')
+        self.assertEqual([m.pk for m in response.context['cl'].result_list], [self.messages['shard_1'].pk])
+
+    def test_message_change_page_finds_the_shard(self):
+        message = self.messages['shard_2']
+        response = self.client.get(f'/admin/chat/message/{message.pk}/change/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['original'].pk, message.pk)
+
+    def test_deleting_a_shard_message_deletes_its_attachments(self):
+        message = self.messages['shard_1']
+        blob = StoredFile.objects.create(sha256='0' * 64, size=1, name='blob')
+        attachment = Attachment.objects.create(
+            conversation_id=message.conversation_id, uploader=self.alice, message_id=message.id, blob=blob
+        )
+        response = self.client.post(f'/admin/chat/message/{message.pk}/delete/', {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Message.objects.using('shard_1').filter(pk=message.pk).exists())
+        self.assertFalse(Attachment.objects.filter(pk=attachment.pk).exists())
+
+    def test_counts_include_every_shard(self):
+        listed = self.client.get('/admin/chat/conversation/').context['cl'].result_list
+        with_messages = {c.pk for c in self.conversations.values()}
+        self.assertEqual({c.pk: c.message_total for c in listed}, {c.pk: int(c.pk in with_messages) for c in listed})
+        users = self.client.get('/admin/users/user/').context['cl'].result_list
+        self.assertEqual({u.username: u.message_total for u in users}, {'admin': 0, 'alice': 3})
+
+
+@override_settings(CHAT_PROFILE_TOKEN='sekret')
+class ProfileTokenTests(SimpleTestCase):
+    def test_token_must_match(self):
+        self.assertTrue(profiling.authorized('sekret'))
+        self.assertTrue(profiling.authorized(b'sekret'))
+        self.assertFalse(profiling.authorized('other'))
+        self.assertFalse(profiling.authorized(''))
+
+    def test_non_ascii_header_is_refused_not_an_error(self):
+        self.assertFalse(profiling.authorized('sékret'))
+        self.assertFalse(profiling.authorized('sekret\u2603'))
+        self.assertFalse(profiling.authorized('s\xe9kret'.encode('latin-1')))
@@ -1,6 +1,19 @@
 from django.urls import path
 
-from .views import ConversationListCreateView, MessageListCreateView
+from .views import (
+    AttachmentDownloadView,
+    ConversationExportView,
+    ConversationListCreateView,
+    MessageDetailView,
+    MessageListCreateView,
+    MetricsView,
+    ProfilingView,
+    ReactionView,
+    ReadCursorView,
+    ThreadView,
+    UploadCreateView,
+    UploadView,
+)
 
 
 urlpatterns = [
@@ -10,5 +23,39 @@ urlpatterns = [
         MessageListCreateView.as_view(),
         name="message_list_create",
     ),
+    path(
+        "conversations/<int:conversation_id>/messages/<int:pk>/",
+        MessageDetailView.as_view(),
+        name="message_detail",
+    ),
+    path(
+        "conversations/<int:conversation_id>/messages/<int:pk>/thread/",
+        ThreadView.as_view(),
+        name="message_thread",
+    ),
+    path(
+        "conversations/<int:conversation_id>/messages/<int:pk>/reactions/",
+        ReactionView.as_view(),
+        name="message_reactions",
+    ),
+    path(
+        "conversations/<int:conversation_id>/read/",
+        ReadCursorView.as_view(),
+        name="read_cursor",
+    ),
+    path(
+        "conversations/<int:conversation_id>/export/",
+        ConversationExportView.as_view(),
+        name="conversation_export",
+    ),
+    path(
+        "conversations/<int:conversation_id>/uploads/",
+        UploadCreateView.as_view(),
+        name="upload_create",
+    ),
+    path("uploads/<uuid:pk>/", UploadView.as_view(), name="upload"),
+    path("attachments/<int:pk>/", AttachmentDownloadView.as_view(), name="attachment_download"),
+    path("metrics/", MetricsView.as_view(), name="chat_metrics"),
+    path("profiling/", ProfilingView.as_view(), name="chat_profiling"),
 ]
 
@@ -0,0 +1,74 @@
+"""
+Validators for conditional GETs on conversation and message lists.
+
+Every conversation keeps a ``version`` counter and ``last_activity_at``,
+bumped in the same transaction as each change to its message history (new,
+edited or deleted messages, reactions, retention). Every user keeps the same
+pair for their conversation list, bumped on membership changes only: the
+list shows no message data. Renaming a user bumps both, since names show on
+participants and message senders. A repeat poll is then answered from one indexed row instead of
+re-serializing the page; nothing here ever scans messages.
+"""
+
+from django.contrib.auth import get_user_model
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Conversation
+
+
+def touch_conversation(conversation_id):
+    """Bump a conversation's validators"""
+    Conversation.objects.filter(pk=conversation_id).update(
+        version=F("version") + 1, last_activity_at=timezone.now()
+    )
+
+
+def touch_users(users, now=None):
+    users.update(
+        conversations_version=F("conversations_version") + 1,
+        conversations_changed_at=now or timezone.now(),
+    )
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Joining or leaving changes the list of everyone in the affected conversations"""
+    if action == "pre_clear":
+        related = instance.conversations if reverse else instance.participants
+        instance._cleared_pks = set(related.values_list("pk", flat=True))
+        return
+    if action == "post_clear":
+        pk_set = instance.__dict__.pop("_cleared_pks", set())
+    elif action not in ("post_add", "post_remove"):
+        return
+
+    if reverse:
+        conversation_ids, user_ids = pk_set, {instance.pk}
+    else:
+        conversation_ids, user_ids = {instance.pk}, pk_set
+    touch_users(get_user_model().objects.filter(Q(pk__in=user_ids) | Q(conversations__in=conversation_ids)))
+
+
+NAME_FIELDS = ("username", "display_name")
+
+
+@receiver(pre_save, sender=get_user_model())
+def remember_rename(sender, instance, update_fields, **kwargs):
+    if instance.pk is None or (update_fields is not None and not set(NAME_FIELDS) & set(update_fields)):
+        return
+    previous = sender.objects.filter(pk=instance.pk).values_list(*NAME_FIELDS).first()
+    instance._renamed = previous is not None and previous != tuple(getattr(instance, f) for f in NAME_FIELDS)
+
+
+@receiver(post_save, sender=get_user_model())
+def user_renamed(sender, instance, **kwargs):
+    """A new name changes every list that shows the user: conversations and their messages"""
+    if not instance.__dict__.pop("_renamed", False):
+        return
+    now = timezone.now()
+    conversation_ids = list(instance.conversations.values_list("pk", flat=True))
+    touch_users(sender.objects.filter(Q(pk=instance.pk) | Q(conversations__in=conversation_ids)), now)
+    Conversation.objects.filter(pk__in=conversation_ids).update(version=F("version") + 1, last_activity_at=now)
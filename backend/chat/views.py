@@ -1,12 +1,89 @@
-from rest_framework import generics, permissions
-from rest_framework.exceptions import PermissionDenied
+from rest_framework import generics, permissions, status
+from rest_framework.exceptions import PermissionDenied, Throttled
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
 from django.db.models import Q
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import content_disposition_header, http_date, quote_etag
 
-from .models import Conversation, Message
-from .serializers import ConversationSerializer, MessageSerializer
+from .attachments import (
+    UploadOffsetMismatch,
+    append_chunk,
+    attachment_metadata,
+    file_range,
+    get_storage,
+    parse_range,
+)
+from .models import Attachment, Conversation, Message, ReadCursor, UploadSession
+from .serializers import (
+    ConversationSerializer,
+    MessageEditSerializer,
+    MessageSerializer,
+    ReactionSerializer,
+    ReadCursorSerializer,
+    ReadCursorUpdateSerializer,
+    UploadSessionSerializer,
+)
+from config import profiling
 
+from . import metrics, outbox, ratelimit, reactions, receipts, sharding
+from .services import MessageConflict, delete_message, edit_message
+from .export import EXPORT_FORMATS, export_rows
+from .streaming import buffered, gzipped, is_asgi, streaming_body
 
-class ConversationListCreateView(generics.ListCreateAPIView):
+
+def get_participant_conversation(user, conversation_id):
+    """Fetch a conversation the user takes part in, or raise 404/403"""
+    conversation = get_object_or_404(Conversation, pk=conversation_id)
+    if not conversation.participants.filter(pk=user.pk).exists():
+        raise PermissionDenied("Not a participant of this conversation")
+    return conversation
+
+
+class ConversationShardMixin:
+    """Route the message tables of a ``conversation_id`` view to that conversation's shard"""
+
+    def dispatch(self, request, *args, **kwargs):
+        with sharding.for_conversation(kwargs["conversation_id"]):
+            return super().dispatch(request, *args, **kwargs)
+
+
+class ConditionalListMixin:
+    """Answer list GETs with 304 Not Modified while the client's copy is current.
+
+    ``get_validators()`` returns ``(etag, last_modified)`` from a version
+    counter and timestamp kept up to date on writes (see chat/versions.py),
+    or ``None`` to skip the check. ETag and Last-Modified are sent with every
+    full response; ``no-cache`` makes clients revalidate instead of guessing
+    freshness from Last-Modified.
+    """
+
+    def get_validators(self):
+        return None
+
+    def list(self, request, *args, **kwargs):
+        validators = self.get_validators()
+        if validators is None:
+            return super().list(request, *args, **kwargs)
+
+        etag, last_modified = quote_etag(validators[0]), int(validators[1].timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().list(request, *args, **kwargs)
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ["Authorization"])
+        return response
+
+
+class ConversationListCreateView(ConditionalListMixin, generics.ListCreateAPIView):
     serializer_class = ConversationSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -14,6 +91,11 @@ class ConversationListCreateView(generics.ListCreateAPIView):
         user = self.request.user
         return Conversation.objects.filter(participants=user).order_by("-created_at")
 
+    def get_validators(self):
+        # The user row is already loaded by authentication, so this costs no query
+        user = self.request.user
+        return f"u{user.pk}-{user.conversations_version}", user.conversations_changed_at
+
     def perform_create(self, serializer):
         # Add current user to participant_ids if not already included
         participant_ids = self.request.data.get("participant_ids") or []
@@ -27,7 +109,44 @@ class ConversationListCreateView(generics.ListCreateAPIView):
         # The display_title will be calculated dynamically in the serializer
 
 
-class MessageListCreateView(generics.ListCreateAPIView):
+class MessagePageMixin:
+    """List messages with the reaction totals for the whole page loaded in one query"""
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        messages = list(page if page is not None else queryset)
+        self.reaction_counts = reactions.counts_for([m.id for m in messages])
+        serializer = self.get_serializer(messages, many=True)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["reaction_counts"] = getattr(self, "reaction_counts", None)
+        return context
+
+
+class ConversationMessagesMixin(ConversationShardMixin, ConditionalListMixin):
+    """Validators from the conversation row, fetched with the participant check in one indexed query"""
+
+    def get_validators(self):
+        row = (
+            Conversation.objects.filter(pk=self.kwargs["conversation_id"], participants=self.request.user)
+            .values_list("version", "last_activity_at")
+            .first()
+        )
+        if row is None:
+            # Let the listing raise the usual 403/404
+            return None
+        version, last_activity_at = row
+        return f"c{self.kwargs['conversation_id']}-{version}", last_activity_at
+
+
+class MessageListCreateView(ConversationMessagesMixin, MessagePageMixin, generics.ListCreateAPIView):
+    """Room history: top-level messages only, replies are summarised on their thread root"""
+
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -37,7 +156,17 @@ class MessageListCreateView(generics.ListCreateAPIView):
         conversation = Conversation.objects.get(pk=conversation_id)
         if not conversation.participants.filter(pk=user.pk).exists():
             raise PermissionDenied("Not a participant of this conversation")
-        return Message.objects.filter(conversation=conversation)
+        # Senders are prefetched, not joined: messages may be on a shard, users never are
+        return Message.objects.filter(conversation=conversation, thread_root__isnull=True).prefetch_related(
+            "sender", "attachments__blob"
+        )
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        if not getattr(self, "message_created", True):
+            # Retried send: the original message, nothing new was stored
+            response.status_code = status.HTTP_200_OK
+        return response
 
     def perform_create(self, serializer):
         user = self.request.user
@@ -46,11 +175,353 @@ class MessageListCreateView(generics.ListCreateAPIView):
         if not conversation.participants.filter(pk=user.pk).exists():
             raise PermissionDenied("Not a participant of this conversation")
         
+        try:
+            ratelimit.check_message(conversation.id, user.id)
+        except ratelimit.SendRejected as e:
+            raise Throttled(wait=e.retry_after, detail=f"Message not sent ({e.code}).")
+
         print(f"Creating message: conversation_id={conversation_id}, sender={user.username}, content={serializer.validated_data.get('content')}")
         message = serializer.save(conversation=conversation, sender=user)
+        self.message_created = serializer.created
+        if not serializer.created:
+            return message
         print(f"Message created successfully: id={message.id}")
+        # Publish to connected sockets; the outbox row was committed with the message
+        outbox.kick_sync(conversation.id)
         return message
 
-from django.shortcuts import render
 
-# Create your views here.
+class MessageDetailView(ConversationShardMixin, generics.RetrieveAPIView):
+    """Fetch, edit (``PATCH``) or delete a single message.
+
+    Edits and deletes bump the message version and are broadcast as
+    ``message_update``/``message_delete`` deltas. Pass the last seen
+    ``version`` (body for PATCH, query string for DELETE) to reject changes
+    made on top of a stale copy with 409.
+    """
+
+    serializer_class = MessageSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_object(self):
+        conversation = get_participant_conversation(self.request.user, self.kwargs["conversation_id"])
+        return get_object_or_404(
+            Message.objects.prefetch_related("sender", "attachments__blob"),
+            conversation=conversation,
+            pk=self.kwargs["pk"],
+        )
+
+    def get_own_message(self):
+        message = self.get_object()
+        if message.sender_id != self.request.user.id:
+            raise PermissionDenied("Only the sender can change this message")
+        return message
+
+    def changed(self, change, *args, **kwargs):
+        try:
+            message = change(*args, **kwargs)
+        except MessageConflict as e:
+            return Response({"detail": str(e)}, status=status.HTTP_409_CONFLICT)
+        outbox.kick_sync(message.conversation_id)
+        return Response(self.get_serializer(message).data)
+
+    def patch(self, request, conversation_id, pk):
+        message = self.get_own_message()
+        edit = MessageEditSerializer(data=request.data)
+        edit.is_valid(raise_exception=True)
+        return self.changed(
+            edit_message,
+            message,
+            request.user,
+            edit.validated_data["content"],
+            edit.validated_data.get("version"),
+        )
+
+    def delete(self, request, conversation_id, pk):
+        message = self.get_own_message()
+        version = request.query_params.get("version")
+        return self.changed(
+            delete_message,
+            message,
+            request.user,
+            int(version) if version and version.isdigit() else None,
+        )
+
+
+class ThreadPagination(CursorPagination):
+    ordering = "created_at"
+    page_size = 50
+    page_size_query_param = "limit"
+    max_page_size = 200
+
+
+class ThreadView(ConversationMessagesMixin, MessagePageMixin, generics.ListAPIView):
+    """Replies in a message's thread, oldest first, loaded a page at a time"""
+
+    serializer_class = MessageSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = ThreadPagination
+
+    def get_queryset(self):
+        conversation = get_participant_conversation(self.request.user, self.kwargs["conversation_id"])
+        message = get_object_or_404(Message, conversation=conversation, pk=self.kwargs["pk"])
+        return Message.objects.filter(thread_root_id=message.thread_root_id or message.id).prefetch_related(
+            "sender", "attachments__blob"
+        )
+
+
+class ReactionView(ConversationShardMixin, generics.GenericAPIView):
+    """Add (``POST``) or remove (``DELETE``) the caller's reaction: ``{"emoji"}``"""
+
+    serializer_class = ReactionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def react(self, request, conversation_id, pk, add):
+        conversation = get_participant_conversation(request.user, conversation_id)
+        message = get_object_or_404(Message, conversation=conversation, pk=pk, deleted_at__isnull=True)
+        serializer = self.get_serializer(data=request.data or request.query_params)
+        serializer.is_valid(raise_exception=True)
+
+        changed = reactions.set_reaction(message, request.user, serializer.validated_data["emoji"].strip(), add)
+        # Counts go out with the next coalesced batch, like socket toggles
+        reactions.maybe_flush_sync()
+        return Response({
+            "message_id": message.id,
+            "changed": changed,
+            "reactions": reactions.counts_for([message.id]).get(message.id, {}),
+        })
+
+    def post(self, request, conversation_id, pk):
+        return self.react(request, conversation_id, pk, add=True)
+
+    def delete(self, request, conversation_id, pk):
+        return self.react(request, conversation_id, pk, add=False)
+
+
+class ReadCursorView(ConversationShardMixin, generics.GenericAPIView):
+    """List read cursors for a conversation or advance the caller's own"""
+
+    serializer_class = ReadCursorSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, conversation_id):
+        conversation = get_participant_conversation(request.user, conversation_id)
+        cursors = ReadCursor.objects.filter(conversation=conversation).select_related("user")
+        return Response(self.get_serializer(cursors, many=True).data)
+
+    def post(self, request, conversation_id):
+        conversation = get_participant_conversation(request.user, conversation_id)
+        update = ReadCursorUpdateSerializer(data=request.data)
+        update.is_valid(raise_exception=True)
+        up_to = update.validated_data["up_to"]
+        if not Message.objects.filter(conversation=conversation, pk=up_to).exists():
+            return Response({"detail": "Unknown message"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Goes through the same buffer as socket updates and is written with
+        # the next coalesced batch
+        receipts.record(conversation.id, request.user.id, read_up_to=up_to)
+        receipts.maybe_flush_sync()
+        cursor = (
+            ReadCursor.objects.select_related("user").filter(conversation=conversation, user=request.user).first()
+            or ReadCursor(conversation=conversation, user=request.user)
+        )
+        # Answer with the position the buffered update will store
+        cursor.last_read_message_id = max(cursor.last_read_message_id, up_to)
+        cursor.last_delivered_message_id = max(cursor.last_delivered_message_id, cursor.last_read_message_id)
+        return Response(self.get_serializer(cursor).data)
+
+
+
+class ConversationExportView(APIView):
+    """Stream a conversation's full history as NDJSON or CSV.
+
+    ``?output=csv`` selects CSV (NDJSON is the default) and ``?gzip=1``
+    returns a gzip-compressed file. Memory use stays flat regardless of size.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, conversation_id):
+        conversation = get_participant_conversation(request.user, conversation_id)
+        output = request.query_params.get("output", "ndjson")
+        if output not in EXPORT_FORMATS:
+            return Response(
+                {"detail": f"Unsupported output, choose one of: {', '.join(EXPORT_FORMATS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        serialize, content_type, extension = EXPORT_FORMATS[output]
+
+        chunks = buffered(serialize(export_rows(conversation.id)))
+        filename = f"conversation-{conversation.id}.{extension}"
+        if request.query_params.get("gzip") in ("1", "true"):
+            chunks = gzipped(chunks)
+            content_type = "application/gzip"
+            filename += ".gz"
+
+        response = StreamingHttpResponse(streaming_body(request, chunks), content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
+class UploadCreateView(generics.CreateAPIView):
+    """Start a resumable upload: ``{"filename", "content_type", "size"}``"""
+
+    serializer_class = UploadSessionSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def perform_create(self, serializer):
+        conversation = get_participant_conversation(self.request.user, self.kwargs["conversation_id"])
+        serializer.save(conversation=conversation, uploader=self.request.user)
+
+
+class UploadView(APIView):
+    """Resume an upload.
+
+    ``GET``/``HEAD`` report the stored offset. ``PATCH`` appends the raw
+    request body at the offset given in the ``Upload-Offset`` header; the body
+    is copied to disk in blocks and never held in memory as a whole.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_session(self, request, pk):
+        return get_object_or_404(UploadSession, pk=pk, uploader=request.user)
+
+    def offset_response(self, session, status_code=status.HTTP_200_OK):
+        response = Response(UploadSessionSerializer(session).data, status=status_code)
+        response["Upload-Offset"] = str(session.received)
+        response["Upload-Length"] = str(session.size)
+        return response
+
+    def get(self, request, pk):
+        return self.offset_response(self.get_session(request, pk))
+
+    def head(self, request, pk):
+        return self.get(request, pk)
+
+    def patch(self, request, pk):
+        session = self.get_session(request, pk)
+        if session.is_complete:
+            return self.offset_response(session)
+        try:
+            offset = int(request.headers.get("Upload-Offset", ""))
+            length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return Response({"detail": "Upload-Offset header required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            attachment = append_chunk(session, offset, request.stream, length) if length else None
+        except UploadOffsetMismatch:
+            return self.offset_response(session, status.HTTP_409_CONFLICT)
+
+        if attachment is not None:
+            # Only metadata goes over the socket; clients download the bytes over HTTP
+            async_to_sync(get_channel_layer().group_send)(
+                f'chat_{session.conversation_id}',
+                {
+                    'type': 'attachment_uploaded',
+                    'user_id': request.user.id,
+                    'attachment': attachment_metadata(attachment),
+                }
+            )
+        return self.offset_response(session)
+
+
+class AttachmentDownloadView(APIView):
+    """Serve an attachment with single-range support.
+
+    With ``CHAT_ATTACHMENT_SENDFILE_HEADER`` set the transfer is handed to the
+    front proxy (X-Accel-Redirect / X-Sendfile). Otherwise whole files go
+    through FileResponse (``wsgi.file_wrapper`` under WSGI) and ranges, or any
+    request under ASGI, are streamed block by block.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, pk):
+        attachment = get_object_or_404(Attachment.objects.select_related("blob"), pk=pk)
+        get_participant_conversation(request.user, attachment.conversation_id)
+        blob = attachment.blob
+        storage = get_storage()
+        disposition = content_disposition_header(
+            not attachment.content_type.startswith("image/"), attachment.filename
+        )
+
+        sendfile_header = getattr(settings, "CHAT_ATTACHMENT_SENDFILE_HEADER", None)
+        if sendfile_header:
+            response = HttpResponse(content_type=attachment.content_type)
+            if sendfile_header == "X-Sendfile":
+                response[sendfile_header] = storage.path(blob.name)
+            else:
+                response[sendfile_header] = settings.CHAT_ATTACHMENT_SENDFILE_PREFIX + blob.name
+            response["Content-Disposition"] = disposition
+            return response
+
+        try:
+            byte_range = parse_range(request.headers.get("Range"), blob.size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{blob.size}"
+            return response
+
+        path = storage.path(blob.name)
+        if byte_range is None and not is_asgi(request):
+            response = FileResponse(open(path, "rb"), content_type=attachment.content_type)
+        else:
+            start, end = byte_range or (0, blob.size - 1)
+            response = StreamingHttpResponse(
+                streaming_body(request, file_range(path, start, end)),
+                content_type=attachment.content_type,
+                status=206 if byte_range else 200,
+            )
+            response["Content-Length"] = str(end - start + 1)
+            if byte_range:
+                response["Content-Range"] = f"bytes {start}-{end}/{blob.size}"
+
+        response["Accept-Ranges"] = "bytes"
+        response["Content-Disposition"] = disposition
+        response["ETag"] = f'"{blob.sha256}"'
+        return response
+
+
+class MetricsView(APIView):
+    """Counters and per-connection queue depths of the worker serving the request (staff only)"""
+
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(metrics.snapshot())
+
+
+class ProfilingView(APIView):
+    """Sampled profiling of requests and socket events on every worker (staff only).
+
+    PUT ``{"rate": 0.01, "seconds": 600}`` profiles one in a hundred for ten
+    minutes; DELETE turns it off. Profiles go to CHAT_PROFILE_DIR on the
+    worker that served them.
+    """
+
+    permission_classes = [permissions.IsAdminUser]
+    max_seconds = 24 * 3600
+
+    def get(self, request):
+        return Response(profiling.sample_status())
+
+    def put(self, request):
+        try:
+            rate = float(request.data.get("rate", 0))
+            seconds = int(request.data.get("seconds", 600))
+        except (TypeError, ValueError):
+            return Response({"detail": "rate and seconds must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 <= rate <= 1 or not 0 < seconds <= self.max_seconds:
+            return Response(
+                {"detail": f"rate must be between 0 and 1, seconds between 1 and {self.max_seconds}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        profiling.set_sample_rate(rate, seconds)
+        return Response(profiling.sample_status())
+
+    def delete(self, request):
+        profiling.set_sample_rate(0, 0)
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Cold-start regression check: time from a fresh interpreter to the first answered request.
+
+Each run starts a new Python process that imports config.asgi and sends one
+HTTP request (the health check) straight into the ASGI application, with no
+server or network involved. The median over several runs is compared against
+a budget, and the script exits non-zero when it is exceeded, or only warns
+with --warn-only. A child that fails to start always fails the check.
+
+    python check_cold_start.py [--runs 5] [--budget-ms 1000] [--path /] [--warn-only]
+
+The budget can also be set with CHAT_COLD_START_BUDGET_MS. Run with
+CHAT_PROFILE_STARTUP=1 to see which imports dominate.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CHILD = r"""
+import asyncio, json, sys, time
+started = time.perf_counter()
+from config.asgi import application
+imported = time.perf_counter()
+
+from asgiref.testing import ApplicationCommunicator
+
+async def first_request(path):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'query_string': b'', 'root_path': '', 'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 50000), 'server': ('localhost', 80),
+    }
+    communicator = ApplicationCommunicator(application, scope)
+    await communicator.send_input({'type': 'http.request', 'body': b''})
+    start = await communicator.receive_output(30)
+    await communicator.receive_output(30)
+    return start['status']
+
+status = asyncio.run(first_request(sys.argv[1]))
+answered = time.perf_counter()
+print(json.dumps({
+    'status': status,
+    'import_ms': (imported - started) * 1000,
+    'request_ms': (answered - imported) * 1000,
+}))
+"""
+
+
+def run_once(path):
+    spawned = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, path],
+        cwd=BASE_DIR,
+        capture_output=True,
+        text=True,
+    )
+    total = (time.perf_counter() - spawned) * 1000
+    if output.stderr.strip():
+        print(output.stderr, file=sys.stderr)
+    if output.returncode:
+        sys.exit(f"❌ Cold-start run exited with status {output.returncode}")
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    result['total_ms'] = total
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('CHAT_COLD_START_BUDGET_MS', '1000')))
+    parser.add_argument('--path', default='/')
+    parser.add_argument('--warn-only', action='store_true', help='report an exceeded budget without failing')
+    args = parser.parse_args()
+
+    results = [run_once(args.path) for _ in range(args.runs)]
+    if any(result['status'] >= 500 for result in results):
+        sys.exit(f"❌ First request failed with status {results[0]['status']}")
+
+    median = {key: statistics.median(r[key] for r in results) for key in ('import_ms', 'request_ms', 'total_ms')}
+    print(f"⏱️  Median over {args.runs} runs")
+    print(f"   import config.asgi: {median['import_ms']:.0f} ms")
+    print(f"   first request:      {median['request_ms']:.0f} ms")
+    print(f"   process to answer:  {median['total_ms']:.0f} ms (budget {args.budget_ms:.0f} ms)")
+
+    if median['total_ms'] > args.budget_ms:
+        over = f"Cold start over budget by {median['total_ms'] - args.budget_ms:.0f} ms"
+        if not args.warn_only:
+            sys.exit(f"❌ {over}")
+        print(f"⚠️  {over}")
+        return
+    print("✅ Cold start within budget")
+
+
+if __name__ == '__main__':
+    main()
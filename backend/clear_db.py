@@ -16,12 +16,29 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 django.setup()
 
 from django.contrib.auth import get_user_model
-from chat.models import Conversation, Message
-from django.db import connection
+from chat import sharding
+from chat.bulk_delete import BulkDeleter
+from chat.models import ArchivedMessage, Conversation, Message
 
 User = get_user_model()
 
 
+def report_progress(label, done, estimate):
+    total = f"/~{estimate}" if estimate is not None else ""
+    print(f"  {label}: {done}{total}")
+
+
+def count_messages():
+    """Messages on the default database and every message shard"""
+    return sum(Message.objects.using(alias).count() for alias in sharding.databases())
+
+
+def wipe(models):
+    """Empty ``models`` on the default database and every message shard"""
+    for alias in sharding.databases():
+        BulkDeleter(using=alias, progress=report_progress).wipe(models)
+
+
 def clear_all_data():
     """Clear all data from the database."""
     print("🗑️  Database Clearing Script")
@@ -30,7 +47,7 @@ def clear_all_data():
     # Show current data counts
     user_count = User.objects.count()
     conversation_count = Conversation.objects.count()
-    message_count = Message.objects.count()
+    message_count = count_messages()
     
     print(f"Current data in database:")
     print(f"  Users: {user_count}")
@@ -52,10 +69,8 @@ def clear_all_data():
         return
     
     try:
-        # Clear all data
-        Message.objects.all().delete()
-        Conversation.objects.all().delete()
-        User.objects.all().delete()
+        # Clear all data with set-based deletes instead of the ORM collector
+        wipe([Message, ArchivedMessage, Conversation, User])
         
         print(f"✅ Deleted {message_count} messages")
         print(f"✅ Deleted {conversation_count} conversations")
@@ -73,7 +88,7 @@ def clear_conversations_only():
     print("=" * 40)
     
     conversation_count = Conversation.objects.count()
-    message_count = Message.objects.count()
+    message_count = count_messages()
     
     print(f"Current data:")
     print(f"  Conversations: {conversation_count}")
@@ -91,8 +106,7 @@ def clear_conversations_only():
         return
     
     try:
-        Message.objects.all().delete()
-        Conversation.objects.all().delete()
+        wipe([Message, ArchivedMessage, Conversation])
         
         print(f"✅ Deleted {message_count} messages")
         print(f"✅ Deleted {conversation_count} conversations")
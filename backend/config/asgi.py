@@ -3,30 +3,84 @@ ASGI config for config project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The HTTP and WebSocket stacks are built on the first request of each type,
+so importing this module stays cheap and a worker starts listening quickly.
+Set CHAT_PROFILE_STARTUP=1 to print per-module import times and the time to
+the first response.
+The first request also starts the event-loop lag monitor (config/profiling.py).
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
 
 import os
-import django
 
-# Set up Django settings before importing anything else
+from config import startup_profile
+
+if startup_profile.enabled():
+    startup_profile.start()
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
-django.setup()
 
-from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-from chat.routing import websocket_urlpatterns
-from chat.middleware import JWTAuthMiddleware
+from chat.drain import RejectWhileDraining
+
+
+def build_http_application():
+    from django.core.asgi import get_asgi_application
+
+    return get_asgi_application()
 
-application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": JWTAuthMiddleware(
+
+def build_websocket_application():
+    import django
+
+    django.setup(set_prefix=False)
+
+    from channels.auth import AuthMiddlewareStack
+    from channels.routing import URLRouter
+    from chat.middleware import JWTAuthMiddleware
+    from chat.routing import websocket_urlpatterns
+
+    return JWTAuthMiddleware(
         AuthMiddlewareStack(
             URLRouter(
                 websocket_urlpatterns
             )
         )
-    ),
-})
+    )
+
+
+class LazyProtocolRouter:
+    """Routes by scope type like ProtocolTypeRouter, building each stack on first use"""
+
+    builders = {
+        "http": build_http_application,
+        "websocket": build_websocket_application,
+    }
+
+    def __init__(self):
+        self.applications = {}
+
+    async def __call__(self, scope, receive, send):
+        protocol = scope["type"]
+        application = self.applications.get(protocol)
+        if application is None:
+            if protocol not in self.builders:
+                raise ValueError(f"No application configured for scope type {protocol!r}")
+            application = self.applications[protocol] = self.builders[protocol]()
+            first = True
+
+            from config import profiling
+
+            profiling.watch_loop()
+        else:
+            first = False
+
+        await application(scope, receive, send)
+        if first:
+            startup_profile.report(f"First {protocol} request")
+
+
+application = RejectWhileDraining(LazyProtocolRouter())
+
+startup_profile.report("config.asgi imported")
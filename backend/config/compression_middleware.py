@@ -0,0 +1,248 @@
+"""
+Response compression negotiated by Accept-Encoding.
+
+gzip is always available; brotli (``br``) and zstd are offered when the
+``brotli`` or ``zstandard`` packages are installed. The middleware works in
+sync and async stacks and compresses streaming responses chunk by chunk,
+flushing after each chunk so streamed exports still arrive incrementally.
+
+Responses are left alone when they are smaller than CHAT_COMPRESS_MIN_SIZE,
+already encoded, served for byte ranges (attachment downloads), or of a type
+that does not compress (images, archives, ...).
+
+Against BREACH, responses under CHAT_COMPRESS_EXCLUDE_PATHS (the token
+endpoints) are never compressed, and gzip bodies carry a random-length file
+name in their header, as Django's GZipMiddleware does. Settings:
+
+- CHAT_COMPRESS_ENCODINGS: preference order, e.g. ``["zstd", "br", "gzip"]``
+- CHAT_COMPRESS_MIN_SIZE: bytes below which bodies are sent as they are
+- CHAT_COMPRESS_EXCLUDE_PATHS: path prefixes that are never compressed
+- CHAT_COMPRESS_RANDOM_BYTES: upper bound of the gzip header padding
+- CHAT_COMPRESS_GZIP_LEVEL, CHAT_COMPRESS_BROTLI_QUALITY, CHAT_COMPRESS_ZSTD_LEVEL
+"""
+
+import re
+import secrets
+import struct
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+from chat import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+    "text/",
+)
+
+_accept_re = re.compile(r"\s*([^\s;,]+)\s*(?:;\s*q=([0-9.]+))?")
+
+
+class _GzipCompressor:
+    """Raw deflate framed by hand, so the header can carry random padding"""
+
+    def __init__(self, level, max_random_bytes=0):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self._crc = 0
+        self._size = 0
+        self._header = self.header(max_random_bytes)
+
+    @staticmethod
+    def header(max_random_bytes):
+        if not max_random_bytes:
+            return b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+        length = secrets.randbelow(max_random_bytes + 1)
+        filename = secrets.token_urlsafe(max_random_bytes)[:length].encode()
+        # FNAME flag, then the NUL-terminated name after the fixed fields
+        return b"\x1f\x8b\x08\x08\x00\x00\x00\x00\x00\xff" + filename + b"\x00"
+
+    def _emit(self, data):
+        header, self._header = self._header, b""
+        return header + data
+
+    def compress(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        return self._emit(self._compressor.compress(data))
+
+    def flush(self):
+        return self._emit(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        trailer = struct.pack("<II", self._crc, self._size & 0xFFFFFFFF)
+        return self._emit(self._compressor.flush(zlib.Z_FINISH) + trailer)
+
+
+class _BrotliCompressor:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality, mode=brotli.MODE_TEXT)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class _ZstdCompressor:
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def available_encodings():
+    """``{encoding: compressor factory}`` for the encodings usable in this process"""
+    encodings = {
+        "gzip": lambda: _GzipCompressor(
+            getattr(settings, "CHAT_COMPRESS_GZIP_LEVEL", 6),
+            getattr(settings, "CHAT_COMPRESS_RANDOM_BYTES", 100),
+        ),
+    }
+    if brotli is not None:
+        encodings["br"] = lambda: _BrotliCompressor(getattr(settings, "CHAT_COMPRESS_BROTLI_QUALITY", 4))
+    if zstandard is not None:
+        encodings["zstd"] = lambda: _ZstdCompressor(getattr(settings, "CHAT_COMPRESS_ZSTD_LEVEL", 3))
+    return encodings
+
+
+def parse_accept_encoding(header):
+    """``{coding: q}`` from an Accept-Encoding header"""
+    accepted = {}
+    for part in header.split(","):
+        match = _accept_re.match(part)
+        if not match:
+            continue
+        try:
+            quality = float(match.group(2)) if match.group(2) else 1.0
+        except ValueError:
+            continue
+        accepted[match.group(1).lower()] = quality
+    return accepted
+
+
+def choose_encoding(header, preference):
+    """The preferred coding among those the client accepts with the highest q, or ``None``"""
+    accepted = parse_accept_encoding(header)
+    best, best_quality = None, 0.0
+    for coding in preference:
+        quality = accepted.get(coding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+class CompressionMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.encodings = available_encodings()
+        self.preference = [
+            coding
+            for coding in getattr(settings, "CHAT_COMPRESS_ENCODINGS", ["zstd", "br", "gzip"])
+            if coding in self.encodings
+        ]
+        self.min_size = getattr(settings, "CHAT_COMPRESS_MIN_SIZE", 1024)
+        self.exclude_paths = tuple(getattr(settings, "CHAT_COMPRESS_EXCLUDE_PATHS", ["/api/auth/"]))
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        return self.process_response(request, response)
+
+    def compressible(self, response):
+        if response.has_header("Content-Encoding") or response.has_header("Accept-Ranges"):
+            return False
+        if response.status_code in (204, 206, 304):
+            return False
+        content_type = response.get("Content-Type", "").split(";")[0].strip().lower()
+        if not content_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+        return response.streaming or len(response.content) >= self.min_size
+
+    def process_response(self, request, response):
+        # Token responses would let a BREACH attacker guess secrets from body sizes
+        if self.exclude_paths and request.path.startswith(self.exclude_paths):
+            return response
+        if not self.compressible(response):
+            return response
+        # Varies with the header whether or not this client gets a compressed body
+        patch_vary_headers(response, ("Accept-Encoding",))
+        coding = choose_encoding(request.headers.get("Accept-Encoding", ""), self.preference)
+        if coding is None:
+            return response
+        compressor = self.encodings[coding]()
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = self.compress_async(compressor, response.streaming_content)
+            else:
+                response.streaming_content = self.compress_sync(compressor, response.streaming_content)
+            del response["Content-Length"]
+        else:
+            original = len(response.content)
+            compressed = compressor.compress(response.content) + compressor.finish()
+            if len(compressed) >= original:
+                return response
+            response.content = compressed
+            response["Content-Length"] = str(len(compressed))
+            metrics.incr("http.compress.bytes_in", original)
+            metrics.incr("http.compress.bytes_out", len(compressed))
+
+        # The body changes with the encoding, so a strong validator would be wrong
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response["ETag"] = "W/" + etag
+        response["Content-Encoding"] = coding
+        metrics.incr(f"http.compress.{coding}")
+        return response
+
+    @staticmethod
+    def compress_sync(compressor, chunks):
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+
+    @staticmethod
+    async def compress_async(compressor, chunks):
+        async for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
@@ -0,0 +1,280 @@
+"""
+Read-replica routing with read-your-writes stickiness.
+
+Only safe requests (GET, HEAD, OPTIONS) read from replicas, and only while
+``ReplicaMiddleware`` has set up a request context. Everything else stays on
+``default``: unsafe requests (whose reads usually feed a write), reads inside
+a transaction, WebSocket consumers, the outbox dispatcher, management
+commands and the shell.
+
+A request keeps one replica for all of its reads, so its queries see one
+consistent point in replication. A replica is eligible while its health
+probe succeeds and its replication lag is at most CHAT_REPLICA_MAX_LAG
+seconds. Each worker re-probes the replicas every
+CHAT_REPLICA_CHECK_INTERVAL seconds. If no replica is eligible, reads fall
+back to the primary.
+
+A user who writes is pinned to the primary for CHAT_REPLICA_STICKY_SECONDS,
+and never for less than CHAT_REPLICA_MAX_LAG. The pin is a per-user cache
+key, so it follows the user across workers and from a WebSocket write to the
+next REST read. ``StickyJWTAuthentication`` checks the pin before loading the
+user row; ``ReplicaMiddleware`` checks it for session users.
+
+Settings: DATABASE_REPLICAS (aliases in DATABASES), CHAT_REPLICA_MAX_LAG,
+CHAT_REPLICA_CHECK_INTERVAL, CHAT_REPLICA_STICKY_SECONDS.
+"""
+
+import contextvars
+import logging
+import math
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from chat import metrics
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+_context = contextvars.ContextVar("db_router_context", default=None)
+
+
+class _Context:
+    __slots__ = ("user_id", "replica_reads", "wrote", "pinned_until", "replica")
+
+    def __init__(self, user_id=None, replica_reads=True):
+        self.user_id = user_id
+        self.replica_reads = replica_reads
+        self.wrote = False
+        self.pinned_until = 0.0
+        self.replica = None
+
+
+def _pin_key(user_id):
+    return f"db:primary:{user_id}"
+
+
+def _sticky_seconds():
+    return max(
+        getattr(settings, "CHAT_REPLICA_STICKY_SECONDS", 5),
+        getattr(settings, "CHAT_REPLICA_MAX_LAG", 2),
+    )
+
+
+def begin(user_id=None, replica_reads=True):
+    """Start a routing context for a request or socket; returns a token for ``end``"""
+    context = _Context(replica_reads=replica_reads)
+    token = _context.set(context)
+    if user_id is not None:
+        identify(user_id)
+    return token
+
+
+def end(token):
+    _context.reset(token)
+
+
+def identify(user_id):
+    """Tell the current context who is making the request"""
+    context = _context.get()
+    if context is None or user_id is None:
+        return
+    context.user_id = user_id
+    if context.wrote:
+        pin(user_id)
+    elif context.replica_reads:
+        context.pinned_until = cache.get(_pin_key(user_id)) or 0.0
+
+
+def pin(user_id):
+    """Send ``user_id``'s reads to the primary until replicas have their writes"""
+    window = _sticky_seconds()
+    until = time.time() + window
+    cache.set(_pin_key(user_id), until, math.ceil(window))
+    context = _context.get()
+    if context is not None and context.user_id == user_id:
+        context.pinned_until = until
+    metrics.incr("db.replica.pins")
+
+
+@contextmanager
+def primary():
+    """Read from the primary inside the block"""
+    outer = _context.get()
+    context = _Context(user_id=outer.user_id if outer else None, replica_reads=False)
+    token = _context.set(context)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+        if outer is not None and context.wrote:
+            outer.wrote = True
+
+
+class ReplicaSet:
+    """Health and lag of the configured replicas, as seen from this worker"""
+
+    def __init__(self, aliases, max_lag=2.0, check_interval=5.0):
+        self.aliases = list(aliases)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag = {}
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def probe(self, alias):
+        """Replication lag of ``alias`` in seconds; raises DatabaseError when it is unreachable"""
+        connection = connections[alias]
+        with connection.cursor() as cursor:
+            if connection.vendor != "postgresql":
+                cursor.execute("SELECT 1")
+                return 0.0
+            # An idle primary sends no new WAL, so a replica that has replayed
+            # everything it received is current however old its last replay is
+            cursor.execute(
+                """
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                END
+                """
+            )
+            return float(cursor.fetchone()[0])
+
+    def refresh(self):
+        lag = {}
+        for alias in self.aliases:
+            try:
+                lag[alias] = self.probe(alias)
+            except DatabaseError as e:
+                lag[alias] = None
+                # Drop the broken connection so the next probe reconnects
+                connections[alias].close()
+                logger.warning(f"Replica {alias} is unavailable: {e}")
+        self.lag = lag
+        self.checked_at = time.monotonic()
+
+    def maybe_refresh(self):
+        if self.checked_at is not None and time.monotonic() - self.checked_at < self.check_interval:
+            return
+        # One thread probes; the others keep using the last results meanwhile
+        if not self._lock.acquire(blocking=self.checked_at is None):
+            return
+        try:
+            if self.checked_at is None or time.monotonic() - self.checked_at >= self.check_interval:
+                self.refresh()
+        finally:
+            self._lock.release()
+
+    def eligible(self):
+        self.maybe_refresh()
+        return [alias for alias, lag in self.lag.items() if lag is not None and lag <= self.max_lag]
+
+    def choose(self):
+        """A random eligible replica, or ``None`` when reads should go to the primary"""
+        eligible = self.eligible()
+        return random.choice(eligible) if eligible else None
+
+    def stats(self):
+        return {
+            "max_lag": self.max_lag,
+            "lag": {alias: "down" if lag is None else round(lag, 3) for alias, lag in self.lag.items()},
+        }
+
+
+class ReplicaRouter:
+    """Database router for DATABASE_ROUTERS; a no-op unless DATABASE_REPLICAS is set"""
+
+    def __init__(self):
+        self.replicas = ReplicaSet(
+            getattr(settings, "DATABASE_REPLICAS", []),
+            max_lag=getattr(settings, "CHAT_REPLICA_MAX_LAG", 2),
+            check_interval=getattr(settings, "CHAT_REPLICA_CHECK_INTERVAL", 5),
+        )
+        if self.replicas.aliases:
+            metrics.register("db.replicas", self.replicas.stats)
+
+    def db_for_read(self, model, **hints):
+        context = _context.get()
+        if context is None or not context.replica_reads or not self.replicas.aliases:
+            return None
+        if context.wrote or context.pinned_until > time.time():
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db:
+            # Related objects come from wherever the instance was loaded
+            return None
+        if context.replica is None:
+            context.replica = self.replicas.choose() or DEFAULT_DB_ALIAS
+            metrics.incr("db.replica.reads" if context.replica != DEFAULT_DB_ALIAS else "db.replica.fallbacks")
+        return context.replica
+
+    def db_for_write(self, model, **hints):
+        context = _context.get()
+        if context is not None:
+            context.wrote = True
+            # Refresh the pin at most twice per window, not on every statement
+            if context.user_id is not None and context.pinned_until < time.time() + _sticky_seconds() / 2:
+                pin(context.user_id)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *self.replicas.aliases}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db in self.replicas.aliases:
+            return False
+        return None
+
+
+class ReplicaMiddleware:
+    """Opens a routing context per request; safe methods may read from replicas.
+
+    Goes after AuthenticationMiddleware. Session users (the admin) are loaded
+    from the primary before the context opens, so a fresh login is never
+    missed; API requests are identified later by ``StickyJWTAuthentication``.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        user = request.user if settings.SESSION_COOKIE_NAME in request.COOKIES else None
+        token = begin(self.user_id(user), replica_reads=request.method in SAFE_METHODS)
+        try:
+            return self.get_response(request)
+        finally:
+            end(token)
+
+    async def __acall__(self, request):
+        user = await request.auser() if settings.SESSION_COOKIE_NAME in request.COOKIES else None
+        token = begin(self.user_id(user), replica_reads=request.method in SAFE_METHODS)
+        try:
+            return await self.get_response(request)
+        finally:
+            end(token)
+
+    @staticmethod
+    def user_id(user):
+        return user.pk if user is not None and user.is_authenticated else None
@@ -0,0 +1,455 @@
+"""
+On-demand profiling of requests and socket events, event-loop stall
+detection, and timing spans.
+
+Sampled profiles
+    ``ProfileMiddleware`` (HTTP) and ``ChatConsumer`` (WebSocket events)
+    profile a request or event when:
+
+    - it carries ``X-Chat-Profile: <CHAT_PROFILE_TOKEN>``. For a socket, the
+      header on the handshake profiles every event of the connection.
+    - or a staff user has turned on sampling with ``/api/profiling/``.
+      That sets a rate (e.g. 0.01 = one in a hundred) in the cache for a
+      limited time. Workers re-read it every few seconds.
+
+    A sampler thread records the Python stack of every busy thread every
+    CHAT_PROFILE_INTERVAL_MS. Other work running in the same process at the
+    time shows up as well, under its own thread. The result is written to
+    CHAT_PROFILE_DIR as ``<name>.folded``, one ``thread;outer;...;inner count``
+    line per stack, which flamegraph.pl, speedscope and inferno read directly.
+    The span totals of the request go into ``<name>.json``. HTTP responses
+    name the profile in ``X-Chat-Profile-Id``. One profile runs per process at
+    a time; streamed response bodies are not covered.
+
+Spans
+    ``with span("name"):`` times a block. Database queries, ``group_send``,
+    REST JSON rendering and socket frame encoding are instrumented. Spans
+    record into the running profile, or into the worker's metrics
+    (``span.<name>.calls`` / ``span.<name>.us``) with CHAT_PROFILE_SPANS=1.
+    Otherwise ``span`` returns a shared no-op, so the cost is one context
+    variable lookup.
+
+Event-loop lag
+    ``watch_loop()`` starts a heartbeat on the running loop and a watchdog
+    thread. A callback that blocks the loop for more than
+    CHAT_LOOP_LAG_THRESHOLD_MS is logged with the stack it is blocked in,
+    while it is still blocked.
+"""
+
+import asyncio
+import contextvars
+import functools
+import hmac
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from pathlib import Path
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from rest_framework import renderers
+
+from chat import metrics
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Chat-Profile"
+RATE_KEY = "chat:profile:rate"
+RATE_CHECK_INTERVAL = 5
+
+# Innermost frames of a thread that is waiting rather than working
+IDLE_FRAMES = {
+    ("selectors", "select"),
+    ("threading", "wait"),
+    ("concurrent.futures.thread", "_worker"),
+    ("twisted.internet.epollreactor", "doPoll"),
+}
+
+
+# Spans
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("recorder", "name", "started_at")
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.add(self.name, time.perf_counter() - self.started_at)
+        return False
+
+
+class MetricsRecorder:
+    """Span totals for every request, kept in the worker's metrics"""
+
+    def add(self, name, seconds):
+        metrics.incr(f"span.{name}.calls")
+        metrics.incr(f"span.{name}.us", int(seconds * 1000000))
+
+
+# The profile of the current request or event, see Profile
+_recorder = contextvars.ContextVar("profile_recorder", default=None)
+
+
+@functools.cache
+def _default_recorder():
+    return MetricsRecorder() if getattr(settings, "CHAT_PROFILE_SPANS", False) else None
+
+
+def _current_recorder():
+    return _recorder.get() or _default_recorder()
+
+
+def span(name):
+    """Time the block under ``name`` if a profile or CHAT_PROFILE_SPANS is on"""
+    recorder = _current_recorder()
+    if recorder is None:
+        return NO_SPAN
+    return _Span(recorder, name)
+
+
+def _time_query(execute, sql, params, many, context):
+    recorder = _current_recorder()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        recorder.add("db", time.perf_counter() - started_at)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    """DRF's JSON renderer, timed as the ``json`` span"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with span("json"):
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+# Sampled profiles
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def fold(frame):
+    """``outer;...;inner`` for a thread's current frame, or None when the thread is idle"""
+    if (frame.f_globals.get("__name__"), frame.f_code.co_name) in IDLE_FRAMES:
+        return None
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class Sampler(threading.Thread):
+    """Counts the folded stacks of all busy threads until stopped"""
+
+    def __init__(self, interval, max_seconds):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.stacks = Counter()
+        self.samples = 0
+        self.finished = threading.Event()
+        self.on_finish = None
+
+    def run(self):
+        own = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + self.max_seconds
+        while not self.finished.wait(self.interval) and time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = fold(frame)
+                if stack is None:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name.replace(";", "_") for thread in threading.enumerate()}
+                self.stacks[f"{names.get(ident, ident)};{stack}"] += 1
+            self.samples += 1
+        if self.on_finish is not None:
+            self.on_finish()
+
+    def stop(self):
+        self.finished.set()
+
+
+_profiling = threading.Lock()
+_sequence = itertools.count(1)
+
+
+class Profile:
+    """A sampled profile of one request or event, written to CHAT_PROFILE_DIR when it ends"""
+
+    def __init__(self, label):
+        label = re.sub(r"[^A-Za-z0-9]+", "_", label).strip("_")[:80]
+        self.name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_sequence)}-{label}"
+        self.spans = {}
+        self._lock = threading.Lock()
+        self._token = None
+        self.sampler = None
+
+    def add(self, name, seconds):
+        with self._lock:
+            calls, total = self.spans.get(name, (0, 0.0))
+            self.spans[name] = (calls + 1, total + seconds)
+
+    def __enter__(self):
+        # One at a time: the sampler sees every thread, so a second one adds nothing
+        if not _profiling.acquire(blocking=False):
+            metrics.incr("profile.skipped")
+            self.name = None
+            return self
+        self.started_at = time.perf_counter()
+        self.sampler = Sampler(
+            getattr(settings, "CHAT_PROFILE_INTERVAL_MS", 5) / 1000,
+            getattr(settings, "CHAT_PROFILE_MAX_SECONDS", 30),
+        )
+        self.sampler.on_finish = self.write
+        self._token = _recorder.set(self)
+        self.sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.sampler is not None:
+            _recorder.reset(self._token)
+            self.duration = time.perf_counter() - self.started_at
+            self.sampler.stop()
+        return False
+
+    def write(self):
+        """Runs on the sampler thread, so the request does not wait for the disk"""
+        try:
+            directory = Path(getattr(settings, "CHAT_PROFILE_DIR", "profiles"))
+            directory.mkdir(parents=True, exist_ok=True)
+            with open(directory / f"{self.name}.folded", "w") as out:
+                for stack, count in self.sampler.stacks.most_common():
+                    out.write(f"{stack} {count}\n")
+            summary = {
+                # Still running if the sampler stopped at CHAT_PROFILE_MAX_SECONDS
+                "duration_ms": round(getattr(self, "duration", time.perf_counter() - self.started_at) * 1000, 1),
+                "samples": self.sampler.samples,
+                "interval_ms": self.sampler.interval * 1000,
+                "spans": {
+                    name: {"calls": calls, "ms": round(total * 1000, 2)}
+                    for name, (calls, total) in sorted(self.spans.items())
+                },
+            }
+            with open(directory / f"{self.name}.json", "w") as out:
+                json.dump(summary, out, indent=2)
+            prune(directory, getattr(settings, "CHAT_PROFILE_KEEP", 200))
+            metrics.incr("profile.written")
+        except OSError as e:
+            logger.warning(f"Could not write profile {self.name}: {e}")
+        finally:
+            _profiling.release()
+
+
+def prune(directory, keep):
+    """Delete all but the newest ``keep`` profiles"""
+    profiles = sorted(directory.glob("*.folded"), key=lambda path: path.stat().st_mtime, reverse=True)
+    for path in profiles[keep:]:
+        path.unlink(missing_ok=True)
+        path.with_suffix(".json").unlink(missing_ok=True)
+
+
+def authorized(value):
+    """Whether a ``X-Chat-Profile`` header value matches CHAT_PROFILE_TOKEN"""
+    token = getattr(settings, "CHAT_PROFILE_TOKEN", "")
+    if not token or not value:
+        return False
+    # compare_digest only takes ASCII strings, so header values are compared as bytes
+    if isinstance(value, str):
+        value = value.encode("latin-1", "replace")
+    return hmac.compare_digest(value, token.encode())
+
+
+def set_sample_rate(rate, seconds):
+    """Profile ``rate`` of all requests and events on every worker for ``seconds``; 0 turns it off"""
+    if rate > 0:
+        cache.set(RATE_KEY, {"rate": rate, "until": time.time() + seconds}, seconds)
+    else:
+        cache.delete(RATE_KEY)
+    _sample_rate.checked_at = None
+
+
+def sample_status():
+    return cache.get(RATE_KEY) or {"rate": 0, "until": None}
+
+
+class _SampleRate:
+    value = 0.0
+    checked_at = None
+
+    def get(self):
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= RATE_CHECK_INTERVAL:
+            # Written before the lookup so concurrent callers do not all hit the cache
+            self.checked_at = now
+            self.value = sample_status()["rate"]
+        return self.value
+
+
+_sample_rate = _SampleRate()
+
+
+def maybe_profile(label, forced=False):
+    """A ``Profile`` when forced or picked by the sample rate, otherwise a no-op"""
+    if forced:
+        return Profile(label)
+    rate = _sample_rate.get()
+    if rate and random.random() < rate:
+        return Profile(label)
+    return NO_SPAN
+
+
+class ProfileMiddleware:
+    """Profiles requests carrying the profile header or picked by the sample rate; goes first"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        profile = self.profile_for(request)
+        with profile:
+            response = self.get_response(request)
+        return self.label(response, profile)
+
+    async def __acall__(self, request):
+        profile = self.profile_for(request)
+        with profile:
+            response = await self.get_response(request)
+        return self.label(response, profile)
+
+    @staticmethod
+    def profile_for(request):
+        return maybe_profile(
+            f"{request.method}-{request.path}",
+            forced=authorized(request.headers.get(PROFILE_HEADER)),
+        )
+
+    @staticmethod
+    def label(response, profile):
+        if getattr(profile, "name", None):
+            response["X-Chat-Profile-Id"] = profile.name
+        return response
+
+
+# Event-loop lag
+
+
+class LoopMonitor:
+    """Heartbeat on an event loop plus a watchdog thread that reports where it is stuck"""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.interval = threshold / 2
+        self.loop = None
+        self.loop_thread = None
+        self.beat = time.monotonic()
+        self.reported_beat = None
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+
+    def start(self, loop):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        loop.create_task(self.heartbeat())
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+        metrics.register("loop", self.stats)
+
+    async def heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_lag = max(now - expected, 0.0)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            if self.last_lag >= self.threshold:
+                self.stalls += 1
+                metrics.incr("loop.stalls")
+                logger.warning(f"Event loop was blocked for {self.last_lag * 1000:.0f} ms")
+            self.beat = now
+
+    def watch(self):
+        while not self.loop.is_closed():
+            time.sleep(self.interval)
+            beat = self.beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold or self.reported_beat == beat:
+                continue
+            self.reported_beat = beat
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no frame)\n"
+            logger.warning(f"Event loop blocked for {blocked * 1000:.0f} ms so far, in:\n{stack.rstrip()}")
+
+    def stats(self):
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "stalls": self.stalls,
+        }
+
+
+_monitors = {}
+
+
+def watch_loop():
+    """Start a LoopMonitor on the running loop once; a no-op if CHAT_LOOP_LAG_THRESHOLD_MS is 0"""
+    loop = asyncio.get_running_loop()
+    if loop in _monitors:
+        return
+    threshold = getattr(settings, "CHAT_LOOP_LAG_THRESHOLD_MS", 250) / 1000
+    _monitors[loop] = monitor = LoopMonitor(threshold) if threshold > 0 else None
+    if monitor is not None:
+        monitor.start(loop)
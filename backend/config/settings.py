@@ -37,12 +37,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "config.profiling.ProfileMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
+    "config.compression_middleware.CompressionMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "users.hashing.HashingBusyMiddleware",
+    "config.db_router.ReplicaMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -89,6 +93,36 @@ DATABASES = {
     }
 }
 
+# Read replicas (config/db_router.py): comma-separated host[:port] list sharing
+# the primary's database name and credentials. Tests use the primary for them.
+DATABASE_REPLICAS = []
+for index, replica in enumerate(h.strip() for h in os.getenv("DB_REPLICA_HOSTS", "").split(",") if h.strip()):
+    host, _, port = replica.partition(":")
+    DATABASES[f"replica_{index + 1}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": port or DATABASES["default"]["PORT"],
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_REPLICAS.append(f"replica_{index + 1}")
+
+# Message shards (chat/sharding.py): comma-separated host[:port] list, like the
+# replicas. Each gets the full schema; messages of a conversation live on one
+# of default and the shards. Once enabled, do not turn sharding off again.
+CHAT_MESSAGE_SHARDS = []
+for index, shard in enumerate(h.strip() for h in os.getenv("DB_SHARD_HOSTS", "").split(",") if h.strip()):
+    host, _, port = shard.partition(":")
+    DATABASES[f"shard_{index + 1}"] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": port or DATABASES["default"]["PORT"],
+    }
+    CHAT_MESSAGE_SHARDS.append(f"shard_{index + 1}")
+if CHAT_MESSAGE_SHARDS:
+    CHAT_MESSAGE_SHARDS.insert(0, "default")
+
+DATABASE_ROUTERS = ["chat.sharding.ShardRouter", "config.db_router.ReplicaRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -108,6 +142,16 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# PBKDF2 runs on a bounded thread pool (users/hashing.py) so logins cannot take
+# every core from chat traffic. The first entry hashes new passwords.
+PASSWORD_HASHERS = [
+    "users.hashing.BoundedPBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+    "django.contrib.auth.hashers.ScryptPasswordHasher",
+]
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/5.0/topics/i18n/
@@ -152,7 +196,11 @@ CORS_ALLOW_CREDENTIALS = True
 # REST Framework settings
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "users.authentication.StickyJWTAuthentication",
+    ),
+    "DEFAULT_RENDERER_CLASSES": (
+        "config.profiling.JSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
     ),
 }
 
@@ -186,9 +234,135 @@ SIMPLE_JWT = {
     "SLIDING_TOKEN_LIFETIME": timedelta(minutes=5),
     "SLIDING_TOKEN_REFRESH_LIFETIME": timedelta(days=1),
     "TOKEN_OBTAIN_SERIALIZER": "rest_framework_simplejwt.serializers.TokenObtainPairSerializer",
-    "TOKEN_REFRESH_SERIALIZER": "rest_framework_simplejwt.serializers.TokenRefreshSerializer",
+    # Revokes rotated tokens in the cache (users/denylist.py); the blacklist app is not used
+    "TOKEN_REFRESH_SERIALIZER": "users.serializers.DenylistTokenRefreshSerializer",
     "TOKEN_VERIFY_SERIALIZER": "rest_framework_simplejwt.serializers.TokenVerifySerializer",
     "TOKEN_BLACKLIST_SERIALIZER": "rest_framework_simplejwt.serializers.TokenBlacklistSerializer",
     "SLIDING_TOKEN_OBTAIN_SERIALIZER": "rest_framework_simplejwt.serializers.TokenObtainSlidingSerializer",
     "SLIDING_TOKEN_REFRESH_SERIALIZER": "rest_framework_simplejwt.serializers.TokenRefreshSlidingSerializer",
 }
+
+# Read receipts: cursor updates are coalesced in memory and upserted in batches
+CHAT_READ_CURSOR_FLUSH_INTERVAL = float(os.getenv("CHAT_READ_CURSOR_FLUSH_INTERVAL", "1.0"))
+CHAT_READ_CURSOR_BATCH_SIZE = int(os.getenv("CHAT_READ_CURSOR_BATCH_SIZE", "500"))
+
+# Message retention. Conversations without a RetentionPolicy fall back to the
+# default below; None keeps messages forever.
+CHAT_DEFAULT_RETENTION_DAYS = int(os.getenv("CHAT_DEFAULT_RETENTION_DAYS")) if os.getenv("CHAT_DEFAULT_RETENTION_DAYS") else None
+CHAT_DEFAULT_RETENTION_ACTION = os.getenv("CHAT_DEFAULT_RETENTION_ACTION", "archive")
+CHAT_RETENTION_BATCH_SIZE = int(os.getenv("CHAT_RETENTION_BATCH_SIZE", "1000"))
+CHAT_ARCHIVE_EXPORT_DIR = os.getenv("CHAT_ARCHIVE_EXPORT_DIR", os.path.join(BASE_DIR, "archive"))
+
+# Conversation exports are read through a server-side cursor in chunks of this size
+CHAT_EXPORT_CHUNK_SIZE = int(os.getenv("CHAT_EXPORT_CHUNK_SIZE", "2000"))
+
+# Message attachments
+CHAT_ATTACHMENT_ROOT = os.getenv("CHAT_ATTACHMENT_ROOT", os.path.join(BASE_DIR, "media", "attachments"))
+CHAT_ATTACHMENT_STORAGE = "chat.attachments.LocalAttachmentStorage"
+CHAT_ATTACHMENT_MAX_SIZE = int(os.getenv("CHAT_ATTACHMENT_MAX_SIZE", str(100 * 1024 * 1024)))
+# Hand downloads to the front proxy, e.g. "X-Accel-Redirect" (nginx) or "X-Sendfile"
+CHAT_ATTACHMENT_SENDFILE_HEADER = os.getenv("CHAT_ATTACHMENT_SENDFILE_HEADER") or None
+CHAT_ATTACHMENT_SENDFILE_PREFIX = os.getenv("CHAT_ATTACHMENT_SENDFILE_PREFIX", "/protected/attachments/")
+
+# Transactional outbox. With inline dispatch the writer publishes right after
+# committing; run `manage.py dispatch_outbox` as well to retry failed events,
+# or alone with inline dispatch disabled to scale fan-out separately.
+CHAT_OUTBOX_INLINE_DISPATCH = os.getenv("CHAT_OUTBOX_INLINE_DISPATCH", "True").lower() == "true"
+CHAT_OUTBOX_BATCH_SIZE = int(os.getenv("CHAT_OUTBOX_BATCH_SIZE", "100"))
+CHAT_OUTBOX_LEASE_SECONDS = int(os.getenv("CHAT_OUTBOX_LEASE_SECONDS", "30"))
+CHAT_OUTBOX_MAX_BACKOFF = int(os.getenv("CHAT_OUTBOX_MAX_BACKOFF", "60"))
+
+# How long recently seen client_msg_ids are answered from the cache
+CHAT_CLIENT_MSG_ID_TTL = int(os.getenv("CHAT_CLIENT_MSG_ID_TTL", "600"))
+
+# Reaction count updates are batched per message and fanned out this often
+CHAT_REACTION_FLUSH_INTERVAL = float(os.getenv("CHAT_REACTION_FLUSH_INTERVAL", "0.5"))
+CHAT_REACTION_BATCH_SIZE = int(os.getenv("CHAT_REACTION_BATCH_SIZE", "500"))
+
+# Per-connection outbound queue. Ephemeral frames (typing, join/leave) are shed
+# above the high watermark; a socket that reaches the max size or stays above
+# it for CHAT_WS_SLOW_EVICT_SECONDS is sent a resync frame and closed.
+CHAT_WS_QUEUE_HIGH_WATERMARK = int(os.getenv("CHAT_WS_QUEUE_HIGH_WATERMARK", "200"))
+CHAT_WS_QUEUE_LOW_WATERMARK = int(os.getenv("CHAT_WS_QUEUE_LOW_WATERMARK", "50"))
+CHAT_WS_QUEUE_MAX_SIZE = int(os.getenv("CHAT_WS_QUEUE_MAX_SIZE", "1000"))
+CHAT_WS_SLOW_EVICT_SECONDS = float(os.getenv("CHAT_WS_SLOW_EVICT_SECONDS", "10"))
+
+# Inbound WebSocket limits. Frame rates are per user across all sockets and
+# message rates per conversation, both shared between workers via the cache.
+CHAT_WS_MAX_FRAME_BYTES = int(os.getenv("CHAT_WS_MAX_FRAME_BYTES", str(64 * 1024)))
+CHAT_MAX_MESSAGE_LENGTH = int(os.getenv("CHAT_MAX_MESSAGE_LENGTH", "4000"))
+CHAT_USER_FRAME_RATE = float(os.getenv("CHAT_USER_FRAME_RATE", "10"))
+CHAT_USER_FRAME_BURST = int(os.getenv("CHAT_USER_FRAME_BURST", "20"))
+CHAT_ROOM_MESSAGE_RATE = float(os.getenv("CHAT_ROOM_MESSAGE_RATE", "20"))
+CHAT_ROOM_MESSAGE_BURST = int(os.getenv("CHAT_ROOM_MESSAGE_BURST", "50"))
+CHAT_SLOW_MODE_CACHE_SECONDS = int(os.getenv("CHAT_SLOW_MODE_CACHE_SECONDS", "10"))
+
+# Draining on deploy (SIGUSR1 or `manage.py drain_connections`): sockets are
+# closed in CHAT_DRAIN_WAVES waves and told to reconnect after a random delay
+# of up to CHAT_RECONNECT_MAX_DELAY seconds with a short-lived resume token.
+CHAT_DRAIN_WAVES = int(os.getenv("CHAT_DRAIN_WAVES", "10"))
+CHAT_DRAIN_WAVE_INTERVAL = float(os.getenv("CHAT_DRAIN_WAVE_INTERVAL", "1.0"))
+CHAT_RECONNECT_MAX_DELAY = float(os.getenv("CHAT_RECONNECT_MAX_DELAY", "30"))
+CHAT_RESUME_TOKEN_MAX_AGE = int(os.getenv("CHAT_RESUME_TOKEN_MAX_AGE", "300"))
+
+# Response compression (config/compression_middleware.py). br and zstd are used
+# only when the brotli / zstandard packages are installed.
+CHAT_COMPRESS_ENCODINGS = os.getenv("CHAT_COMPRESS_ENCODINGS", "zstd,br,gzip").split(",")
+CHAT_COMPRESS_MIN_SIZE = int(os.getenv("CHAT_COMPRESS_MIN_SIZE", "1024"))
+# BREACH: token endpoints are sent uncompressed; gzip headers get random padding
+CHAT_COMPRESS_EXCLUDE_PATHS = [p for p in os.getenv("CHAT_COMPRESS_EXCLUDE_PATHS", "/api/auth/").split(",") if p]
+CHAT_COMPRESS_RANDOM_BYTES = int(os.getenv("CHAT_COMPRESS_RANDOM_BYTES", "100"))
+CHAT_COMPRESS_GZIP_LEVEL = int(os.getenv("CHAT_COMPRESS_GZIP_LEVEL", "6"))
+CHAT_COMPRESS_BROTLI_QUALITY = int(os.getenv("CHAT_COMPRESS_BROTLI_QUALITY", "4"))
+CHAT_COMPRESS_ZSTD_LEVEL = int(os.getenv("CHAT_COMPRESS_ZSTD_LEVEL", "3"))
+
+# Password hashing pool (users/hashing.py). Existing hashes are upgraded on
+# login when CHAT_PASSWORD_ITERATIONS changes.
+CHAT_PASSWORD_HASH_WORKERS = int(os.getenv("CHAT_PASSWORD_HASH_WORKERS", "0")) or max(1, (os.cpu_count() or 2) // 2)
+CHAT_PASSWORD_HASH_QUEUE = int(os.getenv("CHAT_PASSWORD_HASH_QUEUE", "64"))
+CHAT_PASSWORD_ITERATIONS = int(os.getenv("CHAT_PASSWORD_ITERATIONS", "720000"))
+
+# Offline notifications (chat/notifications.py): messages to participants
+# without a live socket are merged into one digest per user and conversation
+# and sent to the sink every CHAT_NOTIFY_WINDOW seconds.
+CHAT_NOTIFICATION_SINK = os.getenv("CHAT_NOTIFICATION_SINK", "chat.notifications.MemorySink")
+CHAT_NOTIFICATION_FILE = os.getenv("CHAT_NOTIFICATION_FILE", str(BASE_DIR / "notifications.jsonl"))
+CHAT_NOTIFY_WINDOW = float(os.getenv("CHAT_NOTIFY_WINDOW", "60"))
+CHAT_NOTIFY_MAX_PENDING = int(os.getenv("CHAT_NOTIFY_MAX_PENDING", "10000"))
+CHAT_NOTIFY_PREVIEWS = int(os.getenv("CHAT_NOTIFY_PREVIEWS", "3"))
+CHAT_PRESENCE_TTL = int(os.getenv("CHAT_PRESENCE_TTL", "300"))
+
+# Admin changelists count exactly below this many (estimated) rows and use
+# PostgreSQL's estimates above it
+CHAT_ADMIN_EXACT_COUNT_LIMIT = int(os.getenv("CHAT_ADMIN_EXACT_COUNT_LIMIT", "10000"))
+
+# Replica selection and read-your-writes stickiness (config/db_router.py).
+# Replicas lagging more than CHAT_REPLICA_MAX_LAG seconds are skipped; users
+# read from the primary for CHAT_REPLICA_STICKY_SECONDS after a write.
+CHAT_REPLICA_MAX_LAG = float(os.getenv("CHAT_REPLICA_MAX_LAG", "2"))
+CHAT_REPLICA_CHECK_INTERVAL = float(os.getenv("CHAT_REPLICA_CHECK_INTERVAL", "5"))
+CHAT_REPLICA_STICKY_SECONDS = float(os.getenv("CHAT_REPLICA_STICKY_SECONDS", "5"))
+
+# Shard directory cache and rebalancing (chat/sharding.py, chat/rebalance.py).
+# A move freezes writes for CHAT_SHARD_DIRECTORY_TTL + CHAT_SHARD_MOVE_GRACE
+# seconds. Message ids embed a worker id; set CHAT_SNOWFLAKE_WORKER_ID (0-63)
+# per process, or leave it unset to lease a free one for
+# CHAT_SNOWFLAKE_LEASE_SECONDS at a time from the cache, which must then be
+# shared by all workers (not the local-memory cache).
+CHAT_SHARD_DIRECTORY_TTL = float(os.getenv("CHAT_SHARD_DIRECTORY_TTL", "5"))
+CHAT_SHARD_MOVE_GRACE = float(os.getenv("CHAT_SHARD_MOVE_GRACE", "2"))
+CHAT_SNOWFLAKE_WORKER_ID = int(os.environ["CHAT_SNOWFLAKE_WORKER_ID"]) if os.getenv("CHAT_SNOWFLAKE_WORKER_ID") else None
+CHAT_SNOWFLAKE_LEASE_SECONDS = int(os.getenv("CHAT_SNOWFLAKE_LEASE_SECONDS", "60"))
+
+# Profiling (config/profiling.py). Requests and socket handshakes carrying
+# "X-Chat-Profile: <CHAT_PROFILE_TOKEN>" are profiled; an empty token turns
+# the header off. CHAT_PROFILE_SPANS=1 keeps span totals in the metrics for
+# every request. Callbacks blocking the event loop longer than
+# CHAT_LOOP_LAG_THRESHOLD_MS are logged with their stack; 0 turns that off.
+CHAT_PROFILE_TOKEN = os.getenv("CHAT_PROFILE_TOKEN", "")
+CHAT_PROFILE_DIR = os.getenv("CHAT_PROFILE_DIR", str(BASE_DIR / "profiles"))
+CHAT_PROFILE_INTERVAL_MS = float(os.getenv("CHAT_PROFILE_INTERVAL_MS", "5"))
+CHAT_PROFILE_MAX_SECONDS = float(os.getenv("CHAT_PROFILE_MAX_SECONDS", "30"))
+CHAT_PROFILE_KEEP = int(os.getenv("CHAT_PROFILE_KEEP", "200"))
+CHAT_PROFILE_SPANS = os.getenv("CHAT_PROFILE_SPANS", "").lower() in ("1", "true")
+CHAT_LOOP_LAG_THRESHOLD_MS = float(os.getenv("CHAT_LOOP_LAG_THRESHOLD_MS", "250"))
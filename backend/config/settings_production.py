@@ -34,32 +34,60 @@ else:
         }
     }
 
-# CORS settings for production (handled by SimpleCorsMiddleware)
-print(f"🔧 Using SimpleCorsMiddleware for CORS handling")
-print(f"🔧 Allowing origin: https://chat-web-app-mocha.vercel.app")
+# Read replicas: DATABASE_REPLICA_URLS (comma-separated) next to DATABASE_URL,
+# otherwise DB_REPLICA_HOSTS as in the base settings
+if DATABASE_URL:
+    replicas = [
+        dj_database_url.parse(url.strip(), conn_max_age=600)
+        for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()
+    ]
+else:
+    replicas = []
+    for replica in (h.strip() for h in os.getenv('DB_REPLICA_HOSTS', '').split(',') if h.strip()):
+        host, _, port = replica.partition(':')
+        replicas.append({**DATABASES['default'], 'HOST': host, 'PORT': port or DATABASES['default']['PORT']})
+DATABASE_REPLICAS = []
+for index, replica in enumerate(replicas):
+    DATABASES[f'replica_{index + 1}'] = {**replica, 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica_{index + 1}')
+
+# Message shards: DATABASE_SHARD_URLS next to DATABASE_URL, otherwise
+# DB_SHARD_HOSTS as in the base settings
+if DATABASE_URL:
+    shards = [
+        dj_database_url.parse(url.strip(), conn_max_age=600)
+        for url in os.getenv('DATABASE_SHARD_URLS', '').split(',') if url.strip()
+    ]
+else:
+    shards = []
+    for shard in (h.strip() for h in os.getenv('DB_SHARD_HOSTS', '').split(',') if h.strip()):
+        host, _, port = shard.partition(':')
+        shards.append({**DATABASES['default'], 'HOST': host, 'PORT': port or DATABASES['default']['PORT']})
+CHAT_MESSAGE_SHARDS = ['default'] if shards else []
+for index, shard in enumerate(shards):
+    DATABASES[f'shard_{index + 1}'] = shard
+    CHAT_MESSAGE_SHARDS.append(f'shard_{index + 1}')
 
-# Static files configuration
+# CORS settings for production are handled by SimpleCorsMiddleware
+
+# Static files configuration. build.sh creates STATIC_ROOT and collects into
+# it; settings stay free of import-time side effects to keep cold starts fast.
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
-# Ensure STATIC_ROOT exists and is absolute
-try:
-    os.makedirs(STATIC_ROOT, exist_ok=True)
-    print(f"✅ STATIC_ROOT created/verified: {STATIC_ROOT}")
-except Exception as e:
-    print(f"⚠️  Could not create STATIC_ROOT: {e}")
-    # Fallback to a simple path
-    STATIC_ROOT = '/tmp/staticfiles'
-
 # Add whitenoise middleware for static files
 MIDDLEWARE = [
+    "config.profiling.ProfileMiddleware",
     "config.simple_cors_middleware.SimpleCorsMiddleware",  # Simple CORS middleware
     "django.middleware.security.SecurityMiddleware",
+    "config.compression_middleware.CompressionMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",  # Add this line
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "users.hashing.HashingBusyMiddleware",
+    "config.db_router.ReplicaMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -75,6 +103,13 @@ if REDIS_URL:
             },
         },
     }
+    # Shared cache so every process sees the same recent client_msg_ids
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        },
+    }
 else:
     # Fallback to InMemoryChannelLayer for development
     CHANNEL_LAYERS = {
@@ -0,0 +1,34 @@
+"""
+Settings for the test suite: SQLite stand-ins for Postgres, no server needed.
+
+    python manage.py test --settings=config.settings_test
+
+The replicas mirror ``default`` during tests, as the Postgres replicas do, so
+routing can be checked against real connections without replication. The
+message shards are separate databases, so sharding is on for every test.
+"""
+
+from .settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+}
+
+DATABASE_REPLICAS = []
+for index in range(2):
+    DATABASES[f'replica_{index + 1}'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica_{index + 1}')
+
+CHAT_MESSAGE_SHARDS = ['default']
+for index in range(2):
+    DATABASES[f'shard_{index + 1}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+    CHAT_MESSAGE_SHARDS.append(f'shard_{index + 1}')
+CHAT_SNOWFLAKE_WORKER_ID = 1
+CHAT_SHARD_DIRECTORY_TTL = 0.1
+CHAT_SHARD_MOVE_GRACE = 0
@@ -4,31 +4,26 @@ from django.http import HttpResponse
 
 logger = logging.getLogger(__name__)
 
-print("🔧 SimpleCorsMiddleware module loaded successfully")
+ALLOWED_METHODS = 'GET, POST, PUT, PATCH, DELETE, OPTIONS'
+# Upload-Offset resumes uploads, If-None-Match revalidates lists, X-Chat-Profile opts into profiling
+ALLOWED_HEADERS = 'Content-Type, Authorization, X-Requested-With, Upload-Offset, If-None-Match, X-Chat-Profile'
+EXPOSED_HEADERS = 'ETag, Upload-Offset, Upload-Length, X-Chat-Profile-Id'
 
 class SimpleCorsMiddleware(MiddlewareMixin):
-    def __init__(self, get_response=None):
-        super().__init__(get_response)
-        print("🔧 SimpleCorsMiddleware initialized")
-    
     def process_request(self, request):
         # Log the request for debugging
-        print(f"🔧 Simple CORS - Request: {request.method} {request.path}")
-        print(f"🔧 Simple CORS - Origin: {request.headers.get('Origin', 'No Origin')}")
-        logger.info(f"Simple CORS - Request: {request.method} {request.path}")
-        logger.info(f"Simple CORS - Origin: {request.headers.get('Origin', 'No Origin')}")
+        logger.debug(f"Simple CORS - Request: {request.method} {request.path}")
+        logger.debug(f"Simple CORS - Origin: {request.headers.get('Origin', 'No Origin')}")
         
         # Handle preflight requests
         if request.method == 'OPTIONS':
-            print(f"🔧 Simple CORS - Handling OPTIONS preflight for {request.path}")
             response = HttpResponse()
             response['Access-Control-Allow-Origin'] = '*'  # Temporarily allow all origins
-            response['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-            response['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With'
+            response['Access-Control-Allow-Methods'] = ALLOWED_METHODS
+            response['Access-Control-Allow-Headers'] = ALLOWED_HEADERS
             response['Access-Control-Allow-Credentials'] = 'true'
             response['Access-Control-Max-Age'] = '86400'  # 24 hours
-            print(f"🔧 Simple CORS - Preflight response headers: {dict(response.headers)}")
-            logger.info(f"Simple CORS - Preflight response for {request.path}")
+            logger.debug(f"Simple CORS - Preflight response for {request.path}")
             return response
         
         return None
@@ -36,20 +31,15 @@ class SimpleCorsMiddleware(MiddlewareMixin):
     def process_response(self, request, response):
         # Add CORS headers to all responses
         origin = request.headers.get('Origin')
-        print(f"🔧 Simple CORS - Processing response for {request.path}")
-        print(f"🔧 Simple CORS - Response origin: {origin}")
         
         # Temporarily allow all origins for debugging
         if origin:
             response['Access-Control-Allow-Origin'] = origin
             response['Access-Control-Allow-Credentials'] = 'true'
-            response['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-            response['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With'
+            response['Access-Control-Allow-Methods'] = ALLOWED_METHODS
+            response['Access-Control-Allow-Headers'] = ALLOWED_HEADERS
+            response['Access-Control-Expose-Headers'] = EXPOSED_HEADERS
             
-            print(f"🔧 Simple CORS - Added headers for {request.path}")
-            print(f"🔧 Simple CORS - Final response headers: {dict(response.headers)}")
-            logger.info(f"Simple CORS - Added headers for {request.path}")
-        else:
-            print(f"🔧 Simple CORS - No origin header found")
-        
+            logger.debug(f"Simple CORS - Added headers for {request.path}")
+
         return response 
\ No newline at end of file
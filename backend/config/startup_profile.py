@@ -0,0 +1,82 @@
+"""
+Startup profiling, enabled with CHAT_PROFILE_STARTUP=1.
+
+Times every module import from the moment ``start()`` is called and reports the
+slowest ones (cumulative and self time, like ``python -X importtime``) plus
+the time until the first request has been answered. Reports go to stderr
+because logging is not configured yet when most imports happen.
+"""
+
+import importlib.abc
+import os
+import sys
+import time
+
+_started_at = None
+_timings = {}
+_stack = []
+
+
+class _TimedLoader(importlib.abc.Loader):
+    def __init__(self, loader, name):
+        self.loader = loader
+        self.name = name
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        start = time.perf_counter()
+        _stack.append(0.0)
+        try:
+            self.loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = _stack.pop()
+            if _stack:
+                _stack[-1] += elapsed
+            _timings[self.name] = (elapsed, elapsed - children)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+class _TimingFinder(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                    spec.loader = _TimedLoader(spec.loader, fullname)
+                return spec
+        return None
+
+
+def enabled():
+    return os.getenv("CHAT_PROFILE_STARTUP", "").lower() in ("1", "true")
+
+
+def start():
+    global _started_at
+    if _started_at is not None:
+        return
+    _started_at = time.perf_counter()
+    sys.meta_path.insert(0, _TimingFinder())
+
+
+def elapsed_ms():
+    return (time.perf_counter() - _started_at) * 1000 if _started_at is not None else None
+
+
+def report(label, limit=25):
+    """Print the slowest imports so far under ``label`` to stderr"""
+    if _started_at is None:
+        return
+    slowest = sorted(_timings.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+    lines = [f"{label}: {elapsed_ms():.0f} ms since start, {len(_timings)} modules imported"]
+    lines.append(f"{'self ms':>9} {'cumulative ms':>14}  module")
+    for name, (cumulative, own) in slowest:
+        lines.append(f"{own * 1000:>9.1f} {cumulative * 1000:>14.1f}  {name}")
+    print("\n".join(lines), file=sys.stderr, flush=True)
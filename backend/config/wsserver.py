@@ -0,0 +1,47 @@
+"""
+Daphne with permessage-deflate negotiation.
+
+Daphne has no option for WebSocket compression, so this entry point runs the
+regular daphne command line with a Server that enables it on the WebSocket
+factory before the first connection is accepted. Arguments are the same as
+for ``daphne``:
+
+    python -m config.wsserver -b 0.0.0.0 -p 8000 config.asgi:application
+
+Set CHAT_WS_PERMESSAGE_DEFLATE=False to turn compression off. Clients that
+do not offer the extension are unaffected either way.
+"""
+
+import os
+
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from twisted.internet import reactor
+
+
+def accept_permessage_deflate(offers):
+    for offer in offers:
+        if isinstance(offer, PerMessageDeflateOffer):
+            # Chat frames are small: a 2 KB window keeps most of the gain
+            # while bounding the compressor memory held per socket
+            return PerMessageDeflateOfferAccept(offer, window_bits=11, mem_level=4)
+    return None
+
+
+class CompressingServer(Server):
+    def run(self):
+        if os.getenv("CHAT_WS_PERMESSAGE_DEFLATE", "True").lower() == "true":
+            # The factory is created inside run(); configure it once the reactor starts
+            reactor.callWhenRunning(
+                lambda: self.ws_factory.setProtocolOptions(perMessageCompressionAccept=accept_permessage_deflate)
+            )
+        super().run()
+
+
+class CommandLine(CommandLineInterface):
+    server_class = CompressingServer
+
+
+if __name__ == "__main__":
+    CommandLine.entrypoint()
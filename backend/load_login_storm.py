@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Load test: chat message latency while a burst of logins hits the server.
+
+Starts the server (start_server.py, one worker) once for each hashing pool
+size in --hash-workers. Chat clients send a message over their WebSocket
+every --interval seconds and time how long it takes for the message to come
+back through the broadcast. After a quiet baseline phase, --login-clients
+threads call POST /api/auth/token/ in a loop. The script prints p50/p99
+message latency for both phases, plus how many logins succeeded or were
+refused with 429.
+
+    python load_login_storm.py [--hash-workers 64 1] [--chat-clients 4] [--login-clients 32] [--seconds 10]
+
+A very large pool (64) behaves like hashing on the request threads; the
+configured default is CHAT_PASSWORD_HASH_WORKERS. Test users and
+conversations are created under the ``loadtest_`` prefix and removed afterwards.
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+import django
+
+django.setup()
+
+from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from rest_framework_simplejwt.tokens import AccessToken
+
+from chat.models import Conversation
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'loadtest-password'
+User = get_user_model()
+
+
+def seed(chat_clients, login_users):
+    """One conversation per chat client, plus users to log in as; all share one hash"""
+    cleanup()
+    encoded = make_password(PASSWORD)
+    users = User.objects.bulk_create(
+        [User(username=f'loadtest_chat_{i}', password=encoded) for i in range(chat_clients)]
+        + [User(username=f'loadtest_login_{i}', password=encoded) for i in range(login_users)]
+    )
+    sessions = []
+    for user in users[:chat_clients]:
+        conversation = Conversation.objects.create(title=f'loadtest {user.username}')
+        conversation.participants.add(user)
+        sessions.append((str(AccessToken.for_user(user)), conversation.id))
+    return sessions
+
+
+def cleanup():
+    Conversation.objects.filter(title__startswith='loadtest ').delete()
+    User.objects.filter(username__startswith='loadtest_').delete()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on port {port} did not come up")
+
+
+class ChatClient(WebSocketClientProtocol):
+    """Sends a message every interval and records the time until it is broadcast back"""
+
+    def onOpen(self):
+        self.factory.opened.set_result(self)
+
+    def onMessage(self, payload, isBinary):
+        event = json.loads(payload)
+        sent = self.factory.in_flight.pop(event.get('client_msg_id'), None)
+        if sent is not None:
+            self.factory.samples.append((time.monotonic(), (time.monotonic() - sent) * 1000))
+
+    def send_probe(self):
+        client_msg_id = uuid.uuid4().hex
+        self.factory.in_flight[client_msg_id] = time.monotonic()
+        self.sendMessage(json.dumps({
+            'type': 'message',
+            'message': 'latency probe',
+            'client_msg_id': client_msg_id,
+        }).encode())
+
+
+async def chat_client(port, token, conversation_id, interval, until):
+    loop = asyncio.get_running_loop()
+    factory = WebSocketClientFactory(f'ws://127.0.0.1:{port}/ws/chat/{conversation_id}/?token={token}')
+    factory.protocol = ChatClient
+    factory.opened = loop.create_future()
+    factory.in_flight = {}
+    factory.samples = []
+    transport, _ = await loop.create_connection(factory, '127.0.0.1', port)
+    client = await factory.opened
+    while time.monotonic() < until:
+        client.send_probe()
+        await asyncio.sleep(interval)
+    await asyncio.sleep(1)
+    transport.close()
+    return factory.samples
+
+
+def login_storm(port, stop, results):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    index = 0
+    while not stop.is_set():
+        body = json.dumps({'username': f'loadtest_login_{index % 50}', 'password': PASSWORD})
+        index += 1
+        try:
+            connection.request('POST', '/api/auth/token/', body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            response.read()
+            results.append(response.status)
+        except (OSError, http.client.HTTPException):
+            results.append(None)
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(hash_workers, sessions, args):
+    port = free_port()
+    env = dict(os.environ, CHAT_PASSWORD_HASH_WORKERS=str(hash_workers), CHAT_PASSWORD_HASH_QUEUE=str(args.queue))
+    server = subprocess.Popen(
+        [sys.executable, 'start_server.py', '--host', '127.0.0.1', '--port', str(port), '--workers', '1'],
+        cwd=BASE_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(port)
+        started = time.monotonic()
+        storm_at = started + args.seconds
+        until = storm_at + args.seconds
+
+        stop = threading.Event()
+        logins = []
+        storm = [
+            threading.Thread(target=login_storm, args=(port, stop, logins), daemon=True)
+            for _ in range(args.login_clients)
+        ]
+
+        async def run():
+            clients = asyncio.gather(*(
+                chat_client(port, token, conversation_id, args.interval, until)
+                for token, conversation_id in sessions
+            ))
+            await asyncio.sleep(max(0, storm_at - time.monotonic()))
+            for thread in storm:
+                thread.start()
+            return await clients
+
+        samples = [sample for client in asyncio.run(run()) for sample in client]
+        stop.set()
+        for thread in storm:
+            thread.join(30)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(30)
+
+    baseline = [ms for at, ms in samples if at < storm_at]
+    during = [ms for at, ms in samples if at >= storm_at]
+    ok = sum(1 for status in logins if status == 200)
+    refused = sum(1 for status in logins if status == 429)
+    for phase, values in (('baseline', baseline), ('storm', during)):
+        print(
+            f"{hash_workers:>8}{phase:>10}{statistics.median(values) if values else float('nan'):>9.1f}"
+            f"{percentile(values, 0.99):>9.1f}{len(values):>9}"
+            + (f"{ok:>8}{refused:>8}" if phase == 'storm' else '')
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hash-workers', type=int, nargs='+', default=[64, 1])
+    parser.add_argument('--chat-clients', type=int, default=4)
+    parser.add_argument('--login-clients', type=int, default=32)
+    parser.add_argument('--interval', type=float, default=0.5)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--queue', type=int, default=64)
+    args = parser.parse_args()
+
+    sessions = seed(args.chat_clients, 50)
+    try:
+        print(f"📊 {args.chat_clients} chat clients, {args.login_clients} login clients, {os.cpu_count()} CPUs")
+        print(f"{'workers':>8}{'phase':>10}{'p50 ms':>9}{'p99 ms':>9}{'samples':>9}{'logins':>8}{'429s':>8}")
+        for hash_workers in args.hash_workers:
+            measure(hash_workers, sessions, args)
+    finally:
+        cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,75 +1,186 @@
 #!/usr/bin/env python
 """
-Script to start the Django server with Daphne for WebSocket support.
+Production launcher: runs several Daphne workers on one listening socket.
+
+The socket is bound once here and handed to every worker (``daphne --fd``),
+so the kernel spreads new connections across them. The launcher supervises
+the workers: crashed ones are replaced, SIGTERM/SIGINT stop them all, and
+SIGHUP does a rolling restart. During a rolling restart each worker is
+replaced in turn: a new worker starts first, then the old one is drained
+(SIGUSR1, see chat/drain.py) so its clients reconnect gradually.
+
+    python start_server.py [--workers N] [--host 0.0.0.0] [--port 8000]
+
+Workers default to WEB_CONCURRENCY, else the CPU count with a Redis channel
+layer and a single worker without one. With more than one worker the channel
+layer must be Redis (set REDIS_URL with the production settings), otherwise
+sockets on different workers could not reach each other.
+Dependencies are installed at build time (build.sh), never here.
 """
 
+import argparse
 import os
-import sys
+import signal
+import socket
 import subprocess
-import django
-
-# Add the backend directory to the Python path
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-
-# Set up Django
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
-django.setup()
-
-def check_dependencies():
-    """Check if required dependencies are installed"""
-    print("🔍 Checking dependencies...")
-    
-    try:
-        import channels
-        print("✅ channels installed")
-    except ImportError:
-        print("❌ channels not installed. Installing...")
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "channels==4.0.0"])
-    
-    try:
-        import daphne
-        print("✅ daphne installed")
-    except ImportError:
-        print("❌ daphne not installed. Installing...")
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "daphne"])
-    
-    try:
-        import redis
-        print("✅ redis installed")
-    except ImportError:
-        print("❌ redis not installed. Installing...")
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "redis==5.0.1"])
-
-def start_daphne_server():
-    """Start the server with Daphne"""
-    print("\n🚀 Starting Django server with Daphne...")
-    print("📍 Server will be available at: http://localhost:8000")
-    print("🔌 WebSocket endpoint: ws://localhost:8000/ws/chat/{conversation_id}/")
-    print("\nPress Ctrl+C to stop the server")
-    print("=" * 50)
-    
-    try:
-        # Start Daphne server
-        subprocess.run([
-            sys.executable, "-m", "daphne",
-            "-b", "0.0.0.0",
-            "-p", "8000",
-            "config.asgi:application"
-        ])
-    except KeyboardInterrupt:
-        print("\n\n🛑 Server stopped by user")
-    except Exception as e:
-        print(f"\n❌ Error starting server: {e}")
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_settings():
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    from django.conf import settings
+
+    return settings
+
+
+def default_workers():
+    """WEB_CONCURRENCY, else one worker per CPU when the channel layer is shared"""
+    configured = int(os.getenv('WEB_CONCURRENCY', '0'))
+    if configured:
+        return configured
+    backend = load_settings().CHANNEL_LAYERS['default']['BACKEND']
+    if 'redis' not in backend.lower():
+        return 1
+    return os.cpu_count() or 1
+
+
+def check_channel_layer(workers):
+    """Refuse to run several workers on a per-process channel layer"""
+    settings = load_settings()
+    backend = settings.CHANNEL_LAYERS['default']['BACKEND']
+    if workers > 1 and 'redis' not in backend.lower():
+        sys.exit(
+            f"❌ {workers} workers need a Redis channel layer, got {backend}. "
+            f"Set REDIS_URL (with config.settings_production) or use --workers 1."
+        )
+    cache_backend = settings.CACHES['default']['BACKEND']
+    if workers > 1 and 'locmem' in cache_backend.lower():
+        print("⚠️  The cache is per process: rate limits, duplicate-send detection and token revocation are not shared between workers")
+
+
+def bind_socket(host, port, backlog=2048):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor:
+    def __init__(self, sock, workers, application, drain_timeout):
+        self.sock = sock
+        self.size = workers
+        self.application = application
+        self.drain_timeout = drain_timeout
+        self.workers = []
+        self.stopping = False
+        self.restart_requested = False
+
+    def spawn(self):
+        fd = self.sock.fileno()
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'config.wsserver', '--fd', str(fd), self.application],
+            cwd=BASE_DIR,
+            pass_fds=(fd,),
+        )
+        print(f"🚀 Worker {process.pid} started")
+        return process
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        signal.signal(signal.SIGHUP, self.on_reload)
+
+        self.workers = [self.spawn() for _ in range(self.size)]
+        while not self.stopping:
+            if self.restart_requested:
+                self.restart_requested = False
+                self.rolling_restart()
+            self.replace_dead()
+            time.sleep(0.5)
+        self.stop_all()
+
+    def replace_dead(self):
+        for index, process in enumerate(self.workers):
+            if process.poll() is not None and not self.stopping:
+                print(f"⚠️  Worker {process.pid} exited with {process.returncode}, replacing it")
+                self.workers[index] = self.spawn()
+
+    def rolling_restart(self):
+        print("🔄 Rolling restart")
+        for index, old in enumerate(list(self.workers)):
+            if self.stopping:
+                return
+            self.workers[index] = self.spawn()
+            # Let the new worker load the app before the old one starts shedding clients
+            time.sleep(2)
+            if old.poll() is None:
+                old.send_signal(signal.SIGUSR1)
+                self.wait(old, self.drain_timeout)
+        print("✅ Rolling restart complete")
+
+    def wait(self, process, timeout):
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            print(f"⚠️  Worker {process.pid} did not exit in {timeout}s, killing it")
+            process.kill()
+            process.wait()
+
+    def stop_all(self):
+        print("\n🛑 Stopping workers")
+        for process in self.workers:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.workers:
+            self.wait(process, 15)
+
+    def on_stop(self, signum, frame):
+        self.stopping = True
+
+    def on_reload(self, signum, frame):
+        self.restart_requested = True
+
 
 def main():
-    print("🎯 Django Chat Server with WebSocket Support")
-    print("=" * 50)
-    
-    # Check and install dependencies
-    check_dependencies()
-    
-    # Start server
-    start_daphne_server()
+    parser = argparse.ArgumentParser(description='Run the chat server with several Daphne workers')
+    parser.add_argument('--host', default=os.getenv('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', '8000')))
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='Worker processes (default: WEB_CONCURRENCY, else the CPU count with Redis, else 1)',
+    )
+    parser.add_argument('--application', default='config.asgi:application')
+    parser.add_argument(
+        '--drain-timeout',
+        type=float,
+        default=60,
+        help='Seconds a worker may spend draining during a rolling restart',
+    )
+    parser.add_argument(
+        '--skip-layer-check',
+        action='store_true',
+        help='Allow several workers without Redis (HTTP-only benchmarks)',
+    )
+    args = parser.parse_args()
+    if not args.workers:
+        args.workers = default_workers()
+
+    if not args.skip_layer_check:
+        check_channel_layer(args.workers)
+
+    sock = bind_socket(args.host, args.port)
+    print(f"🎯 Chat server on http://{args.host}:{args.port} with {args.workers} worker(s)")
+    print(f"🔌 WebSocket endpoint: ws://{args.host}:{args.port}/ws/chat/{{conversation_id}}/")
+    Supervisor(sock, args.workers, args.application, args.drain_timeout).run()
+
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -1,11 +1,18 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
 
+from chat.admin import MessageCountMixin
+from chat.admin_pagination import EstimatedCountPaginator
+
 from .models import User
 
 
 @admin.register(User)
-class UserAdmin(DjangoUserAdmin):
+class UserAdmin(MessageCountMixin, DjangoUserAdmin):
+    list_display = ("username", "email", "display_name", "is_staff", "message_count", "date_joined")
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    message_count_field = "sender"
     fieldsets = (
         (None, {"fields": ("username", "password")}),
         ("Personal info", {"fields": ("first_name", "last_name", "email", "display_name")}),
@@ -23,3 +30,7 @@ class UserAdmin(DjangoUserAdmin):
         ),
         ("Important dates", {"fields": ("last_login", "date_joined")}),
     )
+
+    @admin.display(description="messages sent")
+    def message_count(self, obj):
+        return obj.message_total or 0
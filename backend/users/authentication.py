@@ -0,0 +1,17 @@
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+from config import db_router
+
+
+class StickyJWTAuthentication(JWTAuthentication):
+    """JWT authentication that applies the user's primary pin before loading them.
+
+    A user who wrote moments ago, or who just registered, is read from the
+    primary, so the user row and their own changes are never missing on a
+    lagging replica.
+    """
+
+    def get_user(self, validated_token):
+        db_router.identify(validated_token.get(api_settings.USER_ID_CLAIM))
+        return super().get_user(validated_token)
@@ -0,0 +1,46 @@
+"""
+Refresh-token revocation kept in the cache instead of simplejwt's blacklist tables.
+
+A revoked token's ``jti`` is stored only until the token's own ``exp``;
+after that the signature check rejects the token anyway, so entries expire by
+themselves and nothing grows or needs a cleanup job. Checking and revoking
+are single cache operations. Revocation is only shared between workers when
+the cache is (Redis in production).
+"""
+
+import math
+import time
+
+from django.core.cache import cache
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+
+def _key(jti):
+    return f"auth:revoked:{jti}"
+
+
+def revoke(token):
+    """Revoke ``token`` until it expires; False if it was already revoked.
+
+    Uses ``cache.add`` so of two concurrent refreshes with the same token
+    only one succeeds.
+    """
+    ttl = math.ceil(token["exp"] - time.time())
+    if ttl <= 0:
+        return True
+    return cache.add(_key(token[api_settings.JTI_CLAIM]), 1, ttl)
+
+
+def is_revoked(token):
+    return cache.get(_key(token[api_settings.JTI_CLAIM])) is not None
+
+
+class DenylistRefreshToken(RefreshToken):
+    """Refresh token that fails verification once its ``jti`` has been revoked"""
+
+    def verify(self):
+        super().verify()
+        if is_revoked(self):
+            raise TokenError("Token is revoked")
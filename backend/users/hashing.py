@@ -0,0 +1,110 @@
+"""
+Password hashing on a small dedicated thread pool.
+
+PBKDF2 releases the GIL, so every concurrent login or registration keeps a
+core busy for the whole hash. Left on the request threads, a burst of logins
+takes every core and chat traffic (``database_sync_to_async`` calls, event
+fan-out) waits behind it. ``BoundedPBKDF2PasswordHasher`` hands the hash to
+CHAT_PASSWORD_HASH_WORKERS threads instead. At most CHAT_PASSWORD_HASH_QUEUE
+hashes may be running or waiting; beyond that the request is refused with 429
+rather than queued indefinitely. API views answer ``HashingBusy`` through DRF;
+``HashingBusyMiddleware`` does the same for Django views such as the admin
+login.
+
+Queue depth is published through ``chat.metrics``; the counters are
+``auth.hash.*`` (jobs, rejected, wait and run time in milliseconds).
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.http import HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework.exceptions import Throttled
+
+from chat import metrics
+
+_lock = threading.Lock()
+_executor = None
+_pending = 0
+
+
+class HashingBusy(Throttled):
+    default_detail = "Too many sign-ins right now, try again shortly."
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "CHAT_PASSWORD_HASH_WORKERS", 2),
+                thread_name_prefix="password-hash",
+            )
+            metrics.register("auth.hash_queue", stats)
+        return _executor
+
+
+def stats():
+    return {
+        "pending": _pending,
+        "workers": getattr(settings, "CHAT_PASSWORD_HASH_WORKERS", 2),
+        "limit": getattr(settings, "CHAT_PASSWORD_HASH_QUEUE", 64),
+    }
+
+
+def run(func, *args):
+    """Run ``func(*args)`` on the hashing pool and wait for the result"""
+    global _pending
+    executor = _get_executor()
+    with _lock:
+        if _pending >= getattr(settings, "CHAT_PASSWORD_HASH_QUEUE", 64):
+            metrics.incr("auth.hash.rejected")
+            raise HashingBusy(wait=1)
+        _pending += 1
+
+    submitted = time.perf_counter()
+
+    def job():
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            metrics.incr("auth.hash.jobs")
+            metrics.incr("auth.hash.wait_ms", round((started - submitted) * 1000))
+            metrics.incr("auth.hash.run_ms", round((time.perf_counter() - started) * 1000))
+
+    try:
+        return executor.submit(job).result()
+    finally:
+        with _lock:
+            _pending -= 1
+
+
+class BoundedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """Django's PBKDF2-SHA256 hasher with the work moved to the hashing pool.
+
+    It keeps the ``pbkdf2_sha256`` algorithm name, so existing hashes verify
+    unchanged, and upgrades them on login when CHAT_PASSWORD_ITERATIONS changes.
+    """
+
+    @property
+    def iterations(self):
+        return getattr(settings, "CHAT_PASSWORD_ITERATIONS", PBKDF2PasswordHasher.iterations)
+
+    def encode(self, password, salt, iterations=None):
+        return run(super().encode, password, salt, iterations)
+
+
+class HashingBusyMiddleware(MiddlewareMixin):
+    """Answer ``HashingBusy`` raised outside DRF (admin and form logins) with 429 instead of 500"""
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, HashingBusy):
+            return None
+        response = HttpResponse(exception.detail, status=exception.status_code, content_type="text/plain")
+        response["Retry-After"] = str(exception.wait)
+        return response
@@ -1,9 +1,13 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.utils import timezone
 
 
 class User(AbstractUser):
     display_name = models.CharField(max_length=150, blank=True)
+    # Validators for the conversation list, bumped on membership changes and participant renames
+    conversations_version = models.PositiveBigIntegerField(default=1)
+    conversations_changed_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self) -> str:
         return self.username
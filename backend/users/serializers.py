@@ -1,5 +1,10 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+from .denylist import DenylistRefreshToken, revoke
 
 
 User = get_user_model()
@@ -27,3 +32,23 @@ class RegisterSerializer(serializers.ModelSerializer):
         user.save()
         return user
 
+
+class DenylistTokenRefreshSerializer(TokenRefreshSerializer):
+    """Refresh with rotation; the used refresh token is revoked in the cache denylist"""
+
+    token_class = DenylistRefreshToken
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs["refresh"])
+        data = {"access": str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            if api_settings.BLACKLIST_AFTER_ROTATION and not revoke(refresh):
+                # Another request rotated this token first
+                raise TokenError("Token is revoked")
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data["refresh"] = str(refresh)
+
+        return data
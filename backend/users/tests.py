@@ -1,3 +1,68 @@
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
 
 # Create your tests here.
+
+
+class RefreshDenylistTests(TransactionTestCase):
+    """Run with config.settings_test"""
+
+    databases = {'default', 'replica_1', 'replica_2'}
+
+    def setUp(self):
+        self.alice = get_user_model().objects.create_user('alice')
+        self.refresh = RefreshToken.for_user(self.alice)
+        self.addCleanup(cache.clear)
+
+    def logout(self, user, refresh):
+        return self.client.post(
+            '/api/auth/logout/',
+            {'refresh': str(refresh)},
+            content_type='application/json',
+            HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(user).access_token}',
+        )
+
+    def use(self, refresh):
+        return self.client.post('/api/auth/token/refresh/', {'refresh': str(refresh)}, content_type='application/json')
+
+    def test_logout_revokes_the_refresh_token(self):
+        self.assertEqual(self.logout(self.alice, self.refresh).status_code, 200)
+        self.assertEqual(self.use(self.refresh).status_code, 401)
+
+    def test_rotated_refresh_token_cannot_be_reused(self):
+        response = self.use(self.refresh)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.use(self.refresh).status_code, 401)
+        self.assertEqual(self.use(response.json()['refresh']).status_code, 200)
+
+    def test_logout_ignores_other_users_tokens(self):
+        bob = get_user_model().objects.create_user('bob')
+        self.assertEqual(self.logout(bob, self.refresh).status_code, 200)
+        self.assertEqual(self.use(self.refresh).status_code, 200)
+
+
+class HashingPoolTests(TransactionTestCase):
+    """Run with config.settings_test"""
+
+    databases = {'default', 'replica_1', 'replica_2'}
+
+    def setUp(self):
+        get_user_model().objects.create_user('alice', password='correct horse', is_staff=True)
+
+    def assertRefused(self, response):
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+
+    @override_settings(CHAT_PASSWORD_HASH_QUEUE=0)
+    def test_full_pool_refuses_api_logins(self):
+        self.assertRefused(self.client.post('/api/auth/token/', {'username': 'alice', 'password': 'correct horse'}))
+
+    @override_settings(CHAT_PASSWORD_HASH_QUEUE=0)
+    def test_full_pool_refuses_admin_logins(self):
+        self.assertRefused(self.client.post('/admin/login/', {'username': 'alice', 'password': 'correct horse'}))
+
+    def test_logins_go_through_when_the_pool_has_room(self):
+        response = self.client.post('/api/auth/token/', {'username': 'alice', 'password': 'correct horse'})
+        self.assertEqual(response.status_code, 200)
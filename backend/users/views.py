@@ -1,11 +1,16 @@
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.db.models import Q
 
+from config import db_router
+
+from .denylist import DenylistRefreshToken, revoke
 from .serializers import RegisterSerializer, UserSerializer
 
 
@@ -16,6 +21,11 @@ class RegisterView(generics.CreateAPIView):
     serializer_class = RegisterSerializer
     permission_classes = [permissions.AllowAny]
 
+    def perform_create(self, serializer):
+        user = serializer.save()
+        # Their first authenticated requests must find the row on the primary
+        db_router.identify(user.pk)
+
 
 class CustomTokenObtainPairView(TokenObtainPairView):
     def finalize_response(self, request, response, *args, **kwargs):
@@ -66,6 +76,18 @@ class LogoutView(generics.GenericAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request):
+        # Revoke the refresh token (body or cookie) so it cannot mint new access tokens
+        raw_token = request.data.get("refresh") or request.COOKIES.get("refresh_token")
+        if raw_token:
+            try:
+                token = DenylistRefreshToken(raw_token)
+            except TokenError:
+                # Expired, malformed or already revoked: nothing left to revoke
+                pass
+            else:
+                if token.get(api_settings.USER_ID_CLAIM) == getattr(request.user, api_settings.USER_ID_FIELD):
+                    revoke(token)
+
         response = Response({"detail": "Successfully logged out."})
         # Clear the refresh token cookie
         response.delete_cookie('refresh_token')